@@ -1,21 +1,43 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Body, UploadFile, File, Form, Request, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, Body, Request, Query, Header
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any, Union
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from bson import ObjectId
 import os
 import socket
 from dotenv import load_dotenv
-import shutil
 import uuid
+import hashlib
+import secrets
+import re
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+import aiofiles
+import json
+import base64
+import binascii
 from pathlib import Path
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+from multipart.multipart import MultipartParser, parse_options_header
 import logging
+import asyncio
+import time
+import heapq
+import bisect
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cachetools import TTLCache
 
 # Firebase imports (make sure to install firebase-admin)
 try:
@@ -26,6 +48,28 @@ except ImportError:
     firebase_available = False
     logging.warning("Firebase Admin SDK not installed. Push notifications will be disabled.")
 
+# S3-compatible storage (make sure to install boto3 when STORAGE_BACKEND=s3)
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+    boto3_available = True
+except ImportError:
+    boto3_available = False
+
+# Derivative generation (install Pillow and PyMuPDF for thumbnails and PDF previews)
+try:
+    from PIL import Image
+    pillow_available = True
+except ImportError:
+    pillow_available = False
+
+try:
+    import pymupdf
+    pymupdf_available = True
+except ImportError:
+    pymupdf_available = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -38,23 +82,268 @@ MONGODB_URL = os.getenv("MONGODB_URL", "mongodb+srv://cybexonicsitconsultants:aa
 client = AsyncIOMotorClient(MONGODB_URL)
 db = client.learnlive
 
+# Set INDEX_DIAGNOSTICS=1 to explain the known query shapes at startup and
+# report any that still fall back to a collection scan
+INDEX_DIAGNOSTICS = os.getenv("INDEX_DIAGNOSTICS", "0") == "1"
+
 # File upload settings
 UPLOAD_DIR = "uploads"
 Path(UPLOAD_DIR).mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+UPLOAD_SIZE_LIMITS = {
+    "video": int(os.getenv("MAX_VIDEO_UPLOAD_MB", "2048")) * 1024 * 1024,
+    "document": int(os.getenv("MAX_DOCUMENT_UPLOAD_MB", "100")) * 1024 * 1024,
+    "image": int(os.getenv("MAX_IMAGE_UPLOAD_MB", "20")) * 1024 * 1024,
+    "file": int(os.getenv("MAX_FILE_UPLOAD_MB", "100")) * 1024 * 1024,
+}
+MAX_UPLOAD_BYTES = max(UPLOAD_SIZE_LIMITS.values())
+# Text fields sent alongside an upload (title, description, ...)
+UPLOAD_FORM_FIELD_MAX_BYTES = 64 * 1024
+
+# Storage backend: 'local' keeps files in UPLOAD_DIR, 's3' stores them in an
+# S3-compatible bucket (AWS S3, MinIO, ...)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_BUCKET = os.getenv("S3_BUCKET", "learnlive-uploads")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+# Base URL that stored objects are readable from, e.g. a CDN or public bucket
+S3_PUBLIC_URL = os.getenv("S3_PUBLIC_URL")
+PRESIGNED_URL_EXPIRE_SECONDS = int(os.getenv("PRESIGNED_URL_EXPIRE_SECONDS", "3600"))
+
+# Media serving: uploads never change under their (uuid or SHA-256) name,
+# so clients may cache them for a year
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Derivatives (thumbnails, PDF previews, page counts, extracted text) are
+# generated by the outbox worker in a process pool, cached per source SHA-256
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+PDF_PREVIEW_WIDTH = int(os.getenv("PDF_PREVIEW_WIDTH", "1024"))
+DERIVATIVE_TEXT_LIMIT = int(os.getenv("DERIVATIVE_TEXT_LIMIT", "100000"))
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Orphaned upload sweeper: files in UPLOAD_DIR that nothing references are
+# moved to UPLOAD_QUARANTINE_DIR first and deleted after the quarantine period.
+# Files younger than the grace period are skipped so uploads that are still
+# being attached are never touched.
+UPLOAD_QUARANTINE_DIR = "uploads_quarantine"
+SWEEPER_GRACE_SECONDS = int(os.getenv("SWEEPER_GRACE_SECONDS", str(60 * 60 * 24)))
+SWEEPER_QUARANTINE_DAYS = int(os.getenv("SWEEPER_QUARANTINE_DAYS", "7"))
+SWEEPER_BATCH_SIZE = int(os.getenv("SWEEPER_BATCH_SIZE", "1000"))
+SWEEPER_INTERVAL_SECONDS = int(os.getenv("SWEEPER_INTERVAL_SECONDS", "0"))  # 0 disables
+
+# Resumable upload sessions keep their partial files outside UPLOAD_DIR so
+# incomplete uploads are never served
+UPLOAD_SESSIONS_DIR = "upload_sessions"
+Path(UPLOAD_SESSIONS_DIR).mkdir(exist_ok=True)
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS = int(os.getenv("UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS", "900"))
+# A chunk PUT holds the session's writer lease while it streams, renewed as
+# it goes; a client that vanished mid-chunk frees the session when it lapses
+UPLOAD_SESSION_WRITER_LEASE_SECONDS = 60
 
 # JWT settings
 SECRET_KEY = os.getenv("SECRET_KEY", "your-very-secret-key-123")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
+# Operational endpoints under /ops/ need an X-Ops-Token header matching
+# OPS_TOKEN; without OPS_TOKEN they are disabled
+OPS_TOKEN = os.getenv("OPS_TOKEN")
+
+# Notification fan-out settings
+NOTIFICATION_INSERT_CHUNK_SIZE = int(os.getenv("NOTIFICATION_INSERT_CHUNK_SIZE", "1000"))
+FCM_MULTICAST_BATCH_SIZE = 500  # FCM's per-request token limit
+FCM_TOPIC_BATCH_SIZE = 1000  # FCM's per-request limit for topic (un)subscribes
+
+# The Firebase Admin SDK is synchronous, so FCM calls run in a dedicated thread
+# pool. The SDK reuses one authorized HTTP session per app, so these threads
+# share pooled connections to FCM rather than reconnecting per call.
+FCM_MAX_CONCURRENCY = int(os.getenv("FCM_MAX_CONCURRENCY", "8"))
+FCM_SEND_TIMEOUT_SECONDS = float(os.getenv("FCM_SEND_TIMEOUT_SECONDS", "10"))
+fcm_executor = ThreadPoolExecutor(max_workers=FCM_MAX_CONCURRENCY, thread_name_prefix="fcm")
+fcm_semaphore = asyncio.Semaphore(FCM_MAX_CONCURRENCY)
+
+# Notification outbox settings. Notifications are enqueued into a Mongo
+# outbox and delivered by worker.py (or in-process with OUTBOX_INLINE_WORKER=1)
+OUTBOX_INLINE_WORKER = os.getenv("OUTBOX_INLINE_WORKER", "0") == "1"
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF_BASE_SECONDS = int(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "5"))
+OUTBOX_BACKOFF_MAX_SECONDS = int(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "600"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "1"))
+OUTBOX_FAN_OUT_CHUNK_SIZE = int(os.getenv("OUTBOX_FAN_OUT_CHUNK_SIZE", "1000"))
+OUTBOX_RETENTION_SECONDS = 60 * 60 * 24 * 7
+# Failed jobs are kept longer for inspection, then expire
+OUTBOX_FAILED_RETENTION_SECONDS = int(os.getenv("OUTBOX_FAILED_RETENTION_SECONDS", str(60 * 60 * 24 * 30)))
+
+# Data migrations. The process applying one holds a lease on its marker and
+# renews it while it runs; a marker whose lease ran out (the process died) is
+# taken over and the migration re-run. Others poll until it is applied
+MIGRATION_LEASE_SECONDS = int(os.getenv("MIGRATION_LEASE_SECONDS", "60"))
+MIGRATION_POLL_SECONDS = float(os.getenv("MIGRATION_POLL_SECONDS", "2"))
+
+# Real-time notification stream (Server-Sent Events). Each connection gets a
+# bounded queue; a client that falls behind has its queue replaced by a single
+# "resync" event and should refetch GET /notifications. Notifications are
+# written by the outbox worker, which normally runs in worker.py, so by default
+# the API picks them up from a Mongo change stream (needs a replica set).
+# "local" publishes straight from the writer and only reaches clients of the
+# same process, so it is the default only with OUTBOX_INLINE_WORKER=1
+NOTIFICATION_STREAM_QUEUE_SIZE = int(os.getenv("NOTIFICATION_STREAM_QUEUE_SIZE", "100"))
+NOTIFICATION_STREAM_HEARTBEAT_SECONDS = float(os.getenv("NOTIFICATION_STREAM_HEARTBEAT_SECONDS", "25"))
+NOTIFICATION_STREAM_SOURCE = os.getenv(
+    "NOTIFICATION_STREAM_SOURCE",
+    "local" if OUTBOX_INLINE_WORKER else "change_stream"
+)
+
+# Sessions. date/time are entered in SESSION_TIMEZONE and stored alongside
+# normalized UTC starts_at/ends_at datetimes used for queries
+SESSION_TIMEZONE = ZoneInfo(os.getenv("SESSION_TIMEZONE", "UTC"))
+SESSION_PAGE_SIZE = int(os.getenv("SESSION_PAGE_SIZE", "50"))
+SESSION_PAGE_SIZE_MAX = 200
+SESSION_MAX_DURATION_MINUTES = 24 * 60
+SCHEDULE_CHECK_MAX_SLOTS = 200
+
+# Session reminders. Sessions starting within the next window are held in an
+# in-process heap; a lease document per (session, start time) makes sure only
+# one worker sends each reminder
+SESSION_REMINDERS = os.getenv("SESSION_REMINDERS", "1") == "1"
+SESSION_REMINDER_MINUTES = int(os.getenv("SESSION_REMINDER_MINUTES", "15"))
+SESSION_REMINDER_WINDOW_SECONDS = int(os.getenv("SESSION_REMINDER_WINDOW_SECONDS", "3600"))
+SESSION_REMINDER_RELOAD_SECONDS = int(os.getenv("SESSION_REMINDER_RELOAD_SECONDS", "300"))
+SESSION_REMINDER_MAX_PENDING = int(os.getenv("SESSION_REMINDER_MAX_PENDING", "10000"))
+SESSION_REMINDER_LEASE_SECONDS = 120
+SESSION_REMINDER_RETRY_SECONDS = 30
+
+# iCalendar feeds. Rendered feeds are cached per user in each worker and
+# invalidated through a version stamp on the user whenever a session or
+# enrollment touches one of their courses; the TTL only bounds memory
+CALENDAR_CACHE_TTL_SECONDS = int(os.getenv("CALENDAR_CACHE_TTL_SECONDS", "3600"))
+CALENDAR_CACHE_MAX_SIZE = int(os.getenv("CALENDAR_CACHE_MAX_SIZE", "10000"))
+# How long a worker trusts a token it has looked up before checking users
+# again. Revocations and changes made on other workers show up within this
+# bound; requests inside it, 304 revalidations included, skip Mongo entirely
+CALENDAR_TOKEN_RECHECK_SECONDS = int(os.getenv("CALENDAR_TOKEN_RECHECK_SECONDS", "60"))
+CALENDAR_PAST_DAYS = int(os.getenv("CALENDAR_PAST_DAYS", "30"))
+CALENDAR_MAX_EVENTS = 500
+
+# Notification listing page size
+NOTIFICATION_PAGE_SIZE = int(os.getenv("NOTIFICATION_PAGE_SIZE", "50"))
+NOTIFICATION_PAGE_SIZE_MAX = 100
+
+# A notification is merged into the user's unread one for the same
+# (action_type, action_id) if that was created less than
+# NOTIFICATION_COALESCE_SECONDS ago; the merged record keeps a count and is
+# pushed once
+NOTIFICATION_COALESCE_SECONDS = int(os.getenv("NOTIFICATION_COALESCE_SECONDS", "60"))  # 0 disables
+NOTIFICATION_COALESCE_ATTEMPTS = 3
+NOTIFICATION_COALESCE_JOBS_KEPT = 50
+
+# Notification retention. Read notifications expire through a TTL index on
+# read_at; unread ones older than NOTIFICATION_ARCHIVE_AFTER_DAYS are compacted
+# into one notification_archive document per user and month
+NOTIFICATION_READ_RETENTION_DAYS = int(os.getenv("NOTIFICATION_READ_RETENTION_DAYS", "30"))
+NOTIFICATION_ARCHIVE_AFTER_DAYS = int(os.getenv("NOTIFICATION_ARCHIVE_AFTER_DAYS", "90"))
+NOTIFICATION_ARCHIVE_BATCH_SIZE = int(os.getenv("NOTIFICATION_ARCHIVE_BATCH_SIZE", "1000"))
+NOTIFICATION_ARCHIVE_INTERVAL_SECONDS = int(os.getenv("NOTIFICATION_ARCHIVE_INTERVAL_SECONDS", "21600"))  # 0 disables
+
+# Authenticated user cache settings
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt runs in a bounded thread pool (it releases the GIL) so logins don't
+# block the event loop. Once PASSWORD_HASH_MAX_PENDING jobs are queued or
+# running, further requests are rejected with 503 instead of piling up.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS,
+    thread_name_prefix="password-hash",
+)
+password_jobs_pending = 0
+
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+class UploadTooLarge(Exception):
+    pass
+
+class UploadSizeLimitMiddleware:
+    """Rejects multipart uploads larger than max_bytes with a 413.
+
+    Plain ASGI rather than @app.middleware("http"), so responses pass through
+    untouched (no buffering of streamed bodies, zero-copy sends keep working).
+    A declared Content-Length is checked up front; otherwise the body is
+    counted as the app reads it, which also catches chunked uploads.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+        content_length = headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        rejected = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected and not response_started:
+                # The app's own error response for the aborted read; ours replaces it
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+        if rejected and not response_started:
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope, receive, send):
+        response = JSONResponse(status_code=413, content={"detail": "Request body too large"})
+        await response(scope, receive, send)
+
 app = FastAPI(title="LearnLive API")
 
+# Refuse multipart bodies over the largest per-kind limit outright; upload
+# routes stream their file with read_upload_form, which enforces the limit for
+# its kind. Added first so CORS stays outermost and 413s carry CORS headers
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -102,7 +391,7 @@ class Course(CourseBase):
     id: str
     teacher_id: str
     teacher_name: str
-    students: Optional[List[str]] = []
+    student_count: int = 0
     thumbnail: Optional[str] = None
     modules: Optional[List[str]] = []
     created_at: datetime
@@ -110,6 +399,19 @@ class Course(CourseBase):
     class Config:
         from_attributes = True
 
+class CourseSummary(CourseBase):
+    id: str
+    teacher_id: str
+    teacher_name: str
+    student_count: int = 0
+    thumbnail: Optional[str] = None
+    modules: Optional[List[str]] = []
+    created_at: datetime
+
+class CoursePage(BaseModel):
+    items: List[CourseSummary]
+    next_cursor: Optional[str] = None
+
 class SessionBase(BaseModel):
     title: str
     description: str
@@ -123,11 +425,21 @@ class SessionBase(BaseModel):
 class SessionCreate(SessionBase):
     pass
 
+class SessionSlot(BaseModel):
+    date: str
+    time: str
+    duration: int
+
+class ScheduleCheck(BaseModel):
+    slots: List[SessionSlot]
+
 class Session(SessionBase):
     id: str
     meeting_link: Optional[str] = None
     recording_link: Optional[str] = None
     attendees: Optional[List[str]] = []
+    starts_at: Optional[datetime] = None
+    ends_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -166,6 +478,9 @@ class CourseMaterial(CourseMaterialBase):
     created_by: str
     file_name: Optional[str] = None
     file_size: Optional[int] = None
+    thumbnail: Optional[str] = None
+    preview_url: Optional[str] = None
+    page_count: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -185,14 +500,168 @@ class Notification(NotificationBase):
     id: str
     created_at: datetime
     is_read: bool = False
+    count: int = 1
 
     class Config:
         from_attributes = True
 
+class UploadSessionCreate(BaseModel):
+    file_name: str
+    size: int
+    kind: Optional[str] = None  # 'video', 'document', 'image' or 'file'
+
+class UploadSession(BaseModel):
+    id: str
+    file_name: str
+    kind: str
+    size: int
+    offset: int
+    status: str
+    expires_at: datetime
+
+class UploadSessionComplete(BaseModel):
+    target: str  # 'course_video' or 'material'
+    course_id: str
+    title: Optional[str] = None
+    description: Optional[str] = None
+    type: Optional[str] = None
+
+class PresignedUploadCreate(BaseModel):
+    file_name: str
+    size: int
+    sha256: str
+    kind: Optional[str] = None
+
+class PresignedUpload(BaseModel):
+    key: str
+    file_url: str
+    already_stored: bool
+    upload_url: Optional[str] = None
+    upload_headers: Dict[str, str] = {}
+    expires_in: Optional[int] = None
+
+class PresignedUploadComplete(UploadSessionComplete):
+    file_name: str
+    sha256: str
+
 class DeviceToken(BaseModel):
     device_token: str
     device_type: str  # 'android' or 'ios'
 
+# Index registry: every index the API relies on, per collection. ensure_indexes()
+# creates them at startup; create_index is a no-op when the index already exists.
+INDEX_SPECS = {
+    "users": [
+        {"keys": [("email", ASCENDING)], "unique": True},
+        {"keys": [("role", ASCENDING), ("class_level", ASCENDING)]},
+        {"keys": [("calendar_token", ASCENDING)], "unique": True, "sparse": True},
+    ],
+    "courses": [
+        {"keys": [("grade", ASCENDING), ("_id", DESCENDING)]},
+        {"keys": [("teacher_id", ASCENDING), ("_id", DESCENDING)]},
+        # File URL lookups authorizing presigned downloads
+        {"keys": [("video_url", ASCENDING)]},
+        {"keys": [("thumbnail", ASCENDING)]},
+    ],
+    "enrollments": [
+        {"keys": [("course_id", ASCENDING), ("user_id", ASCENDING)], "unique": True},
+        {"keys": [("user_id", ASCENDING), ("enrolled_at", DESCENDING)]},
+    ],
+    "course_materials": [
+        {"keys": [("course_id", ASCENDING), ("created_at", DESCENDING)]},
+        {"keys": [("file_url", ASCENDING)]},
+        {"keys": [("thumbnail", ASCENDING)]},
+        {"keys": [("preview_url", ASCENDING)]},
+    ],
+    "sessions": [
+        {"keys": [("teacher_id", ASCENDING), ("starts_at", ASCENDING), ("_id", ASCENDING)]},
+        # Overlap checks: only sessions ending after the slot starts are scanned
+        {"keys": [("teacher_id", ASCENDING), ("ends_at", ASCENDING), ("starts_at", ASCENDING)]},
+        {"keys": [("course_id", ASCENDING), ("starts_at", ASCENDING), ("_id", ASCENDING)]},
+        {"keys": [("starts_at", ASCENDING)]},
+    ],
+    "session_reminders": [
+        {"keys": [("created_at", ASCENDING)], "expireAfterSeconds": 60 * 60 * 24 * 7},
+    ],
+    "notifications": [
+        {"keys": [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]},
+        {
+            "keys": [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            "name": "user_id_unread_created_at",
+            "partialFilterExpression": {"is_read": False},
+        },
+        {
+            "keys": [("created_at", ASCENDING)],
+            "name": "unread_created_at",
+            "partialFilterExpression": {"is_read": False},
+        },
+        {
+            "keys": [("read_at", ASCENDING)],
+            "expireAfterSeconds": NOTIFICATION_READ_RETENTION_DAYS * 24 * 60 * 60,
+        },
+        {
+            "keys": [("user_id", ASCENDING), ("coalesce_key", ASCENDING)],
+            "name": "user_id_coalesce_key_unread",
+            "unique": True,
+            "partialFilterExpression": {"is_read": False, "coalesce_key": {"$exists": True}},
+        },
+        {
+            "keys": [("outbox_job", ASCENDING), ("user_id", ASCENDING)],
+            "unique": True,
+            "partialFilterExpression": {"outbox_job": {"$exists": True}},
+        },
+    ],
+    "notification_archive": [
+        {"keys": [("user_id", ASCENDING), ("month", DESCENDING)]},
+        {"keys": [("items.read_at", ASCENDING)]},
+    ],
+    "notification_outbox": [
+        {"keys": [("status", ASCENDING), ("available_at", ASCENDING)]},
+        {"keys": [("status", ASCENDING), ("lease_until", ASCENDING)]},
+        {
+            "keys": [("completed_at", ASCENDING)],
+            "expireAfterSeconds": OUTBOX_RETENTION_SECONDS,
+            "partialFilterExpression": {"status": "done"},
+        },
+        {
+            "keys": [("failed_at", ASCENDING)],
+            "expireAfterSeconds": OUTBOX_FAILED_RETENTION_SECONDS,
+            "partialFilterExpression": {"status": "failed"},
+        },
+    ],
+    "topic_pushes": [
+        {"keys": [("sent_at", ASCENDING)], "expireAfterSeconds": OUTBOX_RETENTION_SECONDS},
+    ],
+    "stored_files": [
+        {"keys": [("ref_count", ASCENDING)]},
+    ],
+    "upload_sessions": [
+        {"keys": [("status", ASCENDING), ("expires_at", ASCENDING)]},
+    ],
+    "device_tokens": [
+        {"keys": [("user_id", ASCENDING), ("device_token", ASCENDING)], "unique": True},
+        {"keys": [("device_token", ASCENDING)]},
+    ],
+}
+
+# Representative query shapes checked by INDEX_DIAGNOSTICS:
+# (collection, filter, sort)
+DIAGNOSTIC_QUERIES = [
+    ("users", {"email": "user@example.com"}, None),
+    ("users", {"role": "student", "class_level": "6"}, None),
+    ("courses", {"grade": "6"}, [("_id", DESCENDING)]),
+    ("courses", {"teacher_id": "000000000000000000000000"}, [("_id", DESCENDING)]),
+    ("enrollments", {"course_id": "000000000000000000000000", "user_id": "000000000000000000000000"}, None),
+    ("enrollments", {"user_id": "000000000000000000000000"}, None),
+    ("course_materials", {"course_id": "000000000000000000000000"}, [("created_at", DESCENDING)]),
+    ("sessions", {"starts_at": {"$gte": datetime(2000, 1, 1)}, "teacher_id": "000000000000000000000000"}, [("starts_at", ASCENDING), ("_id", ASCENDING)]),
+    ("sessions", {"starts_at": {"$gte": datetime(2000, 1, 1)}, "course_id": {"$in": ["000000000000000000000000"]}}, [("starts_at", ASCENDING), ("_id", ASCENDING)]),
+    ("notifications", {"user_id": "000000000000000000000000"}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("notifications", {"user_id": "000000000000000000000000", "is_read": False}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("device_tokens", {"user_id": "000000000000000000000000"}, None),
+    ("device_tokens", {"device_token": "token"}, None),
+]
+
 # Initialize Firebase Admin SDK if available
 firebase_enabled = False
 if firebase_available:
@@ -204,6 +673,30 @@ if firebase_available:
         logger.error(f"Firebase initialization error: {str(e)}")
         firebase_enabled = False
 
+# Authenticated user cache, keyed by the token subject (email). Entries expire
+# after USER_CACHE_TTL_SECONDS and the least recently used ones are evicted once
+# USER_CACHE_MAX_SIZE is reached. Each worker keeps its own cache, so the TTL
+# also bounds how stale a user can be on workers that did not handle a write.
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+user_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def invalidate_cached_user(email: str):
+    if user_cache.pop(email, None) is not None:
+        user_cache_stats["invalidations"] += 1
+
+async def get_cached_user(email: str):
+    user = user_cache.get(email)
+    if user is not None:
+        user_cache_stats["hits"] += 1
+    else:
+        user_cache_stats["misses"] += 1
+        user = await get_user(email)
+        if user is None:
+            return None
+        user_cache[email] = user
+    # Routes mutate the user they receive, so hand out a copy
+    return dict(user)
+
 # Helper functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -211,6 +704,436 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def run_password_job(func, *args):
+    global password_jobs_pending
+    if password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    password_jobs_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, func, *args)
+    finally:
+        password_jobs_pending -= 1
+
+# Storage backends
+class LocalStorageBackend:
+    """Files in UPLOAD_DIR, served by the /uploads route.
+
+    Presigned uploads are PUTs to /storage/local/{key} carrying a signed
+    token, so clients use the same flow as with S3.
+    """
+
+    name = "local"
+
+    def file_url(self, key: str) -> str:
+        return f"/uploads/{key}"
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(UPLOAD_DIR, key)
+
+    async def put_file(self, local_path: str, key: str):
+        os.replace(local_path, self.local_path(key))
+
+    async def exists(self, key: str) -> bool:
+        return os.path.exists(self.local_path(key))
+
+    async def size(self, key: str) -> int:
+        return os.path.getsize(self.local_path(key))
+
+    async def fetch_local(self, key: str) -> tuple:
+        # Returns a local path for the file and whether it is a temp copy
+        return self.local_path(key), False
+
+    async def delete(self, key: str):
+        if os.path.exists(self.local_path(key)):
+            os.remove(self.local_path(key))
+
+    def presign_put(self, key: str, size: int, sha256: str, content_type: str) -> tuple:
+        token = jwt.encode(
+            {
+                "purpose": "storage_put",
+                "key": key,
+                "size": size,
+                "sha256": sha256,
+                "exp": datetime.utcnow() + timedelta(seconds=PRESIGNED_URL_EXPIRE_SECONDS),
+            },
+            SECRET_KEY,
+            algorithm=ALGORITHM
+        )
+        return f"/storage/local/{key}?token={token}", {"Content-Type": content_type}
+
+    def presign_get(self, key: str) -> str:
+        # Local uploads are public and immutable
+        return self.file_url(key)
+
+class S3StorageBackend:
+    """Objects in an S3-compatible bucket; clients read and write them directly.
+
+    boto3 is synchronous, so its network calls run in the default executor.
+    """
+
+    name = "s3"
+
+    def __init__(self):
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            aws_access_key_id=S3_ACCESS_KEY_ID,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"}),
+        )
+        self.public_url = (S3_PUBLIC_URL or f"{S3_ENDPOINT_URL or 'https://s3.amazonaws.com'}/{S3_BUCKET}").rstrip("/")
+
+    async def _run(self, func, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: func(**kwargs))
+
+    def file_url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+    async def put_file(self, local_path: str, key: str):
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        await self._run(
+            self.client.upload_file,
+            Filename=local_path,
+            Bucket=S3_BUCKET,
+            Key=key,
+            ExtraArgs={"ContentType": content_type, "CacheControl": MEDIA_CACHE_CONTROL},
+        )
+        os.remove(local_path)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await self._run(self.client.head_object, Bucket=S3_BUCKET, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def size(self, key: str) -> int:
+        head = await self._run(self.client.head_object, Bucket=S3_BUCKET, Key=key)
+        return head["ContentLength"]
+
+    async def fetch_local(self, key: str) -> tuple:
+        temp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+        await self._run(self.client.download_file, Bucket=S3_BUCKET, Key=key, Filename=temp_path)
+        return temp_path, True
+
+    async def delete(self, key: str):
+        await self._run(self.client.delete_object, Bucket=S3_BUCKET, Key=key)
+
+    def presign_put(self, key: str, size: int, sha256: str, content_type: str) -> tuple:
+        # Signing the checksum makes the store reject bodies that don't match
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": S3_BUCKET,
+                "Key": key,
+                "ContentType": content_type,
+                "ContentLength": size,
+                "ChecksumSHA256": checksum,
+                "CacheControl": MEDIA_CACHE_CONTROL,
+            },
+            ExpiresIn=PRESIGNED_URL_EXPIRE_SECONDS
+        )
+        return url, {
+            "Content-Type": content_type,
+            "x-amz-checksum-sha256": checksum,
+            "Cache-Control": MEDIA_CACHE_CONTROL,
+        }
+
+    def presign_get(self, key: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": key},
+            ExpiresIn=PRESIGNED_URL_EXPIRE_SECONDS
+        )
+
+def create_storage_backend():
+    if STORAGE_BACKEND == "s3":
+        if not boto3_available:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 to be installed")
+        return S3StorageBackend()
+    return LocalStorageBackend()
+
+storage = create_storage_backend()
+
+def storage_key(file_url: str) -> str:
+    return file_url.rsplit("/", 1)[-1]
+
+# Content-addressed storage: uploads are stored once per SHA-256 under the
+# key <sha256>.<ext>, with a reference count in stored_files. Files uploaded
+# before this scheme keep their uuid names and are not counted.
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+def content_addressed_key(sha256: str, file_ext: str) -> str:
+    return f"{sha256}.{file_ext}" if file_ext else sha256
+
+async def add_file_reference(sha256: str, key: str, size: int) -> dict:
+    return await db.stored_files.find_one_and_update(
+        {"_id": sha256},
+        {
+            "$inc": {"ref_count": 1},
+            "$setOnInsert": {
+                "key": key,
+                "file_url": storage.file_url(key),
+                "size": size,
+                "created_at": datetime.utcnow(),
+            },
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+async def store_file(temp_path: str, sha256: str, file_ext: str, size: int) -> str:
+    """Move a finished temp file into storage and return its file_url.
+
+    If the same content is already stored, the temp file is dropped and the
+    existing file gains a reference instead.
+    """
+    stored = await add_file_reference(sha256, content_addressed_key(sha256, file_ext), size)
+    key = storage_key(stored["file_url"])
+    if await storage.exists(key):
+        os.remove(temp_path)
+    else:
+        await storage.put_file(temp_path, key)
+    return stored["file_url"]
+
+async def release_file(file_url: Optional[str]):
+    """Drop one reference to a stored file, deleting it with the last one."""
+    if not file_url:
+        return
+    key = storage_key(file_url)
+    sha256 = Path(key).stem
+
+    if not CONTENT_ADDRESSED_NAME.match(sha256):
+        # Legacy uuid-named upload, owned by exactly one document
+        file_path = file_url.lstrip("/")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        await release_derivatives(file_url)
+        return
+
+    stored = await db.stored_files.find_one_and_update(
+        {"_id": sha256},
+        {"$inc": {"ref_count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if stored is None or stored["ref_count"] > 0:
+        return
+
+    result = await db.stored_files.delete_one({"_id": sha256, "ref_count": {"$lte": 0}})
+    # Re-check in case the same content was stored again meanwhile
+    if result.deleted_count and not await db.stored_files.find_one({"_id": sha256}, {"_id": 1}):
+        await storage.delete(key)
+        await release_derivatives(sha256)
+
+async def release_derivatives(cache_id: str):
+    # Derivatives are cached per source file (by SHA-256, or URL for legacy
+    # uploads) and hold the only reference to their thumbnail and preview
+    derivative = await db.derivatives.find_one_and_delete({"_id": cache_id})
+    if derivative:
+        for name in ("thumbnail_url", "preview_url"):
+            await release_file(derivative.get(name))
+
+async def replace_course_video(course: dict, video_url: str, fields: dict) -> dict:
+    """Point a course at a new, already referenced video and release the old one.
+
+    The update only applies if the course still has the video it was read
+    with, so two racing replacements can't both release the same old file.
+    The loser releases its own new video instead and gets a 409.
+    """
+    updated_course = await db.courses.find_one_and_update(
+        {"_id": course["_id"], "video_url": course.get("video_url")},
+        {"$set": {**fields, "video_url": video_url, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated_course:
+        await release_file(video_url)
+        raise HTTPException(status_code=409, detail="The course was changed meanwhile, please retry")
+
+    await release_file(course.get("video_url"))
+    await schedule_derivatives("courses", str(course["_id"]), video_url)
+    return updated_course
+
+async def is_file_referenced(file_url: str) -> bool:
+    sha256 = Path(storage_key(file_url)).stem
+    if CONTENT_ADDRESSED_NAME.match(sha256):
+        return await db.stored_files.find_one({"_id": sha256, "ref_count": {"$gt": 0}}, {"_id": 1}) is not None
+    return (
+        await db.courses.find_one({"video_url": file_url}, {"_id": 1}) is not None
+        or await db.course_materials.find_one({"file_url": file_url}, {"_id": 1}) is not None
+    )
+
+def get_file_extension(filename: str) -> str:
+    return filename.split(".")[-1] if "." in filename else ""
+
+def get_upload_kind(file_ext: str) -> str:
+    if file_ext.lower() in ["pdf", "doc", "docx"]:
+        return "document"
+    elif file_ext.lower() in ["jpg", "jpeg", "png", "gif"]:
+        return "image"
+    elif file_ext.lower() in ["mp4", "mov", "avi"]:
+        return "video"
+    return "file"
+
+class UploadForm:
+    """A multipart form read by read_upload_form.
+
+    Holds the text fields, plus the file part (if any) as a hashed temp file
+    that store_upload moves into storage. A failed require() or store_upload
+    removes the temp file, so handlers don't leave it behind.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.file = None  # file_name, file_ext, kind, size, sha256, temp_path
+
+    def get(self, name: str) -> Optional[str]:
+        return self.fields.get(name)
+
+    def require(self, name: str, cast=str):
+        value = self.fields.get(name)
+        if value is None:
+            self.discard()
+            raise HTTPException(status_code=422, detail=f"Missing form field '{name}'")
+        try:
+            return cast(value)
+        except ValueError:
+            self.discard()
+            raise HTTPException(status_code=422, detail=f"Invalid value for form field '{name}'")
+
+    def discard(self):
+        if self.file and os.path.exists(self.file["temp_path"]):
+            os.remove(self.file["temp_path"])
+
+async def read_upload_form(request: Request, file_field: str, kind: Optional[str] = None) -> UploadForm:
+    """Parse a multipart form straight from the request stream.
+
+    The file_field part is written to a temp file and hashed as it arrives,
+    and refused with a 413 as soon as it passes the limit for its kind (the
+    given kind, or the one its extension implies). Nothing is spooled first,
+    so an oversized upload costs at most its limit in bytes read.
+    """
+    form = UploadForm()
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data":
+        # No file can be attached, so Starlette's form parsing is fine
+        form.fields = {name: value for name, value in (await request.form()).items() if isinstance(value, str)}
+        return form
+    if not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Missing multipart boundary")
+
+    events = []
+
+    def record(event):
+        def callback(data=b"", start=0, end=0):
+            events.append((event, data[start:end]))
+        return callback
+
+    parser = MultipartParser(params[b"boundary"], {
+        event: record(event)
+        for event in (
+            "on_part_begin", "on_part_data", "on_part_end",
+            "on_header_field", "on_header_value", "on_header_end", "on_headers_finished",
+        )
+    })
+
+    header_field = header_value = disposition = data = b""
+    field_name = file_name = ""
+    buffer = checksum = None
+    max_size = 0
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event, event_data in events:
+                if event == "on_part_begin":
+                    disposition = data = b""
+                elif event == "on_header_field":
+                    header_field += event_data
+                elif event == "on_header_value":
+                    header_value += event_data
+                elif event == "on_header_end":
+                    if header_field.lower() == b"content-disposition":
+                        disposition = header_value
+                    header_field = header_value = b""
+                elif event == "on_headers_finished":
+                    _, options = parse_options_header(disposition)
+                    field_name = options.get(b"name", b"").decode("utf-8", "replace")
+                    file_name = options.get(b"filename", b"").decode("utf-8", "replace")
+                    if file_name and field_name == file_field and form.file is None:
+                        file_ext = get_file_extension(file_name)
+                        form.file = {
+                            "file_name": file_name,
+                            "file_ext": file_ext,
+                            "kind": kind or get_upload_kind(file_ext),
+                            "size": 0,
+                            "temp_path": os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part"),
+                        }
+                        max_size = UPLOAD_SIZE_LIMITS[form.file["kind"]]
+                        checksum = hashlib.sha256()
+                        buffer = await aiofiles.open(form.file["temp_path"], "wb")
+                elif event == "on_part_data":
+                    if buffer is None:
+                        data += event_data
+                        if len(data) > UPLOAD_FORM_FIELD_MAX_BYTES:
+                            raise HTTPException(status_code=413, detail="Form field too large")
+                        continue
+                    form.file["size"] += len(event_data)
+                    if form.file["size"] > max_size:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File too large, the limit for {form.file['kind']} uploads is {max_size // (1024 * 1024)} MB"
+                        )
+                    checksum.update(event_data)
+                    await buffer.write(event_data)
+                elif event == "on_part_end":
+                    if buffer is not None:
+                        await buffer.close()
+                        buffer = None
+                        form.file["sha256"] = checksum.hexdigest()
+                    elif field_name and not file_name:
+                        form.fields[field_name] = data.decode("utf-8", "replace")
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        if buffer is not None:
+            await buffer.close()
+        form.discard()
+        raise
+
+    if form.file and "sha256" not in form.file:
+        # The body ended inside the file part
+        form.discard()
+        raise HTTPException(status_code=400, detail="Incomplete multipart body")
+    return form
+
+async def store_upload(form: UploadForm) -> Optional[dict]:
+    """Move a form's uploaded file into content-addressed storage."""
+    if not form.file:
+        return None
+    upload = form.file
+    try:
+        file_url = await store_file(upload["temp_path"], upload["sha256"], upload["file_ext"], upload["size"])
+    except BaseException:
+        form.discard()
+        raise
+    return {
+        "url": file_url,
+        "file_name": upload["file_name"],
+        "file_ext": upload["file_ext"],
+        "kind": upload["kind"],
+        "size": upload["size"],
+        "sha256": upload["sha256"],
+    }
+
 async def get_user(email: str):
     user = await db.users.find_one({"email": email})
     if user:
@@ -222,7 +1145,7 @@ async def authenticate_user(email: str, password: str):
     user = await get_user(email)
     if not user:
         return False
-    if not verify_password(password, user["password"]):
+    if not await run_password_job(verify_password, password, user["password"]):
         return False
     return user
 
@@ -250,11 +1173,89 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = await get_user(email=token_data.email)
+    user = await get_cached_user(email=token_data.email)
     if user is None:
         raise credentials_exception
     return user
 
+async def require_ops_token(x_ops_token: Optional[str] = Header(None)):
+    # Ops endpoints are for operators, not app users: hide them entirely
+    # unless configured, and compare the token in constant time
+    if not OPS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_ops_token or not secrets.compare_digest(x_ops_token, OPS_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid ops token")
+
+def push_platform_options() -> dict:
+    return dict(
+        android=messaging.AndroidConfig(
+            priority="high",
+            notification=messaging.AndroidNotification(
+                icon="ic_launcher",
+                color="#8852E5",
+                sound="default",
+            ),
+        ),
+        apns=messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(
+                    sound="default",
+                ),
+            ),
+        ),
+    )
+
+def build_multicast_message(
+    device_tokens: List[str],
+    title: str,
+    body: str,
+    data: Optional[Dict[str, str]] = None
+):
+    return messaging.MulticastMessage(
+        tokens=device_tokens,
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=data or {},
+        **push_platform_options()
+    )
+
+def build_topic_message(
+    topic: str,
+    title: str,
+    body: str,
+    data: Optional[Dict[str, str]] = None
+):
+    return messaging.Message(
+        topic=topic,
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=data or {},
+        **push_platform_options()
+    )
+
+def is_invalid_token_error(exception) -> bool:
+    return "invalid-argument" in str(exception) or "not-registered" in str(exception)
+
+def notification_push_data(notification_data: dict) -> Dict[str, str]:
+    data = {}
+    if notification_data.get("action_type"):
+        data["action_type"] = notification_data["action_type"]
+    if notification_data.get("action_id"):
+        data["action_id"] = notification_data["action_id"]
+    return data
+
+async def run_fcm_call(func, *args):
+    async with fcm_semaphore:
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(fcm_executor, func, *args),
+            timeout=FCM_SEND_TIMEOUT_SECONDS
+        )
+
 async def send_push_notification(
     user_id: str,
     title: str,
@@ -276,32 +1277,10 @@ async def send_push_notification(
             return
 
         # Create message
-        message = messaging.MulticastMessage(
-            tokens=device_tokens,
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data=data or {},
-            android=messaging.AndroidConfig(
-                priority="high",
-                notification=messaging.AndroidNotification(
-                    icon="ic_launcher",
-                    color="#8852E5",
-                    sound="default",
-                ),
-            ),
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(
-                        sound="default",
-                    ),
-                ),
-            ),
-        )
+        message = build_multicast_message(device_tokens, title, body, data)
 
         # Send message
-        response = messaging.send_multicast(message)
+        response = await run_fcm_call(messaging.send_multicast, message)
         logger.info(f"Push notification sent to {response.success_count} devices")
 
         # Handle failures
@@ -311,34 +1290,1143 @@ async def send_push_notification(
                     logger.error(f"Failed to send notification to {device_tokens[idx]}: {resp.exception}")
 
                     # Remove invalid tokens
-                    if "invalid-argument" in str(resp.exception) or "not-registered" in str(resp.exception):
+                    if is_invalid_token_error(resp.exception):
                         await db.device_tokens.delete_one({"device_token": device_tokens[idx]})
 
+    except asyncio.TimeoutError:
+        # Raised so the outbox retries the push; the record is already written
+        logger.error(f"Push notification to user {user_id} timed out after {FCM_SEND_TIMEOUT_SECONDS}s")
+        raise
     except Exception as e:
         logger.error(f"Error sending push notification: {str(e)}")
+        raise
+
+# Real-time notification stream
+class NotificationBroker:
+    """In-process pub/sub of notification events, keyed by user ID."""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, set] = {}
+        self.stats = {"published": 0, "delivered": 0, "resyncs": 0}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    def publish(self, user_id: str, event: dict):
+        self.stats["published"] += 1
+        for queue in self.subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait(event)
+                self.stats["delivered"] += 1
+            except asyncio.QueueFull:
+                # Never block the publisher on a slow client: drop its backlog
+                # and tell it to refetch instead
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"event": "resync"})
+                self.stats["resyncs"] += 1
+
+    def connection_count(self) -> int:
+        return sum(len(queues) for queues in self.subscribers.values())
+
+notification_broker = NotificationBroker(NOTIFICATION_STREAM_QUEUE_SIZE)
+
+def notification_event(notification: dict) -> dict:
+    return {
+        "event": "notification",
+        "id": str(notification["_id"]),
+        "data": {
+            "id": str(notification["_id"]),
+            "title": notification["title"],
+            "message": notification["message"],
+            "user_id": notification["user_id"],
+            "image_url": notification.get("image_url"),
+            "action_type": notification.get("action_type"),
+            "action_id": notification.get("action_id"),
+            "created_at": notification["created_at"].isoformat(),
+            "is_read": notification.get("is_read", False),
+            "count": notification.get("count", 1),
+        },
+    }
 
-async def create_notification(notification_data: dict):
-    notification_data["created_at"] = datetime.utcnow()
-    notification_data["is_read"] = False
+def publish_notification(notification: dict):
+    # With a change stream bridge every insert is published from there instead
+    if NOTIFICATION_STREAM_SOURCE == "local":
+        notification_broker.publish(notification["user_id"], notification_event(notification))
 
-    result = await db.notifications.insert_one(notification_data)
-    notification_id = str(result.inserted_id)
+async def watch_notification_inserts():
+    """Bridge notifications inserted by any process into the local broker."""
+    resume_token = None
+    while True:
+        try:
+            # Inserts, plus updates that merged a coalesced notification
+            async with db.notifications.watch(
+                [{"$match": {"$or": [
+                    {"operationType": "insert"},
+                    {"operationType": "update", "updateDescription.updatedFields.count": {"$exists": True}},
+                ]}}],
+                full_document="updateLookup",
+                resume_after=resume_token
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    notification = change.get("fullDocument")
+                    if notification is None:
+                        continue
+                    notification_broker.publish(notification["user_id"], notification_event(notification))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Notification change stream failed, reconnecting: {str(e)}")
+            await asyncio.sleep(5)
+
+# Unread notification counters, one document per user in
+# notification_counters (looked up by _id, so no extra index). Every write
+# that changes a notification's unread state adjusts the counter right after,
+# as a separate write: a crash or failed write in between leaves the counter
+# off until `python worker.py repair-unread-counters` (rebuild_unread_counters)
+# recounts it from the notifications. Run it after an outage or a failed
+# deploy; counters only drift through such partial failures.
+async def adjust_unread_count(user_id: str, delta: int):
+    if delta:
+        await db.notification_counters.update_one(
+            {"_id": user_id},
+            {"$inc": {"unread": delta}},
+            upsert=True
+        )
 
-    # Send push notification
+async def get_unread_count(user_id: str) -> int:
+    counter = await db.notification_counters.find_one({"_id": user_id})
+    return max(counter["unread"], 0) if counter else 0
+
+async def rebuild_unread_counters() -> dict:
+    """Recount unread notifications per user and overwrite the counters."""
+    rebuilt_at = datetime.utcnow()
+    unread_counts = {}
+    async for row in db.notifications.aggregate([
+        {"$match": {"is_read": False}},
+        {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}},
+    ]):
+        unread_counts[row["_id"]] = row["unread"]
+    async for row in db.notification_archive.aggregate([
+        {"$match": {"items.is_read": False}},
+        {"$unwind": "$items"},
+        {"$match": {"items.is_read": False}},
+        {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}},
+    ]):
+        unread_counts[row["_id"]] = unread_counts.get(row["_id"], 0) + row["unread"]
+
+    users = len(unread_counts)
+    operations = [
+        UpdateOne(
+            {"_id": user_id},
+            {"$set": {"unread": unread, "rebuilt_at": rebuilt_at}},
+            upsert=True
+        )
+        for user_id, unread in unread_counts.items()
+    ]
+    for start in range(0, len(operations), NOTIFICATION_INSERT_CHUNK_SIZE):
+        await db.notification_counters.bulk_write(
+            operations[start:start + NOTIFICATION_INSERT_CHUNK_SIZE],
+            ordered=False
+        )
+
+    # Users not seen above have no unread notifications left
+    result = await db.notification_counters.update_many(
+        {"rebuilt_at": {"$ne": rebuilt_at}},
+        {"$set": {"unread": 0, "rebuilt_at": rebuilt_at}}
+    )
+    report = {"users_with_unread": users, "reset_to_zero": result.modified_count}
+    logger.info(f"Rebuilt unread notification counters: {report}")
+    return report
+
+# Notification archive. Buckets hold compact copies of old unread
+# notifications (same _id) so listings, mark-read and delete work on both stores.
+def archived_notification_item(notification: dict) -> dict:
+    return {
+        "_id": notification["_id"],
+        "title": notification["title"],
+        "message": notification["message"],
+        "image_url": notification.get("image_url"),
+        "action_type": notification.get("action_type"),
+        "action_id": notification.get("action_id"),
+        "created_at": notification["created_at"],
+        "is_read": False,
+        "count": notification.get("count", 1),
+    }
+
+async def archive_old_notifications() -> dict:
+    """Move old unread notifications into monthly buckets and drop expired read ones."""
+    now = datetime.utcnow()
+    archive_cutoff = now - timedelta(days=NOTIFICATION_ARCHIVE_AFTER_DAYS)
+    read_cutoff = now - timedelta(days=NOTIFICATION_READ_RETENTION_DAYS)
+    report = {"archived": 0, "buckets": 0, "expired_buckets": 0}
+
+    while True:
+        batch = await db.notifications.find(
+            {"is_read": False, "created_at": {"$lt": archive_cutoff}}
+        ).sort("created_at", ASCENDING).limit(NOTIFICATION_ARCHIVE_BATCH_SIZE).to_list(None)
+        if not batch:
+            break
+
+        buckets = {}
+        for notification in batch:
+            month = notification["created_at"].strftime("%Y-%m")
+            buckets.setdefault((notification["user_id"], month), []).append(
+                archived_notification_item(notification)
+            )
+        # $addToSet keeps a retried batch from duplicating items
+        await db.notification_archive.bulk_write([
+            UpdateOne(
+                {"_id": f"{user_id}:{month}"},
+                {
+                    "$setOnInsert": {"user_id": user_id, "month": month},
+                    "$addToSet": {"items": {"$each": items}},
+                },
+                upsert=True
+            )
+            for (user_id, month), items in buckets.items()
+        ], ordered=False)
+        report["buckets"] += len(buckets)
+
+        ids = [notification["_id"] for notification in batch]
+        result = await db.notifications.delete_many({"_id": {"$in": ids}, "is_read": False})
+        report["archived"] += result.deleted_count
+        if result.deleted_count < len(ids):
+            # Some were read meanwhile; they stay in the live store only
+            remaining = await db.notifications.distinct("_id", {"_id": {"$in": ids}})
+            await db.notification_archive.update_many(
+                {"items._id": {"$in": remaining}},
+                {"$pull": {"items": {"_id": {"$in": remaining}}}}
+            )
+
+    # Archived notifications read long enough ago expire like live ones
+    await db.notification_archive.update_many(
+        {"items.read_at": {"$lt": read_cutoff}},
+        {"$pull": {"items": {"read_at": {"$lt": read_cutoff}}}}
+    )
+    result = await db.notification_archive.delete_many({"items": {"$size": 0}})
+    report["expired_buckets"] = result.deleted_count
+    logger.info(f"Notification archival: {report}")
+    return report
+
+async def find_archived_notification(user_id: str, notification_id: ObjectId) -> Optional[dict]:
+    bucket = await db.notification_archive.find_one(
+        {"user_id": user_id, "items._id": notification_id},
+        {"items": {"$elemMatch": {"_id": notification_id}}}
+    )
+    if not bucket:
+        return None
+    return {**bucket["items"][0], "user_id": user_id}
+
+async def find_archived_notifications(user_id: str, query: dict, limit: int) -> List[dict]:
+    notifications = []
+    async for item in db.notification_archive.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$unwind": "$items"},
+        {"$replaceRoot": {"newRoot": "$items"}},
+        {"$match": query},
+        {"$sort": {"created_at": DESCENDING, "_id": DESCENDING}},
+        {"$limit": limit},
+    ]):
+        item["user_id"] = user_id
+        notifications.append(item)
+    return notifications
+
+# Notification coalescing
+def notification_coalesce_key(notification: dict) -> Optional[str]:
+    # coalesce_id lets a burst of distinct actions merge, e.g. several
+    # materials added to one course. Titles are fixed per event kind, so only
+    # repeats of the same event merge: an update and an enrollment on one
+    # course stay separate notifications
+    coalesce_id = notification.get("coalesce_id") or notification.get("action_id")
+    if NOTIFICATION_COALESCE_SECONDS <= 0 or not notification.get("action_type") or not coalesce_id:
+        return None
+    return f"{notification['action_type']}:{notification['title']}:{coalesce_id}"
+
+def coalescing_update(notification: dict, user_id: str, coalesce_key: str, now: datetime) -> dict:
+    # Upsert into the user's recent unread notification; the latest content
+    # and action win, created_at stays at the first one
+    latest_fields = ("title", "message", "image_url", "action_id")
+    return {
+        "$setOnInsert": {
+            **{key: value for key, value in notification.items() if key not in latest_fields},
+            "user_id": user_id,
+            "coalesce_key": coalesce_key,
+            "created_at": now,
+            "is_read": False,
+        },
+        "$set": {
+            **{key: notification.get(key) for key in latest_fields},
+            "updated_at": now,
+        },
+        "$inc": {"count": 1},
+    }
+
+def duplicate_key_indexes(error: BulkWriteError) -> set:
+    # Positions of the operations that hit a unique index; any other write
+    # error is re-raised
+    details = error.details
+    if details.get("writeConcernErrors") or any(item["code"] != 11000 for item in details.get("writeErrors", [])):
+        raise error
+    return {item["index"] for item in details.get("writeErrors", [])}
+
+async def coalesce_notifications(
+    user_ids: List[str],
+    notification: dict,
+    coalesce_key: str,
+    now: datetime,
+    job_id: Optional[str] = None
+) -> List[str]:
+    """Merge a notification into each user's recent unread one with the same key.
+
+    Returns the users that got a new record instead. The window slides from
+    the existing record's created_at, so a burst merges however it falls on
+    the clock. The unique index on unread (user_id, coalesce_key) makes
+    concurrent writers converge on one record: an insert that loses the race
+    fails with a duplicate key and is retried as a merge, and a record that
+    has aged out of the window gives up its key so the retry starts a new one.
+    Records remember the outbox jobs merged into them, so a retried job does
+    not count twice.
+    """
+    window_start = now - timedelta(seconds=NOTIFICATION_COALESCE_SECONDS)
+    new_user_ids = []
+    pending = list(user_ids)
+    for _ in range(NOTIFICATION_COALESCE_ATTEMPTS):
+        operations = []
+        for user_id in pending:
+            query = {
+                "user_id": user_id,
+                "coalesce_key": coalesce_key,
+                "is_read": False,
+                "created_at": {"$gt": window_start},
+            }
+            update = coalescing_update(notification, user_id, coalesce_key, now)
+            if job_id:
+                query["outbox_jobs"] = {"$ne": job_id}
+                update["$setOnInsert"]["outbox_job"] = job_id
+                update["$push"] = {"outbox_jobs": {"$each": [job_id], "$slice": -NOTIFICATION_COALESCE_JOBS_KEPT}}
+            operations.append(UpdateOne(query, update, upsert=True))
+        try:
+            result = await db.notifications.bulk_write(operations, ordered=False)
+            upserted, conflicts = result.upserted_ids, set()
+        except BulkWriteError as e:
+            conflicts = duplicate_key_indexes(e)
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+        new_user_ids += [pending[index] for index in upserted]
+        pending = [pending[index] for index in sorted(conflicts)]
+        if pending and job_id:
+            # An earlier attempt of this job already wrote these
+            applied = set(await db.notifications.distinct(
+                "user_id",
+                {"user_id": {"$in": pending}, "$or": [{"outbox_job": job_id}, {"outbox_jobs": job_id}]}
+            ))
+            pending = [user_id for user_id in pending if user_id not in applied]
+        if not pending:
+            return new_user_ids
+        await db.notifications.update_many(
+            {
+                "user_id": {"$in": pending},
+                "coalesce_key": coalesce_key,
+                "is_read": False,
+                "created_at": {"$lte": window_start},
+            },
+            {"$unset": {"coalesce_key": ""}}
+        )
+    raise RuntimeError(f"Could not coalesce notification {coalesce_key} for {len(pending)} users")
+
+async def write_notifications(
+    user_ids: List[str],
+    notification: dict,
+    now: datetime,
+    job_id: Optional[str] = None
+) -> tuple:
+    """Write a notification record for each user, coalescing where it applies.
+
+    Returns the records written or merged into, and the users that got a new
+    record in this call (only those count as unread again). Records written
+    by an outbox job carry its id, unique per user, so a retried job finds
+    the records of its earlier attempts instead of inserting them again.
+    """
+    coalesce_key = notification_coalesce_key(notification)
+    if not coalesce_key:
+        documents = [
+            {**notification, "user_id": user_id, "created_at": now, "is_read": False}
+            for user_id in user_ids
+        ]
+        if job_id:
+            for document in documents:
+                document["outbox_job"] = job_id
+        try:
+            await db.notifications.insert_many(documents, ordered=False)
+            return documents, list(user_ids)
+        except BulkWriteError as e:
+            written = duplicate_key_indexes(e)
+        if not job_id:
+            raise RuntimeError(f"Unexpected duplicate notification records for {len(written)} users")
+        existing = await db.notifications.find(
+            {"outbox_job": job_id, "user_id": {"$in": [user_ids[index] for index in written]}}
+        ).to_list(None)
+        new_documents = [document for index, document in enumerate(documents) if index not in written]
+        return new_documents + existing, [document["user_id"] for document in new_documents]
+
+    new_user_ids = await coalesce_notifications(user_ids, notification, coalesce_key, now, job_id)
+    documents = await db.notifications.find(
+        {"user_id": {"$in": user_ids}, "coalesce_key": coalesce_key, "is_read": False}
+    ).to_list(None)
+    return documents, new_user_ids
+
+async def get_push_user_ids(user_ids: List[str], new_user_ids: List[str], job_id: Optional[str]) -> List[str]:
+    # Push for the records this job created and has not pushed yet, so a
+    # retry after a crash between write and push still pushes, once
+    if not job_id:
+        return list(new_user_ids)
+    return await db.notifications.distinct(
+        "user_id",
+        {"outbox_job": job_id, "user_id": {"$in": user_ids}, "pushed_at": {"$exists": False}}
+    )
+
+async def mark_pushed(user_ids: List[str], job_id: Optional[str]):
+    if job_id and user_ids:
+        await db.notifications.update_many(
+            {"outbox_job": job_id, "user_id": {"$in": user_ids}},
+            {"$set": {"pushed_at": datetime.utcnow()}}
+        )
+
+async def deliver_notification(notification_data: dict, job_id: Optional[str] = None):
     user_id = notification_data["user_id"]
+    documents, new_user_ids = await write_notifications([user_id], notification_data, datetime.utcnow(), job_id)
+    for document in documents:
+        publish_notification(document)
+    notification_id = str(documents[0]["_id"]) if documents else None
+
+    if new_user_ids:
+        await adjust_unread_count(user_id, 1)
+    if not await get_push_user_ids([user_id], new_user_ids, job_id):
+        # Merged into a recent notification, which was already pushed
+        return notification_id
+
+    # Send push notification
     title = notification_data["title"]
     message = notification_data["message"]
 
-    data = {}
-    if "action_type" in notification_data:
-        data["action_type"] = notification_data["action_type"]
-    if "action_id" in notification_data:
-        data["action_id"] = notification_data["action_id"]
+    data = notification_push_data(notification_data)
 
     await send_push_notification(user_id, title, message, data)
+    await mark_pushed([user_id], job_id)
 
     return notification_id
 
+async def fan_out_notifications(
+    user_ids: List[str],
+    notification: dict,
+    push: bool = True,
+    job_id: Optional[str] = None
+) -> dict:
+    """Deliver the same notification to many users.
+
+    Writes the notification records in chunks (bulk inserts, or bulk upserts
+    when coalescing). With push, every new recipient's device tokens are
+    resolved in one $in query and pushed in multicast batches; fan-outs that
+    reach their recipients through a topic send skip this. Returns a summary
+    with per-batch latency and failures; if a batch failed, raises once the
+    rest is done, so the outbox retries the push for its recipients.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    summary = {"recipients": len(user_ids), "inserted": 0, "coalesced": 0, "tokens": 0, "batches": []}
+    if not user_ids:
+        return summary
+
+    created_at = datetime.utcnow()
+    push_user_ids = []
+    for start in range(0, len(user_ids), NOTIFICATION_INSERT_CHUNK_SIZE):
+        chunk = user_ids[start:start + NOTIFICATION_INSERT_CHUNK_SIZE]
+        # Only recipients without a recent unread notification get a new one
+        documents, new_user_ids = await write_notifications(chunk, notification, created_at, job_id)
+        summary["inserted"] += len(new_user_ids)
+        summary["coalesced"] += len(chunk) - len(new_user_ids)
+        push_user_ids += await get_push_user_ids(chunk, new_user_ids, job_id)
+        if new_user_ids:
+            await db.notification_counters.bulk_write(
+                [UpdateOne({"_id": user_id}, {"$inc": {"unread": 1}}, upsert=True) for user_id in new_user_ids],
+                ordered=False
+            )
+        for document in documents:
+            publish_notification(document)
+
+    if not push or not push_user_ids:
+        return summary
+    if not firebase_enabled:
+        logger.warning("Firebase is not initialized, skipping push notifications for fan-out")
+        return summary
+
+    token_users = {}
+    async for token_doc in db.device_tokens.find({"user_id": {"$in": push_user_ids}}, {"device_token": 1, "user_id": 1}):
+        token_users.setdefault(token_doc["device_token"], set()).add(token_doc["user_id"])
+    device_tokens = list(token_users)
+    summary["tokens"] = len(device_tokens)
+
+    data = notification_push_data(notification)
+    invalid_tokens = []
+    failed_tokens = []
+
+    async def send_batch(batch: List[str]) -> dict:
+        batch_summary = {"size": len(batch), "success": 0, "failure": 0}
+        started = time.perf_counter()
+        try:
+            response = await run_fcm_call(
+                messaging.send_multicast,
+                build_multicast_message(batch, notification["title"], notification["message"], data)
+            )
+            batch_summary["success"] = response.success_count
+            batch_summary["failure"] = response.failure_count
+            for idx, resp in enumerate(response.responses):
+                if not resp.success and is_invalid_token_error(resp.exception):
+                    invalid_tokens.append(batch[idx])
+        except asyncio.TimeoutError:
+            batch_summary["failure"] = len(batch)
+            batch_summary["error"] = f"timed out after {FCM_SEND_TIMEOUT_SECONDS}s"
+            failed_tokens.extend(batch)
+        except Exception as e:
+            batch_summary["failure"] = len(batch)
+            batch_summary["error"] = str(e)
+            failed_tokens.extend(batch)
+        batch_summary["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return batch_summary
+
+    # Batches go out concurrently, bounded by the FCM semaphore
+    summary["batches"] = await asyncio.gather(*[
+        send_batch(device_tokens[start:start + FCM_MULTICAST_BATCH_SIZE])
+        for start in range(0, len(device_tokens), FCM_MULTICAST_BATCH_SIZE)
+    ])
+
+    if invalid_tokens:
+        await db.device_tokens.delete_many({"device_token": {"$in": invalid_tokens}})
+    # Recipients with a token in a failed batch stay unpushed, and the job is
+    # failed so the outbox retries just them (possibly re-pushing their other
+    # devices)
+    unpushed = {user_id for token in failed_tokens for user_id in token_users[token]}
+    await mark_pushed([user_id for user_id in push_user_ids if user_id not in unpushed], job_id)
+
+    logger.info(
+        f"Fan-out '{notification['title']}': {summary['inserted']} notifications, "
+        f"{summary['tokens']} tokens, {len(invalid_tokens)} invalid tokens removed, "
+        f"batches={summary['batches']}"
+    )
+    if unpushed:
+        raise RuntimeError(f"Push failed for {len(unpushed)} of {len(push_user_ids)} recipients")
+    return summary
+
+async def send_topic_push(topic: str, notification: dict, job_id: Optional[str] = None):
+    """Push a fan-out's notification to its topic with a single FCM send.
+
+    topic_pushes holds a claim per outbox job, so a retried job doesn't send
+    again, and one per (topic, coalesce key): a burst of coalescable
+    notifications to the same topic is pushed once per
+    NOTIFICATION_COALESCE_SECONDS, like the per-user records it accompanies.
+    The window is anchored on the topic's last send rather than on each
+    user's record, so a user whose record is new can still miss a push that
+    was coalesced away. A failed send releases its claims for the retry.
+    """
+    if not firebase_enabled:
+        logger.warning(f"Firebase is not initialized, skipping push to topic {topic}")
+        return
+    now = datetime.utcnow()
+    claims = []
+    if job_id:
+        try:
+            await db.topic_pushes.insert_one({"_id": f"job:{job_id}", "sent_at": now})
+        except DuplicateKeyError:
+            logger.info(f"Topic push of outbox job {job_id} was already sent")
+            return
+        claims.append(f"job:{job_id}")
+    coalesce_key = notification_coalesce_key(notification)
+    if coalesce_key:
+        try:
+            await db.topic_pushes.update_one(
+                {
+                    "_id": f"{topic}:{coalesce_key}",
+                    "sent_at": {"$lte": now - timedelta(seconds=NOTIFICATION_COALESCE_SECONDS)},
+                },
+                {"$set": {"sent_at": now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            logger.info(f"Coalesced push to topic {topic} for {coalesce_key}")
+            return
+        claims.append(f"{topic}:{coalesce_key}")
+
+    started = time.perf_counter()
+    try:
+        await run_fcm_call(
+            messaging.send,
+            build_topic_message(topic, notification["title"], notification["message"], notification_push_data(notification))
+        )
+    except Exception:
+        await db.topic_pushes.delete_many({"_id": {"$in": claims}})
+        raise
+    logger.info(
+        f"Pushed '{notification['title']}' to topic {topic} "
+        f"in {round((time.perf_counter() - started) * 1000, 1)}ms"
+    )
+
+# FCM topics. Students' devices are subscribed to a topic per enrolled course
+# and one for their grade, so course-wide pushes are one send per event
+def course_topic(course_id: str) -> str:
+    return f"course-{course_id}"
+
+def grade_topic(grade: str) -> str:
+    return "grade-" + re.sub(r"[^a-zA-Z0-9\-_.~%]", "_", str(grade))
+
+async def get_user_topics(user_id: str) -> List[str]:
+    topics = [course_topic(course_id) for course_id in await get_enrolled_course_ids(user_id)]
+    user = await db.users.find_one({"_id": ObjectId(user_id)}, {"role": 1, "class_level": 1})
+    if user and user.get("role") == "student" and user.get("class_level"):
+        topics.append(grade_topic(user["class_level"]))
+    return topics
+
+async def update_topic_subscriptions(user_ids: List[str], topics: List[str], subscribe: bool = True) -> dict:
+    summary = {"tokens": 0, "topics": len(topics), "failures": 0}
+    if not firebase_enabled or not user_ids or not topics:
+        return summary
+
+    device_tokens = await db.device_tokens.distinct("device_token", {"user_id": {"$in": user_ids}})
+    summary["tokens"] = len(device_tokens)
+    func = messaging.subscribe_to_topic if subscribe else messaging.unsubscribe_from_topic
+    invalid_tokens = []
+    for topic in topics:
+        for start in range(0, len(device_tokens), FCM_TOPIC_BATCH_SIZE):
+            batch = device_tokens[start:start + FCM_TOPIC_BATCH_SIZE]
+            response = await run_fcm_call(func, batch, topic)
+            summary["failures"] += response.failure_count
+            for error in response.errors:
+                if is_invalid_token_error(error.reason):
+                    invalid_tokens.append(batch[error.index])
+
+    if invalid_tokens:
+        await db.device_tokens.delete_many({"device_token": {"$in": invalid_tokens}})
+    return summary
+
+async def enqueue_topic_subscriptions(user_ids: List[str], topics: List[str], subscribe: bool = True):
+    if user_ids and topics:
+        await enqueue_outbox_jobs("topic_subscriptions", [
+            {"user_ids": user_ids, "topics": topics, "subscribe": subscribe}
+        ])
+
+def plan_has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(plan_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(plan_has_collscan(value) for value in plan)
+    return False
+
+async def report_collscans():
+    for collection, query, sort in DIAGNOSTIC_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explanation = await cursor.explain()
+        except Exception as e:
+            logger.error(f"Explain failed for {collection} {query}: {str(e)}")
+            continue
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        if plan_has_collscan(winning_plan):
+            logger.warning(f"COLLSCAN on {collection}: filter={query} sort={sort}")
+        else:
+            logger.info(f"Index used on {collection}: filter={query} sort={sort}")
+
+@app.on_event("startup")
+async def ensure_indexes():
+    for collection, specs in INDEX_SPECS.items():
+        for spec in specs:
+            options = {key: value for key, value in spec.items() if key != "keys"}
+            try:
+                name = await db[collection].create_index(spec["keys"], **options)
+                logger.info(f"Ensured index {collection}.{name}")
+            except Exception as e:
+                # Keep starting up: a conflicting or failing index (e.g. duplicate
+                # emails blocking a unique index) shouldn't take the API down
+                logger.error(f"Failed to create index on {collection} {spec['keys']}: {str(e)}")
+
+    if INDEX_DIAGNOSTICS:
+        await report_collscans()
+
+# Notification outbox
+async def enqueue_outbox_jobs(kind: str, payloads: List[dict], key: Optional[str] = None):
+    # With a key the jobs get deterministic IDs, so enqueueing the same work
+    # again (e.g. a retried reminder) is a no-op for jobs already queued
+    if not payloads:
+        return
+    now = datetime.utcnow()
+    jobs = [
+        {
+            "kind": kind,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now,
+        }
+        for payload in payloads
+    ]
+    if key:
+        for index, job in enumerate(jobs):
+            job["_id"] = f"{key}:{kind}:{index}"
+    try:
+        await db.notification_outbox.insert_many(jobs, ordered=False)
+    except BulkWriteError as e:
+        if not key:
+            raise
+        skipped = duplicate_key_indexes(e)
+        logger.info(f"Skipped {len(skipped)} {kind} jobs already queued for {key}")
+
+async def create_notification(notification_data: dict, key: Optional[str] = None):
+    await enqueue_outbox_jobs("notification", [notification_data], key)
+
+async def enqueue_fan_out(
+    user_ids: List[str],
+    notification: dict,
+    topic: Optional[str] = None,
+    key: Optional[str] = None
+):
+    # With a topic, one topic send covers every recipient: the chunk jobs only
+    # write records and a separate job does the push
+    user_ids = list(dict.fromkeys(user_ids))
+    payloads = [
+        {"user_ids": user_ids[start:start + OUTBOX_FAN_OUT_CHUNK_SIZE], "notification": notification, "push": not topic}
+        for start in range(0, len(user_ids), OUTBOX_FAN_OUT_CHUNK_SIZE)
+    ]
+    await enqueue_outbox_jobs("fan_out", payloads, key)
+    if topic and payloads:
+        await enqueue_outbox_jobs("topic_push", [{"topic": topic, "notification": notification}], key)
+
+# Handlers get the job id so notification records can be keyed by it; a job
+# whose lease ran out mid-run is picked up again and must not write twice
+OUTBOX_HANDLERS = {
+    "notification": lambda payload, job_id: deliver_notification(payload, job_id),
+    "fan_out": lambda payload, job_id: fan_out_notifications(
+        payload["user_ids"], payload["notification"], payload.get("push", True), job_id
+    ),
+    "topic_push": lambda payload, job_id: send_topic_push(payload["topic"], payload["notification"], job_id),
+    "derivatives": lambda payload, job_id: generate_derivatives(payload),
+    "topic_subscriptions": lambda payload, job_id: update_topic_subscriptions(
+        payload["user_ids"], payload["topics"], payload["subscribe"]
+    ),
+}
+
+async def claim_outbox_job(worker_id: str):
+    # A job is claimable when it is due, or when the lease of the worker that
+    # claimed it has run out (that worker crashed or stalled)
+    now = datetime.utcnow()
+    return await db.notification_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"status": "processing", "lease_until": {"$lte": now}},
+        ]},
+        {
+            "$set": {
+                "status": "processing",
+                "worker_id": worker_id,
+                "lease_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("available_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_outbox_lease(job: dict):
+    # Heartbeat for long-running jobs (big fan-outs, derivative renders) so
+    # their lease doesn't run out and hand them to a second worker
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+        try:
+            await db.notification_outbox.update_one(
+                {"_id": job["_id"], "worker_id": job["worker_id"], "status": "processing"},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            logger.error(f"Failed to renew the lease of outbox job {job['_id']}: {str(e)}")
+
+async def process_outbox_job(job: dict):
+    heartbeat = asyncio.create_task(renew_outbox_lease(job))
+    try:
+        await OUTBOX_HANDLERS[job["kind"]](job["payload"], str(job["_id"]))
+    except Exception as e:
+        attempts = job.get("attempts", 1)
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Outbox job {job['_id']} failed permanently after {attempts} attempts: {str(e)}")
+            update = {"status": "failed", "last_error": str(e), "failed_at": datetime.utcnow()}
+        else:
+            backoff = min(OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX_SECONDS)
+            logger.warning(f"Outbox job {job['_id']} failed (attempt {attempts}), retrying in {backoff}s: {str(e)}")
+            update = {
+                "status": "pending",
+                "last_error": str(e),
+                "available_at": datetime.utcnow() + timedelta(seconds=backoff),
+            }
+        await db.notification_outbox.update_one(
+            {"_id": job["_id"], "worker_id": job["worker_id"]},
+            {"$set": update, "$unset": {"lease_until": ""}}
+        )
+        return
+    finally:
+        heartbeat.cancel()
+
+    await db.notification_outbox.update_one(
+        {"_id": job["_id"], "worker_id": job["worker_id"]},
+        {"$set": {"status": "done", "completed_at": datetime.utcnow()}, "$unset": {"lease_until": ""}}
+    )
+
+async def outbox_worker_loop(worker_id: str):
+    while True:
+        try:
+            job = await claim_outbox_job(worker_id)
+        except Exception as e:
+            logger.error(f"Outbox worker {worker_id} failed to claim a job: {str(e)}")
+            job = None
+        if job is None:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL_SECONDS)
+            continue
+        await process_outbox_job(job)
+
+async def run_outbox_worker(concurrency: int = OUTBOX_CONCURRENCY):
+    worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"Starting notification outbox worker {worker_prefix} with concurrency {concurrency}")
+    await asyncio.gather(*[
+        outbox_worker_loop(f"{worker_prefix}-{index}")
+        for index in range(concurrency)
+    ])
+
+async def migrate_course_students_to_enrollments():
+    # Move each course's embedded students array into the enrollments
+    # collection, then drop the array and keep only a student_count
+    migrated = 0
+    async for course in db.courses.find(
+        {"students": {"$exists": True}},
+        {"students": 1}
+    ):
+        course_id = str(course["_id"])
+        student_ids = list(dict.fromkeys(course.get("students") or []))
+        if student_ids:
+            await db.enrollments.bulk_write([
+                UpdateOne(
+                    {"course_id": course_id, "user_id": student_id},
+                    {"$setOnInsert": {
+                        "course_id": course_id,
+                        "user_id": student_id,
+                        "enrolled_at": course["_id"].generation_time.replace(tzinfo=None),
+                        "source": "migration",
+                    }},
+                    upsert=True
+                )
+                for student_id in student_ids
+            ], ordered=False)
+        student_count = await db.enrollments.count_documents({"course_id": course_id})
+        await db.courses.update_one(
+            {"_id": course["_id"]},
+            {"$set": {"student_count": student_count}, "$unset": {"students": ""}}
+        )
+        migrated += 1
+    logger.info(f"Moved enrollments of {migrated} courses into the enrollments collection")
+
+async def migrate_uploads_to_content_addressed_storage():
+    # Re-home legacy uuid-named uploads into content-addressed storage so
+    # identical files referenced from several courses or materials are kept once
+    loop = asyncio.get_running_loop()
+    stored_before = 0
+    for collection, field in (("courses", "video_url"), ("course_materials", "file_url")):
+        async for document in db[collection].find({field: {"$regex": "^/uploads/"}}, {field: 1}):
+            file_url = document[field]
+            file_path = file_url.lstrip("/")
+            if CONTENT_ADDRESSED_NAME.match(Path(file_path).stem):
+                continue
+            if not os.path.exists(file_path):
+                logger.warning(f"Referenced upload {file_url} is missing, leaving it as is")
+                continue
+            size = os.path.getsize(file_path)
+            sha256 = await loop.run_in_executor(None, hash_file, file_path, size)
+            stored_before += size
+            # Store a copy and only remove the original once the document
+            # points at it, so a run interrupted here can simply be re-run
+            temp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+            await loop.run_in_executor(None, shutil.copyfile, file_path, temp_path)
+            new_url = await store_file(temp_path, sha256, get_file_extension(file_path), size)
+            await db[collection].update_one({"_id": document["_id"]}, {"$set": {field: new_url}})
+            os.remove(file_path)
+
+    stats = await get_storage_stats()
+    logger.info(
+        f"Moved {stored_before} bytes of uploads into content-addressed storage, "
+        f"now {stats['stored_bytes']} bytes on disk ({stats['saved_bytes']} bytes saved by deduplication)"
+    )
+
+async def backfill_notification_read_at():
+    # Read notifications from before read_at existed expire by age instead
+    result = await db.notifications.update_many(
+        {"is_read": True, "read_at": {"$exists": False}},
+        [{"$set": {"read_at": "$created_at"}}]
+    )
+    logger.info(f"Set read_at on {result.modified_count} read notifications")
+
+async def subscribe_existing_devices_to_topics():
+    # Devices registered before topic sends existed only get topic pushes
+    # once subscribed; queue one subscription job per user
+    user_ids = await db.device_tokens.distinct("user_id")
+    payloads = []
+    for user_id in user_ids:
+        topics = await get_user_topics(user_id)
+        if topics:
+            payloads.append({"user_ids": [user_id], "topics": topics, "subscribe": True})
+    for start in range(0, len(payloads), OUTBOX_FAN_OUT_CHUNK_SIZE):
+        await enqueue_outbox_jobs("topic_subscriptions", payloads[start:start + OUTBOX_FAN_OUT_CHUNK_SIZE])
+    logger.info(f"Queued topic subscriptions for {len(payloads)} users with devices")
+
+async def migrate_session_datetimes():
+    # Fill starts_at/ends_at from the string date, time and duration fields
+    operations = []
+    skipped = 0
+    async for session in db.sessions.find(
+        {"starts_at": {"$exists": False}},
+        {"date": 1, "time": 1, "duration": 1}
+    ):
+        try:
+            starts_at, ends_at = session_bounds(session["date"], session["time"], int(session.get("duration") or 0))
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Session {session['_id']} has an unparseable date/time, leaving it unscheduled")
+            skipped += 1
+            continue
+        operations.append(UpdateOne(
+            {"_id": session["_id"]},
+            {"$set": {"starts_at": starts_at, "ends_at": ends_at}}
+        ))
+    for start in range(0, len(operations), NOTIFICATION_INSERT_CHUNK_SIZE):
+        await db.sessions.bulk_write(operations[start:start + NOTIFICATION_INSERT_CHUNK_SIZE], ordered=False)
+    logger.info(f"Set starts_at/ends_at on {len(operations)} sessions, skipped {skipped}")
+
+async def migrate_session_course_ids():
+    # Resolve sessions that reference their course by title to a course_id
+    resolved = 0
+    unresolved = 0
+    async for session in db.sessions.find(
+        {"course_id": {"$in": [None, ""]}, "course": {"$nin": [None, ""]}},
+        {"course": 1, "teacher_id": 1}
+    ):
+        course = await resolve_session_course(session["course"], session.get("teacher_id"))
+        if not course:
+            logger.warning(f"Session {session['_id']} references unknown course '{session['course']}'")
+            unresolved += 1
+            continue
+        await db.sessions.update_one({"_id": session["_id"]}, {"$set": {"course_id": str(course["_id"])}})
+        resolved += 1
+    logger.info(f"Resolved course_id for {resolved} sessions, {unresolved} unresolved")
+
+async def unique_notification_coalesce_keys():
+    # Keys used to carry a clock-aligned window suffix and the index behind
+    # them was not unique. Old keys never match the new format, so unset them
+    # and swap in the unique index on unread (user_id, coalesce_key)
+    result = await db.notifications.update_many(
+        {"coalesce_key": {"$exists": True}},
+        {"$unset": {"coalesce_key": ""}}
+    )
+    try:
+        await db.notifications.drop_index("user_id_1_coalesce_key_1")
+    except OperationFailure:
+        pass
+    spec = next(spec for spec in INDEX_SPECS["notifications"] if spec.get("name") == "user_id_coalesce_key_unread")
+    await db.notifications.create_index(spec["keys"], **{key: value for key, value in spec.items() if key != "keys"})
+    logger.info(f"Cleared legacy coalesce keys on {result.modified_count} notifications")
+
+async def backfill_outbox_failed_at():
+    # Failed jobs used to record completed_at, which only expires done jobs
+    result = await db.notification_outbox.update_many(
+        {"status": "failed", "failed_at": {"$exists": False}},
+        [{"$set": {"failed_at": {"$ifNull": ["$completed_at", "$created_at"]}}}]
+    )
+    logger.info(f"Set failed_at on {result.modified_count} failed outbox jobs")
+
+async def release_orphaned_derivatives():
+    # Deleting a course or material used to leave its derivatives behind
+    released = 0
+    async for derivative in db.derivatives.find({}, {"_id": 1}):
+        # cache_id is the source's SHA-256, or its URL for legacy uploads
+        if not await is_file_referenced(derivative["_id"]):
+            await release_derivatives(derivative["_id"])
+            released += 1
+    logger.info(f"Released {released} orphaned derivatives")
+
+async def get_storage_stats() -> dict:
+    stats = {"files": 0, "references": 0, "stored_bytes": 0, "saved_bytes": 0}
+    async for row in db.stored_files.aggregate([
+        {"$group": {
+            "_id": None,
+            "files": {"$sum": 1},
+            "references": {"$sum": "$ref_count"},
+            "stored_bytes": {"$sum": "$size"},
+            "saved_bytes": {"$sum": {"$multiply": ["$size", {"$subtract": ["$ref_count", 1]}]}},
+        }}
+    ]):
+        stats.update({key: value for key, value in row.items() if key != "_id"})
+    return stats
+
+# Data migrations, applied once each in order. The migrations collection
+# records what has run, so restarts and additional processes skip them.
+# MIGRATIONS must be applied before the API serves; each API process applies
+# them or waits for the one applying them at startup.
+MIGRATIONS = [
+    ("0001_course_students_to_enrollments", migrate_course_students_to_enrollments),
+    ("0003_unread_notification_counters", rebuild_unread_counters),
+    ("0004_notification_read_at", backfill_notification_read_at),
+    ("0005_device_topic_subscriptions", subscribe_existing_devices_to_topics),
+    ("0006_session_starts_at", migrate_session_datetimes),
+    ("0007_session_course_ids", migrate_session_course_ids),
+    ("0008_unique_notification_coalesce_keys", unique_notification_coalesce_keys),
+    ("0009_outbox_failed_at", backfill_outbox_failed_at),
+    ("0010_release_orphaned_derivatives", release_orphaned_derivatives),
+]
+
+# Long-running migrations the API works without (legacy uploads stay
+# servable), run by the outbox worker in the background
+BACKGROUND_MIGRATIONS = [
+    ("0002_uploads_to_content_addressed_storage", migrate_uploads_to_content_addressed_storage),
+]
+
+async def claim_migration(name: str, owner: str) -> bool:
+    lease_until = datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+    try:
+        await db.migrations.insert_one({
+            "_id": name,
+            "status": "running",
+            "owner": owner,
+            "started_at": datetime.utcnow(),
+            "lease_until": lease_until,
+        })
+        return True
+    except DuplicateKeyError:
+        pass
+    # Take over a marker whose owner stopped renewing it (markers written
+    # before leases existed have none and are taken over too)
+    taken = await db.migrations.find_one_and_update(
+        {"_id": name, "status": "running", "$or": [
+            {"lease_until": {"$lte": datetime.utcnow()}},
+            {"lease_until": {"$exists": False}},
+        ]},
+        {"$set": {"owner": owner, "started_at": datetime.utcnow(), "lease_until": lease_until}}
+    )
+    if taken:
+        logger.warning(f"Migration {name} was left running by {taken.get('owner', 'an older process')}, re-running it")
+    return taken is not None
+
+async def renew_migration_lease(name: str, owner: str):
+    while True:
+        await asyncio.sleep(MIGRATION_LEASE_SECONDS / 3)
+        try:
+            await db.migrations.update_one(
+                {"_id": name, "owner": owner, "status": "running"},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            logger.error(f"Failed to renew the lease of migration {name}: {str(e)}")
+
+async def apply_migrations(migrations: List[tuple]):
+    """Apply each migration in order, or wait while another process applies it.
+
+    Returns once all are applied. A failed migration releases its marker, so
+    the next attempt re-runs it, and raises.
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    for name, migration in migrations:
+        claimed = False
+        while not claimed:
+            claimed = await claim_migration(name, owner)
+            if claimed:
+                break
+            marker = await db.migrations.find_one({"_id": name}, {"status": 1, "owner": 1})
+            if marker and marker["status"] == "applied":
+                break
+            if marker:
+                logger.info(f"Waiting for migration {name}, being applied by {marker.get('owner')}")
+            await asyncio.sleep(MIGRATION_POLL_SECONDS)
+        if not claimed:
+            continue
+
+        heartbeat = asyncio.create_task(renew_migration_lease(name, owner))
+        try:
+            await migration()
+        except Exception as e:
+            logger.error(f"Migration {name} failed: {str(e)}")
+            await db.migrations.delete_one({"_id": name, "owner": owner})
+            raise
+        finally:
+            heartbeat.cancel()
+        await db.migrations.update_one(
+            {"_id": name, "owner": owner},
+            {"$set": {"status": "applied", "applied_at": datetime.utcnow()}, "$unset": {"lease_until": ""}}
+        )
+        logger.info(f"Applied migration {name}")
+
+@app.on_event("startup")
+async def run_migrations():
+    # Startup doesn't finish, so nothing is served, until these are applied
+    await apply_migrations(MIGRATIONS)
+
+async def run_background_migrations():
+    try:
+        await apply_migrations(BACKGROUND_MIGRATIONS)
+    except Exception as e:
+        # Released on failure; the next worker start retries it
+        logger.error(f"Background migrations stopped: {str(e)}")
+
+async def enroll_user(user_id: str, course_id: str, source: str) -> bool:
+    # Returns False if the user was already enrolled
+    try:
+        await db.enrollments.insert_one({
+            "course_id": course_id,
+            "user_id": user_id,
+            "enrolled_at": datetime.utcnow(),
+            "source": source,
+        })
+    except DuplicateKeyError:
+        return False
+    await db.courses.update_one({"_id": ObjectId(course_id)}, {"$inc": {"student_count": 1}})
+    await invalidate_calendar_feeds([user_id])
+    await enqueue_topic_subscriptions([user_id], [course_topic(course_id)])
+    return True
+
+async def is_enrolled(user_id: str, course_id: str) -> bool:
+    # One lookup on the unique (course_id, user_id) index. Enrollments are read
+    # straight from Mongo, so changes made by other workers show up at once
+    enrollment = await db.enrollments.find_one(
+        {"course_id": course_id, "user_id": user_id},
+        {"_id": 1}
+    )
+    return enrollment is not None
+
+async def get_course_student_ids(course_id: str) -> List[str]:
+    student_ids = []
+    async for enrollment in db.enrollments.find({"course_id": course_id}, {"user_id": 1}):
+        student_ids.append(enrollment["user_id"])
+    return student_ids
+
+async def get_enrolled_course_ids(user_id: str) -> List[str]:
+    course_ids = []
+    async for enrollment in db.enrollments.find({"user_id": user_id}, {"course_id": 1}):
+        course_ids.append(enrollment["course_id"])
+    return course_ids
+
 # Routes
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -356,18 +2444,19 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/users", response_model=User)
-async def create_user(user: UserCreate, background_tasks: BackgroundTasks):
+async def create_user(user: UserCreate):
     db_user = await get_user(user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await run_password_job(get_password_hash, user.password)
     user_dict = user.dict()
     user_dict.pop("password")
     user_dict["password"] = hashed_password
     user_dict["created_at"] = datetime.utcnow()
 
     result = await db.users.insert_one(user_dict)
+    invalidate_cached_user(user.email)
     user_id = str(result.inserted_id)
     user_dict["id"] = user_id
 
@@ -378,7 +2467,7 @@ async def create_user(user: UserCreate, background_tasks: BackgroundTasks):
         "message": f"Welcome {user.name}! We're excited to have you join our platform.",
         "action_type": "welcome",
     }
-    background_tasks.add_task(create_notification, notification_data)
+    await create_notification(notification_data)
 
     return user_dict
 
@@ -387,11 +2476,19 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
     current_user["id"] = str(current_user["_id"])
     return current_user
 
-@app.put("/users/me/class")
+@app.get("/ops/user-cache-stats", dependencies=[Depends(require_ops_token)])
+async def get_user_cache_stats():
+    return {
+        **user_cache_stats,
+        "size": len(user_cache),
+        "max_size": user_cache.maxsize,
+        "ttl_seconds": user_cache.ttl,
+    }
+
+@app.put("/users/me/class", response_model=User)
 async def update_class_level(
     current_user: dict = Depends(get_current_user),
-    class_data: dict = Body(...),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    class_data: dict = Body(...)
 ):
     if current_user["role"] != "student":
         raise HTTPException(status_code=400, detail="Only students can update class level")
@@ -400,6 +2497,13 @@ async def update_class_level(
         {"_id": ObjectId(current_user["_id"])},
         {"$set": {"class_level": class_data["class_level"]}}
     )
+    invalidate_cached_user(current_user["email"])
+
+    user_id = str(current_user["_id"])
+    old_class_level = current_user.get("class_level")
+    if old_class_level and old_class_level != class_data["class_level"]:
+        await enqueue_topic_subscriptions([user_id], [grade_topic(old_class_level)], subscribe=False)
+    await enqueue_topic_subscriptions([user_id], [grade_topic(class_data["class_level"])])
 
     updated_user = await db.users.find_one({"_id": ObjectId(current_user["_id"])})
     updated_user["id"] = str(updated_user["_id"])
@@ -411,24 +2515,55 @@ async def update_class_level(
         "message": f"Your class level has been updated to Grade {class_data['class_level']}.",
         "action_type": "profile_update",
     }
-    background_tasks.add_task(create_notification, notification_data)
+    await create_notification(notification_data)
 
     return updated_user
 
-@app.get("/courses", response_model=List[Course])
+def encode_course_cursor(course_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(course_id.binary).decode().rstrip("=")
+
+def decode_course_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/courses", response_model=CoursePage)
 async def get_courses(
     current_user: dict = Depends(get_current_user),
-    grade: Optional[str] = None
+    grade: Optional[str] = None,
+    teacher_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100)
 ):
+    # Keyset pagination on _id (newest first), so every page is an index range
+    # scan no matter how deep the client has paged
     query = {}
     if grade:
         query["grade"] = grade
+    if teacher_id:
+        query["teacher_id"] = teacher_id
+    if cursor:
+        query["_id"] = {"$lt": decode_course_cursor(cursor)}
+
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {"students": 0}},
+    ]
 
     courses = []
-    async for course in db.courses.find(query):
+    async for course in db.courses.aggregate(pipeline):
         course["id"] = str(course["_id"])
         courses.append(course)
-    return courses
+
+    next_cursor = None
+    if len(courses) > limit:
+        courses = courses[:limit]
+        next_cursor = encode_course_cursor(courses[-1]["_id"])
+
+    return {"items": courses, "next_cursor": next_cursor}
 
 @app.get("/courses/{course_id}", response_model=Course)
 async def get_course(course_id: str, current_user: dict = Depends(get_current_user)):
@@ -446,8 +2581,10 @@ async def get_course(course_id: str, current_user: dict = Depends(get_current_us
 async def get_enrolled_courses(current_user: dict = Depends(get_current_user)):
     user_id = str(current_user["_id"])
 
+    course_ids = [ObjectId(course_id) for course_id in await get_enrolled_course_ids(user_id)]
+
     courses = []
-    async for course in db.courses.find({"students": user_id}):
+    async for course in db.courses.find({"_id": {"$in": course_ids}}):
         course["id"] = str(course["_id"])
         courses.append(course)
 
@@ -455,28 +2592,26 @@ async def get_enrolled_courses(current_user: dict = Depends(get_current_user)):
 
 @app.post("/courses", response_model=Course)
 async def create_course(
-    current_user: dict = Depends(get_current_user),
-    title: str = Form(...),
-    description: str = Form(...),
-    grade: str = Form(...),
-    price: float = Form(...),
-    video: Optional[UploadFile] = File(None),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    request: Request,
+    current_user: dict = Depends(get_current_user)
 ):
+    """Multipart form: title, description, grade, price and an optional video."""
     if current_user["role"] != "teacher":
         raise HTTPException(status_code=400, detail="Only teachers can create courses")
 
+    form = await read_upload_form(request, "video", "video")
+    title = form.require("title")
+    description = form.require("description")
+    grade = form.require("grade")
+    price = form.require("price", float)
+
     video_url = None
-    if video:
+    if form.file:
         try:
-            file_ext = video.filename.split(".")[-1] if "." in video.filename else ""
-            unique_filename = f"{uuid.uuid4()}.{file_ext}"
-            file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(video.file, buffer)
-
-            video_url = f"/uploads/{unique_filename}"
+            saved = await store_upload(form)
+            video_url = saved["url"]
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error saving video: {str(e)}")
 
@@ -487,7 +2622,7 @@ async def create_course(
         "price": price,
         "teacher_id": str(current_user["_id"]),
         "teacher_name": current_user["name"],
-        "students": [],
+        "student_count": 0,
         "created_at": datetime.utcnow(),
         "video_url": video_url
     }
@@ -495,6 +2630,7 @@ async def create_course(
     result = await db.courses.insert_one(course_dict)
     course_id = str(result.inserted_id)
     course_dict["id"] = course_id
+    await schedule_derivatives("courses", course_id, video_url)
 
     # Create notification for the teacher
     notification_data = {
@@ -504,26 +2640,25 @@ async def create_course(
         "action_type": "course",
         "action_id": course_id,
     }
-    background_tasks.add_task(create_notification, notification_data)
+    await create_notification(notification_data)
 
     # Create notifications for students in the appropriate grade
-    async for student in db.users.find({"role": "student", "class_level": grade}):
-        student_notification = {
-            "user_id": str(student["_id"]),
-            "title": "New Course Available",
-            "message": f"A new course '{title}' for Grade {grade} is now available.",
-            "action_type": "course",
-            "action_id": course_id,
-        }
-        background_tasks.add_task(create_notification, student_notification)
+    student_ids = []
+    async for student in db.users.find({"role": "student", "class_level": grade}, {"_id": 1}):
+        student_ids.append(str(student["_id"]))
+    await enqueue_fan_out(student_ids, {
+        "title": "New Course Available",
+        "message": f"A new course '{title}' for Grade {grade} is now available.",
+        "action_type": "course",
+        "action_id": course_id,
+    }, topic=grade_topic(grade))
 
     return course_dict
 
 @app.post("/courses/{course_id}/enroll")
 async def enroll_in_course(
     course_id: str,
-    current_user: dict = Depends(get_current_user),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    current_user: dict = Depends(get_current_user)
 ):
     user_id = str(current_user["_id"])
 
@@ -534,14 +2669,9 @@ async def enroll_in_course(
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
 
-    if "students" in course and user_id in course["students"]:
+    if not await enroll_user(user_id, course_id, "enroll"):
         raise HTTPException(status_code=400, detail="Already enrolled in this course")
 
-    await db.courses.update_one(
-        {"_id": ObjectId(course_id)},
-        {"$push": {"students": user_id}}
-    )
-
     # Create notification for the student
     student_notification = {
         "user_id": user_id,
@@ -550,7 +2680,7 @@ async def enroll_in_course(
         "action_type": "course",
         "action_id": course_id,
     }
-    background_tasks.add_task(create_notification, student_notification)
+    await create_notification(student_notification)
 
     # Create notification for the teacher
     teacher_notification = {
@@ -560,15 +2690,14 @@ async def enroll_in_course(
         "action_type": "course",
         "action_id": course_id,
     }
-    background_tasks.add_task(create_notification, teacher_notification)
+    await create_notification(teacher_notification)
 
     return {"message": "Successfully enrolled in course"}
 
 @app.post("/payments", response_model=PaymentResponse)
 async def process_payment(
     current_user: dict = Depends(get_current_user),
-    payment: PaymentRequest = Body(...),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    payment: PaymentRequest = Body(...)
 ):
     if not ObjectId.is_valid(payment.course_id):
         raise HTTPException(status_code=400, detail="Invalid course ID format")
@@ -592,11 +2721,7 @@ async def process_payment(
     await db.payments.insert_one(payment_record)
 
     user_id = str(current_user["_id"])
-    if user_id not in course.get("students", []):
-        await db.courses.update_one(
-            {"_id": ObjectId(payment.course_id)},
-            {"$push": {"students": user_id}}
-        )
+    await enroll_user(user_id, payment.course_id, "payment")
 
     # Create payment notification for the student
     student_notification = {
@@ -605,7 +2730,7 @@ async def process_payment(
         "message": f"Your payment of ${payment.amount} for '{course['title']}' was successful.",
         "action_type": "payment",
     }
-    background_tasks.add_task(create_notification, student_notification)
+    await create_notification(student_notification)
 
     # Create enrollment notification for the teacher
     teacher_notification = {
@@ -614,7 +2739,7 @@ async def process_payment(
         "message": f"{current_user['name']} has made a payment of ${payment.amount} for '{course['title']}'.",
         "action_type": "payment",
     }
-    background_tasks.add_task(create_notification, teacher_notification)
+    await create_notification(teacher_notification)
 
     return {
         "payment_id": payment_id,
@@ -629,8 +2754,7 @@ async def process_payment(
 @app.delete("/courses/{course_id}")
 async def delete_course(
     course_id: str,
-    current_user: dict = Depends(get_current_user),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    current_user: dict = Depends(get_current_user)
 ):
     if not ObjectId.is_valid(course_id):
         raise HTTPException(status_code=400, detail="Invalid course ID format")
@@ -646,17 +2770,37 @@ async def delete_course(
             detail="Only the course teacher can delete this course"
         )
 
-    # Delete all materials associated with the course
-    await db.course_materials.delete_many({"course_id": course_id})
+    student_ids = await get_course_student_ids(course_id)
+
+    # Delete the course first, so only one of several concurrent deletes goes
+    # on to release its files
+    course = await db.courses.find_one_and_delete({"_id": ObjectId(course_id), "teacher_id": user_id})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+
+    # Delete materials one by one, releasing only what this request removed,
+    # since a concurrent material delete may be releasing some of them
+    material_file_urls = []
+    while True:
+        material = await db.course_materials.find_one_and_delete({"course_id": course_id})
+        if not material:
+            break
+        if material.get("file_url"):
+            material_file_urls.append(material["file_url"])
 
     # Delete all sessions associated with the course
     await db.sessions.delete_many({"course_id": course_id})
 
-    # Delete the course
-    result = await db.courses.delete_one({"_id": ObjectId(course_id)})
+    await db.enrollments.delete_many({"course_id": course_id})
+    await invalidate_calendar_feeds([user_id, *student_ids])
+    await enqueue_topic_subscriptions(student_ids, [course_topic(course_id)], subscribe=False)
 
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Course not found")
+    # Release the course video and material files
+    for file_url in [course.get("video_url"), *material_file_urls]:
+        try:
+            await release_file(file_url)
+        except Exception as e:
+            logger.error(f"Error deleting file: {str(e)}")
 
     # Create notification for the teacher
     notification_data = {
@@ -665,17 +2809,14 @@ async def delete_course(
         "message": f"Your course '{course['title']}' has been deleted successfully.",
         "action_type": "course_deleted",
     }
-    background_tasks.add_task(create_notification, notification_data)
+    await create_notification(notification_data)
 
     # Create notifications for enrolled students
-    for student_id in course.get("students", []):
-        student_notification = {
-            "user_id": student_id,
-            "title": "Course Removed",
-            "message": f"The course '{course['title']}' has been removed.",
-            "action_type": "course_deleted",
-        }
-        background_tasks.add_task(create_notification, student_notification)
+    await enqueue_fan_out(student_ids, {
+        "title": "Course Removed",
+        "message": f"The course '{course['title']}' has been removed.",
+        "action_type": "course_deleted",
+    })
 
     return {"message": "Course deleted successfully"}
 
@@ -683,14 +2824,10 @@ async def delete_course(
 @app.put("/courses/{course_id}", response_model=Course)
 async def update_course(
     course_id: str,
-    current_user: dict = Depends(get_current_user),
-    title: str = Form(...),
-    description: str = Form(...),
-    grade: str = Form(...),
-    price: float = Form(...),
-    video: Optional[UploadFile] = File(None),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    request: Request,
+    current_user: dict = Depends(get_current_user)
 ):
+    """Multipart form: title, description, grade, price and an optional new video."""
     if not ObjectId.is_valid(course_id):
         raise HTTPException(status_code=400, detail="Invalid course ID format")
 
@@ -705,42 +2842,34 @@ async def update_course(
             detail="Only the course teacher can update this course"
         )
 
-    video_url = course.get("video_url")
-    if video:
+    # Read the body only once the caller is known to own the course
+    form = await read_upload_form(request, "video", "video")
+    fields = {
+        "title": form.require("title"),
+        "description": form.require("description"),
+        "grade": form.require("grade"),
+        "price": form.require("price", float),
+    }
+    if form.file:
         try:
-            # Delete old video if exists
-            if video_url:
-                old_video_path = video_url.lstrip("/")
-                if os.path.exists(old_video_path):
-                    os.remove(old_video_path)
-
-            # Save new video
-            file_ext = video.filename.split(".")[-1] if "." in video.filename else ""
-            unique_filename = f"{uuid.uuid4()}.{file_ext}"
-            file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(video.file, buffer)
-
-            video_url = f"/uploads/{unique_filename}"
+            # Save new video before removing the old one, so a failed upload
+            # leaves the course with a working video
+            saved = await store_upload(form)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error saving video: {str(e)}")
 
-    # Update the course
-    await db.courses.update_one(
-        {"_id": ObjectId(course_id)},
-        {"$set": {
-            "title": title,
-            "description": description,
-            "grade": grade,
-            "price": price,
-            "video_url": video_url,
-            "updated_at": datetime.utcnow()
-        }}
-    )
-
-    # Get the updated course
-    updated_course = await db.courses.find_one({"_id": ObjectId(course_id)})
+        # Release the old video, deleting it if no other course uses it
+        updated_course = await replace_course_video(course, saved["url"], fields)
+    else:
+        updated_course = await db.courses.find_one_and_update(
+            {"_id": ObjectId(course_id)},
+            {"$set": {**fields, "updated_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not updated_course:
+            raise HTTPException(status_code=404, detail="Course not found")
     updated_course["id"] = str(updated_course["_id"])
 
     # Create notification for the teacher
@@ -751,18 +2880,15 @@ async def update_course(
         "action_type": "course",
         "action_id": course_id,
     }
-    background_tasks.add_task(create_notification, notification_data)
+    await create_notification(notification_data)
 
     # Create notifications for enrolled students
-    for student_id in updated_course.get("students", []):
-        student_notification = {
-            "user_id": student_id,
-            "title": "Course Updated",
-            "message": f"The course '{updated_course['title']}' has been updated.",
-            "action_type": "course",
-            "action_id": course_id,
-        }
-        background_tasks.add_task(create_notification, student_notification)
+    await enqueue_fan_out(await get_course_student_ids(course_id), {
+        "title": "Course Updated",
+        "message": f"The course '{updated_course['title']}' has been updated.",
+        "action_type": "course",
+        "action_id": course_id,
+    }, topic=course_topic(course_id))
 
     return updated_course
 
@@ -782,33 +2908,62 @@ async def get_course_materials(
     user_id = str(current_user["_id"])
     is_teacher = current_user["role"] == "teacher"
     is_course_teacher = course.get("teacher_id") == user_id
-    is_enrolled = user_id in course.get("students", [])
 
-    if not (is_teacher or is_course_teacher or is_enrolled):
+    if not (is_teacher or is_course_teacher or await is_enrolled(user_id, course_id)):
         raise HTTPException(
             status_code=403,
             detail="You must be the teacher or enrolled in the course to view materials"
         )
 
     materials = []
-    async for material in db.course_materials.find({"course_id": course_id}).sort("created_at", -1):
+    # Extracted text is kept for search, not sent with every listing
+    async for material in db.course_materials.find(
+        {"course_id": course_id}, {"extracted_text": 0}
+    ).sort("created_at", -1):
         material["id"] = str(material["_id"])
         materials.append(material)
 
     return materials
 
+async def insert_course_material(course: dict, user_id: str, material_dict: dict) -> dict:
+    course_id = str(course["_id"])
+    material_dict["course_id"] = course_id
+    material_dict["created_at"] = datetime.utcnow()
+    material_dict["created_by"] = user_id
+
+    result = await db.course_materials.insert_one(material_dict)
+    material_id = str(result.inserted_id)
+    material_dict["id"] = material_id
+    await schedule_derivatives("course_materials", material_id, material_dict.get("file_url"))
+
+    # Create notification for the teacher
+    teacher_notification = {
+        "user_id": user_id,
+        "title": "Material Added",
+        "message": f"You've successfully added '{material_dict['title']}' to '{course['title']}'.",
+        "action_type": "material",
+        "action_id": material_id,
+    }
+    await create_notification(teacher_notification)
+
+    # Create notifications for enrolled students
+    await enqueue_fan_out(await get_course_student_ids(course_id), {
+        "title": "New Course Material",
+        "message": f"New material '{material_dict['title']}' has been added to '{course['title']}'.",
+        "action_type": "material",
+        "action_id": material_id,
+        "coalesce_id": course_id,
+    }, topic=course_topic(course_id))
+
+    return material_dict
+
 @app.post("/courses/{course_id}/materials", response_model=CourseMaterial)
 async def create_course_material(
     course_id: str,
-    current_user: dict = Depends(get_current_user),
-    title: str = Form(...),
-    description: str = Form(...),
-    type: str = Form(...),
-    content: Optional[str] = Form(None),
-    external_url: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    request: Request,
+    current_user: dict = Depends(get_current_user)
 ):
+    """Multipart form: title, description, type, and optional content, external_url and file."""
     logger.info(f"Creating material for course {course_id}")
 
     if not ObjectId.is_valid(course_id):
@@ -825,32 +2980,30 @@ async def create_course_material(
             detail="Only the course teacher can add materials"
         )
 
+    # Read the body only once the caller is known to own the course
+    form = await read_upload_form(request, "file")
+    title = form.require("title")
+    description = form.require("description")
+    type = form.require("type")
+    content = form.get("content")
+    external_url = form.get("external_url")
+
     file_url = None
     file_name = None
     file_size = None
 
-    if file:
+    if form.file:
         try:
-            file_ext = file.filename.split(".")[-1] if "." in file.filename else ""
-            unique_filename = f"{uuid.uuid4()}.{file_ext}"
-            file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            saved = await store_upload(form)
 
-            file_url = f"/uploads/{unique_filename}"
-            file_name = file.filename
-            file_size = os.path.getsize(file_path)
+            file_url = saved["url"]
+            file_name = saved["file_name"]
+            file_size = saved["size"]
 
             if not type:
-                if file_ext.lower() in ["pdf", "doc", "docx"]:
-                    type = "document"
-                elif file_ext.lower() in ["jpg", "jpeg", "png", "gif"]:
-                    type = "image"
-                elif file_ext.lower() in ["mp4", "mov", "avi"]:
-                    type = "video"
-                else:
-                    type = "file"
+                type = saved["kind"]
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
 
@@ -863,37 +3016,9 @@ async def create_course_material(
         "file_url": file_url,
         "file_name": file_name,
         "file_size": file_size,
-        "course_id": course_id,
-        "created_at": datetime.utcnow(),
-        "created_by": user_id
     }
 
-    result = await db.course_materials.insert_one(material_dict)
-    material_id = str(result.inserted_id)
-    material_dict["id"] = material_id
-
-    # Create notification for the teacher
-    teacher_notification = {
-        "user_id": user_id,
-        "title": "Material Added",
-        "message": f"You've successfully added '{title}' to '{course['title']}'.",
-        "action_type": "material",
-        "action_id": material_id,
-    }
-    background_tasks.add_task(create_notification, teacher_notification)
-
-    # Create notifications for enrolled students
-    for student_id in course.get("students", []):
-        student_notification = {
-            "user_id": student_id,
-            "title": "New Course Material",
-            "message": f"New material '{title}' has been added to '{course['title']}'.",
-            "action_type": "material",
-            "action_id": material_id,
-        }
-        background_tasks.add_task(create_notification, student_notification)
-
-    return material_dict
+    return await insert_course_material(course, user_id, material_dict)
 
 @app.get("/courses/{course_id}/materials/{material_id}", response_model=CourseMaterial)
 async def get_course_material(
@@ -911,9 +3036,8 @@ async def get_course_material(
     user_id = str(current_user["_id"])
     is_teacher = current_user["role"] == "teacher"
     is_course_teacher = course.get("teacher_id") == user_id
-    is_enrolled = user_id in course.get("students", [])
 
-    if not (is_teacher or is_course_teacher or is_enrolled):
+    if not (is_teacher or is_course_teacher or await is_enrolled(user_id, course_id)):
         raise HTTPException(
             status_code=403,
             detail="You must be the teacher or enrolled in the course to view this material"
@@ -950,7 +3074,9 @@ async def delete_course_material(
             detail="Only the course teacher can delete materials"
         )
 
-    material = await db.course_materials.find_one({
+    # Delete before releasing, so a concurrent or retried delete can't
+    # release the same file reference twice
+    material = await db.course_materials.find_one_and_delete({
         "_id": ObjectId(material_id),
         "course_id": course_id
     })
@@ -960,72 +3086,1057 @@ async def delete_course_material(
 
     if material.get("file_url"):
         try:
-            file_path = material["file_url"].lstrip("/")
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            await release_file(material["file_url"])
         except Exception as e:
             logger.error(f"Error deleting file: {str(e)}")
 
-    result = await db.course_materials.delete_one({
-        "_id": ObjectId(material_id),
-        "course_id": course_id
-    })
+    return {"message": "Material deleted successfully"}
 
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Material not found")
+# Resumable Upload Endpoints
+def upload_session_path(session_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{session_id}.part")
+
+# Running SHA-256 of each open upload session in this process, keyed by
+# session ID along with the offset it has hashed up to. Sessions whose chunks
+# land on another worker (or survive a restart) are re-hashed on completion.
+upload_session_hashers: Dict[str, tuple] = {}
+
+def hash_file(file_path: str, size: int) -> str:
+    checksum = hashlib.sha256()
+    remaining = size
+    with open(file_path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return checksum.hexdigest()
+
+def format_upload_session(upload_session: dict) -> dict:
+    upload_session["id"] = str(upload_session["_id"])
+    return upload_session
+
+async def get_own_upload_session(session_id: str, current_user: dict) -> dict:
+    if not ObjectId.is_valid(session_id):
+        raise HTTPException(status_code=400, detail="Invalid upload session ID format")
+
+    upload_session = await db.upload_sessions.find_one({"_id": ObjectId(session_id)})
+    if not upload_session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    if upload_session["user_id"] != str(current_user["_id"]):
+        raise HTTPException(status_code=403, detail="You can only access your own upload sessions")
+
+    return upload_session
+
+@app.post("/upload-sessions", response_model=UploadSession)
+async def create_upload_session(
+    upload: UploadSessionCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] != "teacher":
+        raise HTTPException(status_code=400, detail="Only teachers can upload files")
 
-    return {"message": "Material deleted successfully"}
+    file_ext = get_file_extension(upload.file_name)
+    kind = upload.kind or get_upload_kind(file_ext)
+    validate_upload_size(kind, upload.size)
+
+    now = datetime.utcnow()
+    upload_session = {
+        "user_id": str(current_user["_id"]),
+        "file_name": upload.file_name,
+        "file_ext": file_ext,
+        "kind": kind,
+        "size": upload.size,
+        "offset": 0,
+        "status": "open",
+        "created_at": now,
+        "expires_at": now + timedelta(hours=UPLOAD_SESSION_TTL_HOURS),
+    }
+    result = await db.upload_sessions.insert_one(upload_session)
+
+    # Create the empty part file so chunks can always be written in place
+    async with aiofiles.open(upload_session_path(str(result.inserted_id)), "wb"):
+        pass
+
+    return format_upload_session(upload_session)
+
+@app.get("/upload-sessions/{session_id}", response_model=UploadSession)
+async def get_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    return format_upload_session(await get_own_upload_session(session_id, current_user))
+
+@app.put("/upload-sessions/{session_id}", response_model=UploadSession)
+async def upload_session_chunk(
+    session_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    upload_session = await get_own_upload_session(session_id, current_user)
+
+    # Claim the offset before writing: of concurrent PUTs at the same offset
+    # only one gets the writer lease, the others get a 409 and re-sync
+    writer = secrets.token_hex(8)
+    now = datetime.utcnow()
+    claimed = await db.upload_sessions.find_one_and_update(
+        {
+            "_id": upload_session["_id"],
+            "status": "open",
+            "offset": offset,
+            "$or": [{"writer": {"$exists": False}}, {"writer_until": {"$lte": now}}],
+        },
+        {"$set": {"writer": writer, "writer_until": now + timedelta(seconds=UPLOAD_SESSION_WRITER_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not claimed:
+        upload_session = await db.upload_sessions.find_one({"_id": upload_session["_id"]})
+        if upload_session["status"] != "open":
+            raise HTTPException(status_code=409, detail="Upload session is no longer open")
+        if offset != upload_session["offset"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Offset mismatch, the upload session is at byte {upload_session['offset']}"
+            )
+        raise HTTPException(status_code=409, detail="Another chunk is being written to this upload session")
+    upload_session = claimed
+
+    # Chunks are written in place at the requested offset, so a retried chunk
+    # overwrites whatever part of it arrived before the connection dropped.
+    # Bytes received before a disconnect still count towards the offset.
+    hashed_offset, checksum = upload_session_hashers.pop(session_id, (0, hashlib.sha256()))
+    if hashed_offset != offset:
+        checksum = None
+
+    written = 0
+    renew_at = time.monotonic() + UPLOAD_SESSION_WRITER_LEASE_SECONDS / 3
+    try:
+        async with aiofiles.open(upload_session_path(session_id), "r+b") as part_file:
+            await part_file.seek(offset)
+            async for chunk in request.stream():
+                if offset + written + len(chunk) > upload_session["size"]:
+                    raise HTTPException(status_code=413, detail="Chunk exceeds the declared upload size")
+                if time.monotonic() >= renew_at:
+                    renewed = await db.upload_sessions.update_one(
+                        {"_id": upload_session["_id"], "writer": writer},
+                        {"$set": {"writer_until": datetime.utcnow() + timedelta(seconds=UPLOAD_SESSION_WRITER_LEASE_SECONDS)}}
+                    )
+                    if not renewed.matched_count:
+                        checksum = None
+                        raise HTTPException(status_code=409, detail="Upload session was taken over by another chunk")
+                    renew_at = time.monotonic() + UPLOAD_SESSION_WRITER_LEASE_SECONDS / 3
+                await part_file.write(chunk)
+                written += len(chunk)
+                if checksum:
+                    checksum.update(chunk)
+    finally:
+        # Only the lease holder advances the offset and releases the lease
+        upload_session = await db.upload_sessions.find_one_and_update(
+            {"_id": upload_session["_id"], "writer": writer, "offset": offset},
+            {
+                "$set": {
+                    "offset": offset + written,
+                    "expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS),
+                },
+                "$unset": {"writer": "", "writer_until": ""},
+            },
+            return_document=ReturnDocument.AFTER
+        ) or await db.upload_sessions.find_one({"_id": upload_session["_id"]})
+        if checksum and upload_session["offset"] == offset + written:
+            upload_session_hashers[session_id] = (offset + written, checksum)
+
+    return format_upload_session(upload_session)
+
+@app.post("/upload-sessions/{session_id}/complete")
+async def complete_upload_session(
+    session_id: str,
+    completion: UploadSessionComplete,
+    current_user: dict = Depends(get_current_user)
+):
+    upload_session = await get_own_upload_session(session_id, current_user)
+
+    if upload_session["status"] != "open":
+        raise HTTPException(status_code=409, detail="Upload session is no longer open")
+    if upload_session["offset"] != upload_session["size"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload incomplete, received {upload_session['offset']} of {upload_session['size']} bytes"
+        )
+    course = await get_attachment_course(completion, current_user)
+
+    # Claim the session so a concurrent completion can't attach it twice
+    claimed = await db.upload_sessions.find_one_and_update(
+        {"_id": upload_session["_id"], "status": "open"},
+        {"$set": {"status": "completing"}}
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Upload session is no longer open")
+
+    part_path = upload_session_path(session_id)
+    hashed_offset, checksum = upload_session_hashers.pop(session_id, (None, None))
+    try:
+        if hashed_offset == upload_session["size"]:
+            sha256 = checksum.hexdigest()
+        else:
+            loop = asyncio.get_running_loop()
+            sha256 = await loop.run_in_executor(None, hash_file, part_path, upload_session["size"])
+        os.truncate(part_path, upload_session["size"])
+        file_url = await store_file(part_path, sha256, upload_session["file_ext"], upload_session["size"])
+    except Exception:
+        # Reopen the session so the client can retry the completion
+        await db.upload_sessions.update_one(
+            {"_id": upload_session["_id"], "status": "completing"},
+            {"$set": {"status": "open"}}
+        )
+        raise
+
+    await db.upload_sessions.update_one(
+        {"_id": upload_session["_id"]},
+        {"$set": {"status": "completed", "file_url": file_url, "completed_at": datetime.utcnow()}}
+    )
+
+    return await attach_uploaded_file(
+        course,
+        str(current_user["_id"]),
+        completion,
+        file_url,
+        upload_session["file_name"],
+        upload_session["size"],
+        upload_session["kind"]
+    )
+
+async def get_attachment_course(completion: UploadSessionComplete, current_user: dict) -> dict:
+    if completion.target not in ("course_video", "material"):
+        raise HTTPException(status_code=400, detail="Target must be 'course_video' or 'material'")
+    if completion.target == "material" and not (completion.title and completion.description):
+        raise HTTPException(status_code=400, detail="Materials need a title and description")
+
+    if not ObjectId.is_valid(completion.course_id):
+        raise HTTPException(status_code=400, detail="Invalid course ID format")
+
+    course = await db.courses.find_one({"_id": ObjectId(completion.course_id)})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+
+    if course.get("teacher_id") != str(current_user["_id"]):
+        raise HTTPException(
+            status_code=403,
+            detail="Only the course teacher can attach uploads to this course"
+        )
+    return course
+
+async def attach_uploaded_file(
+    course: dict,
+    user_id: str,
+    completion: UploadSessionComplete,
+    file_url: str,
+    file_name: str,
+    size: int,
+    kind: str
+):
+    if completion.target == "course_video":
+        updated_course = await replace_course_video(course, file_url, {})
+        updated_course["id"] = str(updated_course["_id"])
+        return Course(**updated_course)
+
+    material_dict = {
+        "title": completion.title,
+        "description": completion.description,
+        "type": completion.type or kind,
+        "content": None,
+        "external_url": None,
+        "file_url": file_url,
+        "file_name": file_name,
+        "file_size": size,
+    }
+    return CourseMaterial(**await insert_course_material(course, user_id, material_dict))
+
+# Presigned Upload Endpoints
+def validate_upload_size(kind: str, size: int):
+    if kind not in UPLOAD_SIZE_LIMITS:
+        raise HTTPException(status_code=400, detail=f"Unknown upload kind '{kind}'")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+    if size > UPLOAD_SIZE_LIMITS[kind]:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large, the limit for {kind} uploads is {UPLOAD_SIZE_LIMITS[kind] // (1024 * 1024)} MB"
+        )
+
+@app.post("/storage/presigned-uploads", response_model=PresignedUpload)
+async def create_presigned_upload(
+    upload: PresignedUploadCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] != "teacher":
+        raise HTTPException(status_code=400, detail="Only teachers can upload files")
+
+    sha256 = upload.sha256.lower()
+    if not CONTENT_ADDRESSED_NAME.match(sha256):
+        raise HTTPException(status_code=400, detail="sha256 must be a hex SHA-256 digest")
+
+    file_ext = get_file_extension(upload.file_name)
+    kind = upload.kind or get_upload_kind(file_ext)
+    validate_upload_size(kind, upload.size)
+
+    # Content we already store doesn't need to be uploaded again
+    stored = await db.stored_files.find_one({"_id": sha256})
+    if stored and await storage.exists(storage_key(stored["file_url"])):
+        return {"key": storage_key(stored["file_url"]), "file_url": stored["file_url"], "already_stored": True}
+
+    key = content_addressed_key(sha256, file_ext)
+    content_type = mimetypes.guess_type(upload.file_name)[0] or "application/octet-stream"
+    upload_url, upload_headers = storage.presign_put(key, upload.size, sha256, content_type)
+    return {
+        "key": key,
+        "file_url": storage.file_url(key),
+        "already_stored": False,
+        "upload_url": upload_url,
+        "upload_headers": upload_headers,
+        "expires_in": PRESIGNED_URL_EXPIRE_SECONDS,
+    }
+
+@app.put("/storage/local/{key}")
+async def upload_presigned_local_file(key: str, request: Request, token: str = Query(...)):
+    if storage.name != "local":
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=403, detail="Invalid or expired upload URL")
+    if claims.get("purpose") != "storage_put" or claims.get("key") != key:
+        raise HTTPException(status_code=403, detail="Invalid or expired upload URL")
+
+    if await storage.exists(key):
+        return {"message": "File already stored"}
+
+    temp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+    checksum = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as buffer:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > claims["size"]:
+                    raise HTTPException(status_code=413, detail="Body exceeds the signed upload size")
+                checksum.update(chunk)
+                await buffer.write(chunk)
+        if size != claims["size"] or checksum.hexdigest() != claims["sha256"]:
+            raise HTTPException(status_code=400, detail="Uploaded content does not match the signed size and checksum")
+        await storage.put_file(temp_path, key)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return {"message": "File uploaded successfully"}
+
+@app.post("/storage/presigned-uploads/complete")
+async def complete_presigned_upload(
+    completion: PresignedUploadComplete,
+    current_user: dict = Depends(get_current_user)
+):
+    course = await get_attachment_course(completion, current_user)
+
+    sha256 = completion.sha256.lower()
+    if not CONTENT_ADDRESSED_NAME.match(sha256):
+        raise HTTPException(status_code=400, detail="sha256 must be a hex SHA-256 digest")
+
+    file_ext = get_file_extension(completion.file_name)
+    stored = await db.stored_files.find_one({"_id": sha256})
+    key = storage_key(stored["file_url"]) if stored else content_addressed_key(sha256, file_ext)
+    if not await storage.exists(key):
+        raise HTTPException(status_code=409, detail="The file has not been uploaded yet")
+
+    size = stored["size"] if stored else await storage.size(key)
+
+    stored = await add_file_reference(sha256, key, size)
+    return await attach_uploaded_file(
+        course,
+        str(current_user["_id"]),
+        completion,
+        stored["file_url"],
+        completion.file_name,
+        size,
+        get_upload_kind(file_ext)
+    )
+
+async def authorize_file_download(file_url: str, current_user: dict):
+    """Allow a download only to the teacher of, or a student enrolled in, a
+    course that references the file. Course thumbnails are shown on the public
+    course list, so anyone signed in may fetch those."""
+    key = storage_key(file_url)
+    # Stored URLs depend on the backend that wrote them
+    urls = list({storage.file_url(key), f"/uploads/{key}", file_url})
+    if await db.courses.find_one({"thumbnail": {"$in": urls}}, {"_id": 1}):
+        return
+
+    course_ids = set()
+    async for course in db.courses.find({"video_url": {"$in": urls}}, {"_id": 1}):
+        course_ids.add(str(course["_id"]))
+    async for material in db.course_materials.find(
+        {"$or": [{field: {"$in": urls}} for field in ("file_url", "thumbnail", "preview_url")]},
+        {"course_id": 1}
+    ):
+        course_ids.add(material["course_id"])
+    if not course_ids:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    user_id = str(current_user["_id"])
+    owned = await db.courses.find_one(
+        {"_id": {"$in": [ObjectId(course_id) for course_id in course_ids if ObjectId.is_valid(course_id)]}, "teacher_id": user_id},
+        {"_id": 1}
+    )
+    if owned:
+        return
+    for course_id in course_ids:
+        if await is_enrolled(user_id, course_id):
+            return
+    raise HTTPException(
+        status_code=403,
+        detail="You must be the teacher or enrolled in the course to download this file"
+    )
+
+@app.get("/storage/presigned-download")
+async def get_presigned_download(
+    file_url: str,
+    current_user: dict = Depends(get_current_user)
+):
+    await authorize_file_download(file_url, current_user)
+    return {
+        "url": storage.presign_get(storage_key(file_url)),
+        "expires_in": PRESIGNED_URL_EXPIRE_SECONDS,
+    }
+
+async def cleanup_stale_upload_sessions():
+    # Drop sessions that were abandoned (and their partial files), and forget
+    # completed ones once they expire
+    removed = 0
+    async for upload_session in db.upload_sessions.find(
+        {"expires_at": {"$lte": datetime.utcnow()}},
+        {"_id": 1}
+    ):
+        part_path = upload_session_path(str(upload_session["_id"]))
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        upload_session_hashers.pop(str(upload_session["_id"]), None)
+        await db.upload_sessions.delete_one({"_id": upload_session["_id"]})
+        removed += 1
+    if removed:
+        logger.info(f"Removed {removed} stale upload sessions")
+
+# Derivative pipeline
+derivative_executor = None
+
+def get_derivative_executor() -> ProcessPoolExecutor:
+    # Created on first use so the API process never forks a pool it won't use
+    global derivative_executor
+    if derivative_executor is None:
+        derivative_executor = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+    return derivative_executor
+
+def render_derivatives(source_path: str, kind: str, file_ext: str, work_dir: str) -> dict:
+    """Render derivatives of one file. Runs in the derivative process pool.
+
+    Returns the paths of generated images inside work_dir plus any metadata.
+    """
+    result = {}
+    image_source = None
+
+    if file_ext.lower() == "pdf" and pymupdf_available:
+        with pymupdf.open(source_path) as document:
+            result["page_count"] = document.page_count
+            text_parts = []
+            text_length = 0
+            for page in document:
+                if text_length >= DERIVATIVE_TEXT_LIMIT:
+                    break
+                page_text = page.get_text()
+                text_parts.append(page_text)
+                text_length += len(page_text)
+            result["text"] = "".join(text_parts)[:DERIVATIVE_TEXT_LIMIT]
+            if document.page_count:
+                first_page = document[0]
+                zoom = PDF_PREVIEW_WIDTH / max(first_page.rect.width, 1)
+                preview_path = os.path.join(work_dir, "preview.png")
+                first_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).save(preview_path)
+                result["preview_path"] = preview_path
+                image_source = preview_path
+    elif kind == "image":
+        image_source = source_path
+    elif kind == "video" and FFMPEG_PATH:
+        frame_path = os.path.join(work_dir, "frame.jpg")
+        completed = subprocess.run(
+            [FFMPEG_PATH, "-loglevel", "error", "-y", "-ss", "1", "-i", source_path, "-frames:v", "1", frame_path],
+            capture_output=True,
+            timeout=60
+        )
+        if completed.returncode == 0 and os.path.exists(frame_path):
+            image_source = frame_path
+
+    if image_source and pillow_available:
+        thumbnail_path = os.path.join(work_dir, "thumbnail.jpg")
+        with Image.open(image_source) as image:
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image.convert("RGB").save(thumbnail_path, "JPEG", quality=80, optimize=True)
+        result["thumbnail_path"] = thumbnail_path
+
+    return result
+
+async def build_derivatives(cache_id: str, file_url: str, kind: str) -> dict:
+    key = storage_key(file_url)
+    local_path, is_temp = await storage.fetch_local(key)
+    work_dir = tempfile.mkdtemp(prefix=".derivatives-", dir=UPLOAD_DIR)
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(
+            get_derivative_executor(),
+            render_derivatives,
+            local_path,
+            kind,
+            get_file_extension(key),
+            work_dir
+        )
+        derivative = {
+            "_id": cache_id,
+            "page_count": rendered.get("page_count"),
+            "text": rendered.get("text"),
+            "created_at": datetime.utcnow(),
+        }
+        for name in ("thumbnail", "preview"):
+            path = rendered.get(f"{name}_path")
+            if path:
+                size = os.path.getsize(path)
+                sha256 = await loop.run_in_executor(None, hash_file, path, size)
+                derivative[f"{name}_url"] = await store_file(path, sha256, get_file_extension(path), size)
+        return derivative
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if is_temp and os.path.exists(local_path):
+            os.remove(local_path)
+
+async def generate_derivatives(payload: dict):
+    """Outbox handler: derive previews for an uploaded file and attach them."""
+    collection = payload["collection"]
+    document_id = ObjectId(payload["document_id"])
+    file_url = payload["file_url"]
+
+    # Identical uploads share one set of derivatives
+    stem = Path(storage_key(file_url)).stem
+    cache_id = stem if CONTENT_ADDRESSED_NAME.match(stem) else file_url
+
+    derivative = await db.derivatives.find_one({"_id": cache_id})
+    if derivative is None:
+        # Safe to run twice (a retried job, or a render that outlived a lease):
+        # the insert is keyed by cache_id and the loser releases its files
+        derivative = await build_derivatives(cache_id, file_url, payload["kind"])
+        try:
+            await db.derivatives.insert_one(derivative)
+        except DuplicateKeyError:
+            # Another worker rendered the same content first; keep theirs
+            for name in ("thumbnail_url", "preview_url"):
+                await release_file(derivative.get(name))
+            derivative = await db.derivatives.find_one({"_id": cache_id})
+        if not await is_file_referenced(file_url):
+            # The source was deleted while rendering, after its release found
+            # nothing to clean up
+            await release_derivatives(cache_id)
+            return
+        if derivative is None:
+            return
+
+    # Only attach if the document still points at the file we processed
+    if collection == "courses":
+        await db.courses.update_one(
+            {"_id": document_id, "video_url": file_url},
+            {"$set": {"thumbnail": derivative.get("thumbnail_url")}}
+        )
+    else:
+        await db.course_materials.update_one(
+            {"_id": document_id, "file_url": file_url},
+            {"$set": {
+                "thumbnail": derivative.get("thumbnail_url"),
+                "preview_url": derivative.get("preview_url"),
+                "page_count": derivative.get("page_count"),
+                "extracted_text": derivative.get("text"),
+            }}
+        )
+
+async def schedule_derivatives(collection: str, document_id: str, file_url: Optional[str]):
+    if file_url:
+        await enqueue_outbox_jobs("derivatives", [{
+            "collection": collection,
+            "document_id": document_id,
+            "file_url": file_url,
+            "kind": get_upload_kind(get_file_extension(storage_key(file_url))),
+        }])
+
+# Orphaned upload sweeper
+async def get_referenced_upload_keys() -> set:
+    referenced = set()
+    sources = [
+        ("courses", "video_url", {}),
+        ("course_materials", "file_url", {}),
+        ("stored_files", "file_url", {"ref_count": {"$gt": 0}}),
+        ("upload_sessions", "file_url", {}),
+        ("derivatives", "thumbnail_url", {}),
+        ("derivatives", "preview_url", {}),
+    ]
+    for collection, field, extra_query in sources:
+        async for document in db[collection].find(
+            {field: {"$regex": "^/uploads/"}, **extra_query},
+            {field: 1}
+        ):
+            referenced.add(storage_key(document[field]))
+    return referenced
+
+def scan_directory_batches(directory: str, batch_size: int):
+    batch = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+async def sweep_orphaned_uploads(dry_run: bool = True) -> dict:
+    """Quarantine unreferenced files in UPLOAD_DIR and purge old quarantine.
+
+    The referenced keys are loaded into an in-memory set once, then the
+    directory is streamed in batches and checked against it. With dry_run
+    nothing is moved or deleted and the report lists what would happen.
+    """
+    report = {
+        "dry_run": dry_run,
+        "scanned": 0,
+        "quarantined": [],
+        "quarantined_bytes": 0,
+        "restored": [],
+        "deleted": [],
+        "deleted_bytes": 0,
+    }
+    if storage.name != "local":
+        logger.info("Upload sweeper only manages local storage, skipping")
+        return report
+
+    Path(UPLOAD_QUARANTINE_DIR).mkdir(exist_ok=True)
+    referenced = await get_referenced_upload_keys()
+    now = time.time()
+
+    for batch in scan_directory_batches(UPLOAD_DIR, SWEEPER_BATCH_SIZE):
+        for entry in batch:
+            report["scanned"] += 1
+            # Recent files, including the dotfile temp files of in-flight
+            # uploads, are left alone until the grace period has passed
+            name = entry.name
+            stat_result = entry.stat()
+            if now - stat_result.st_mtime < SWEEPER_GRACE_SECONDS or name in referenced:
+                continue
+            report["quarantined"].append(name)
+            report["quarantined_bytes"] += stat_result.st_size
+            if not dry_run:
+                quarantine_path = os.path.join(UPLOAD_QUARANTINE_DIR, name)
+                os.replace(entry.path, quarantine_path)
+                # Quarantine age is measured from the move
+                os.utime(quarantine_path)
+        await asyncio.sleep(0)
+
+    quarantine_cutoff = now - SWEEPER_QUARANTINE_DAYS * 24 * 60 * 60
+    for batch in scan_directory_batches(UPLOAD_QUARANTINE_DIR, SWEEPER_BATCH_SIZE):
+        for entry in batch:
+            stat_result = entry.stat()
+            if entry.name in referenced:
+                # Referenced again since it was quarantined, put it back
+                report["restored"].append(entry.name)
+                if not dry_run:
+                    os.replace(entry.path, os.path.join(UPLOAD_DIR, entry.name))
+            elif stat_result.st_mtime < quarantine_cutoff:
+                report["deleted"].append(entry.name)
+                report["deleted_bytes"] += stat_result.st_size
+                if not dry_run:
+                    os.remove(entry.path)
+        await asyncio.sleep(0)
+
+    logger.info(
+        f"Upload sweep{' (dry run)' if dry_run else ''}: scanned {report['scanned']} files, "
+        f"quarantined {len(report['quarantined'])} ({report['quarantined_bytes']} bytes), "
+        f"restored {len(report['restored'])}, "
+        f"deleted {len(report['deleted'])} ({report['deleted_bytes']} bytes)"
+    )
+    return report
+
+async def sweep_orphaned_uploads_job():
+    await sweep_orphaned_uploads(dry_run=False)
+
+async def run_periodically(interval_seconds: float, job):
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"Periodic job {job.__name__} failed: {str(e)}")
+        await asyncio.sleep(interval_seconds)
+
+def to_utc(local: datetime) -> datetime:
+    return local.replace(tzinfo=SESSION_TIMEZONE).astimezone(timezone.utc).replace(tzinfo=None)
+
+def session_bounds(date: str, time: str, duration: int) -> tuple:
+    """Return naive UTC (starts_at, ends_at) for a session's local date and time."""
+    day = datetime.strptime(date, "%Y-%m-%d")
+    for time_format in ("%H:%M:%S", "%H:%M"):
+        try:
+            clock = datetime.strptime(time, time_format).time()
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"Invalid session time '{time}'")
+    starts_at = to_utc(datetime.combine(day.date(), clock))
+    return starts_at, starts_at + timedelta(minutes=duration)
+
+class SessionReminderScheduler:
+    """Sends "starting soon" notifications before live sessions.
+
+    Only sessions starting within the next SESSION_REMINDER_WINDOW_SECONDS,
+    and at most SESSION_REMINDER_MAX_PENDING of them, are kept in a heap
+    ordered by reminder time. The window is reloaded from the starts_at index
+    as it advances, which also recovers everything pending after a restart.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.pending = {}  # session ID -> starts_at it is scheduled for
+        self.handled = {}  # session ID -> starts_at whose reminder was sent or skipped
+        self.horizon = None
+        self.wake = asyncio.Event()
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    def schedule(self, session_id: str, starts_at: datetime):
+        # Sessions beyond the loaded window are picked up by a later reload
+        if self.horizon is None or starts_at > self.horizon:
+            return
+        if self.pending.get(session_id) == starts_at or self.handled.get(session_id) == starts_at:
+            return
+        self.pending[session_id] = starts_at
+        fire_at = starts_at - timedelta(minutes=SESSION_REMINDER_MINUTES)
+        heapq.heappush(self.heap, (fire_at, session_id, starts_at))
+        self.wake.set()
+
+    async def load_window(self):
+        now = datetime.utcnow()
+        self.horizon = now + timedelta(minutes=SESSION_REMINDER_MINUTES, seconds=SESSION_REMINDER_WINDOW_SECONDS)
+        self.handled = {
+            session_id: starts_at
+            for session_id, starts_at in self.handled.items()
+            if starts_at > now
+        }
+        loaded = 0
+        last_starts_at = None
+        async for session in db.sessions.find(
+            {"starts_at": {"$gt": now, "$lte": self.horizon}},
+            {"starts_at": 1}
+        ).sort("starts_at", ASCENDING).limit(SESSION_REMINDER_MAX_PENDING):
+            self.schedule(str(session["_id"]), session["starts_at"])
+            loaded += 1
+            last_starts_at = session["starts_at"]
+        if loaded == SESSION_REMINDER_MAX_PENDING:
+            # Full: shrink the window to what fits, the rest loads later
+            self.horizon = last_starts_at
+
+    async def claim(self, reminder_id: str, session_id: str) -> Optional[bool]:
+        # True when claimed, False when already handled, None while another
+        # worker holds a live lease (retried on a later reload)
+        now = datetime.utcnow()
+        lease = {
+            "claimed_by": self.worker_id,
+            "lease_until": now + timedelta(seconds=SESSION_REMINDER_LEASE_SECONDS),
+        }
+        try:
+            await db.session_reminders.insert_one({
+                "_id": reminder_id,
+                "session_id": session_id,
+                "status": "claimed",
+                "created_at": now,
+                **lease,
+            })
+            return True
+        except DuplicateKeyError:
+            # Take over a claim left by a worker that died before sending
+            taken = await db.session_reminders.find_one_and_update(
+                {"_id": reminder_id, "status": "claimed", "lease_until": {"$lte": now}},
+                {"$set": lease}
+            )
+            if taken is not None:
+                return True
+            reminder = await db.session_reminders.find_one({"_id": reminder_id}, {"status": 1})
+            return None if reminder and reminder["status"] == "claimed" else False
+
+    async def fire(self, session_id: str, starts_at: datetime):
+        reminder_id = f"{session_id}:{int(starts_at.replace(tzinfo=timezone.utc).timestamp())}"
+        claimed = await self.claim(reminder_id, session_id)
+        if claimed is None:
+            return
+        if not claimed:
+            self.handled[session_id] = starts_at
+            return
+
+        try:
+            session = await db.sessions.find_one({"_id": ObjectId(session_id)})
+            if not session or session.get("starts_at") != starts_at:
+                await db.session_reminders.update_one({"_id": reminder_id}, {"$set": {"status": "skipped"}})
+                self.handled[session_id] = starts_at
+                return
+
+            minutes = max(1, round((starts_at - datetime.utcnow()).total_seconds() / 60))
+            notification = {
+                "title": "Session Starting Soon",
+                "message": f"'{session['title']}' starts in {minutes} minutes.",
+                "action_type": "session",
+                "action_id": session_id,
+            }
+            # Keyed jobs: a retry after a partial failure only queues what is missing
+            await create_notification(
+                {**notification, "user_id": session["teacher_id"]},
+                key=f"reminder:{reminder_id}:teacher"
+            )
+            if session.get("course_id"):
+                await enqueue_fan_out(
+                    await get_course_student_ids(session["course_id"]),
+                    notification,
+                    topic=course_topic(session["course_id"]),
+                    key=f"reminder:{reminder_id}:students"
+                )
+            await db.session_reminders.update_one(
+                {"_id": reminder_id},
+                {"$set": {"status": "sent", "sent_at": datetime.utcnow()}}
+            )
+        except Exception:
+            # Let this or another worker retry right away
+            await db.session_reminders.update_one(
+                {"_id": reminder_id, "claimed_by": self.worker_id, "status": "claimed"},
+                {"$set": {"lease_until": datetime.utcnow()}}
+            )
+            raise
+        self.handled[session_id] = starts_at
+
+    def retry_later(self, session_id: str, starts_at: datetime):
+        retry_at = datetime.utcnow() + timedelta(seconds=SESSION_REMINDER_RETRY_SECONDS)
+        if retry_at >= starts_at or session_id in self.pending:
+            return
+        self.pending[session_id] = starts_at
+        heapq.heappush(self.heap, (retry_at, session_id, starts_at))
+
+    async def run(self):
+        logger.info(f"Starting session reminder scheduler {self.worker_id}")
+        next_reload = 0
+        while True:
+            try:
+                if time.monotonic() >= next_reload:
+                    await self.load_window()
+                    next_reload = time.monotonic() + SESSION_REMINDER_RELOAD_SECONDS
+
+                while self.heap and self.heap[0][0] <= datetime.utcnow():
+                    _, session_id, starts_at = heapq.heappop(self.heap)
+                    if self.pending.get(session_id) != starts_at:
+                        continue  # superseded by a newer start time
+                    del self.pending[session_id]
+                    try:
+                        await self.fire(session_id, starts_at)
+                    except Exception as e:
+                        logger.error(f"Reminder for session {session_id} failed, retrying: {str(e)}")
+                        self.retry_later(session_id, starts_at)
+            except Exception as e:
+                logger.error(f"Session reminder scheduler error: {str(e)}")
+
+            delay = next_reload - time.monotonic()
+            if self.heap:
+                delay = min(delay, (self.heap[0][0] - datetime.utcnow()).total_seconds())
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=max(delay, 0.1))
+            except asyncio.TimeoutError:
+                pass
+
+reminder_scheduler = SessionReminderScheduler()
+
+async def resolve_session_course(course: str, teacher_id: str) -> Optional[dict]:
+    # The app sends the course title, API clients may send its ID; prefer the
+    # teacher's own course when titles collide
+    if ObjectId.is_valid(course):
+        found = await db.courses.find_one({"_id": ObjectId(course)})
+        if found:
+            return found
+    return (
+        await db.courses.find_one({"title": course, "teacher_id": teacher_id})
+        or await db.courses.find_one({"title": course})
+    )
+
+def parse_session_slot(date: str, time: str, duration: int) -> tuple:
+    if not 0 < duration <= SESSION_MAX_DURATION_MINUTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Session duration must be between 1 and {SESSION_MAX_DURATION_MINUTES} minutes"
+        )
+    try:
+        return session_bounds(date, time, duration)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Session date must be YYYY-MM-DD and time HH:mm:ss")
+
+class TeacherSchedule:
+    """Sessions ordered by start time, for overlap queries.
+
+    Only sessions starting in [start - longest duration, end) can overlap a
+    slot; both bounds are found by binary search. The longest duration is
+    tracked from the sessions added, since legacy sessions may exceed
+    SESSION_MAX_DURATION_MINUTES.
+    """
+
+    def __init__(self):
+        self.longest = timedelta(0)
+        self.starts = []
+        self.sessions = []  # (starts_at, ends_at, session ID, title), parallel to starts
+
+    def add(self, session_id: str, title: str, starts_at: datetime, ends_at: datetime):
+        index = bisect.bisect_right(self.starts, starts_at)
+        self.starts.insert(index, starts_at)
+        self.sessions.insert(index, (starts_at, ends_at, session_id, title))
+        self.longest = max(self.longest, ends_at - starts_at)
+
+    def overlapping(self, starts_at: datetime, ends_at: datetime) -> List[tuple]:
+        first = bisect.bisect_left(self.starts, starts_at - self.longest)
+        last = bisect.bisect_left(self.starts, ends_at)
+        return [session for session in self.sessions[first:last] if session[1] > starts_at]
+
+def format_conflict(session: tuple) -> dict:
+    starts_at, ends_at, session_id, title = session
+    # Plain JSON types, since conflicts are also returned in a 409 detail
+    return {"id": session_id, "title": title, "starts_at": starts_at.isoformat(), "ends_at": ends_at.isoformat()}
+
+def session_overlap_query(starts_at: datetime, ends_at: datetime) -> dict:
+    return {"ends_at": {"$gt": starts_at}, "starts_at": {"$lt": ends_at}}
+
+async def find_session_conflicts(
+    teacher_id: str, starts_at: datetime, ends_at: datetime, exclude_id: Optional[ObjectId] = None
+) -> List[dict]:
+    """Return the teacher's stored sessions overlapping a slot."""
+    query = {"teacher_id": teacher_id, **session_overlap_query(starts_at, ends_at)}
+    if exclude_id is not None:
+        query["_id"] = {"$ne": exclude_id}
+    return [
+        format_conflict((session["starts_at"], session["ends_at"], str(session["_id"]), session.get("title")))
+        async for session in db.sessions.find(query, {"title": 1, "starts_at": 1, "ends_at": 1})
+    ]
+
+async def find_schedule_conflicts(teacher_id: str, slots: List[tuple]) -> List[List[dict]]:
+    """Return the teacher's sessions overlapping each (starts_at, ends_at) slot.
+
+    All slots are answered by a single indexed query, then matched up in memory.
+    """
+    schedule = TeacherSchedule()
+    async for session in db.sessions.find(
+        {"teacher_id": teacher_id, "$or": [session_overlap_query(*slot) for slot in slots]},
+        {"title": 1, "starts_at": 1, "ends_at": 1}
+    ):
+        schedule.add(str(session["_id"]), session.get("title"), session["starts_at"], session["ends_at"])
+    return [[format_conflict(session) for session in schedule.overlapping(*slot)] for slot in slots]
 
 # Sessions Endpoints
 @app.get("/sessions/upcoming", response_model=List[Session])
-async def get_upcoming_sessions(current_user: dict = Depends(get_current_user)):
+async def get_upcoming_sessions(
+    current_user: dict = Depends(get_current_user),
+    limit: int = Query(SESSION_PAGE_SIZE, ge=1, le=SESSION_PAGE_SIZE_MAX),
+    after: Optional[str] = None
+):
+    """Sessions from the start of today, soonest first. Pass the last ID of a page as `after` for the next."""
     user_id = str(current_user["_id"])
-    today = datetime.utcnow().strftime("%Y-%m-%d")
+    local_today = datetime.now(SESSION_TIMEZONE).replace(tzinfo=None)
+    start_of_today = to_utc(datetime.combine(local_today.date(), datetime.min.time()))
 
-    query = {}
     if current_user["role"] == "student":
-        enrolled_courses = []
-        async for course in db.courses.find({"students": user_id}):
-            enrolled_courses.append(str(course["_id"]))
-            enrolled_courses.append(course["title"])
-
-        query = {
-            "date": {"$gte": today},
-            "$or": [
-                {"course_id": {"$in": enrolled_courses}},
-                {"course": {"$in": enrolled_courses}}
-            ]
-        }
+        visible = {"course_id": {"$in": await get_enrolled_course_ids(user_id)}}
     else:
-        query = {
-            "date": {"$gte": today},
-            "teacher_id": user_id
-        }
+        visible = {"teacher_id": user_id}
+    conditions = [{"starts_at": {"$gte": start_of_today}}, visible]
+
+    if after:
+        if not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail="Invalid session ID format")
+        # Only sessions the caller can see work as an anchor, so the cursor
+        # doesn't reveal whether (or when) other sessions exist
+        anchor = await db.sessions.find_one({"$and": [{"_id": ObjectId(after)}, visible]}, {"starts_at": 1})
+        if not anchor or not anchor.get("starts_at"):
+            raise HTTPException(status_code=404, detail="Session not found")
+        conditions.append({"$or": [
+            {"starts_at": {"$gt": anchor["starts_at"]}},
+            {"starts_at": anchor["starts_at"], "_id": {"$gt": anchor["_id"]}},
+        ]})
 
     sessions = []
-    async for session in db.sessions.find(query).sort("date", 1).sort("time", 1):
+    async for session in db.sessions.find({"$and": conditions}).sort(
+        [("starts_at", ASCENDING), ("_id", ASCENDING)]
+    ).limit(limit):
         session["id"] = str(session["_id"])
         sessions.append(session)
 
     return sessions
 
+def session_conflict(conflicts: List[dict]) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={
+            "message": "This session overlaps another of your sessions",
+            "conflicts": conflicts,
+        }
+    )
+
 @app.post("/sessions", response_model=Session)
 async def create_session(
     current_user: dict = Depends(get_current_user),
-    session: SessionCreate = Body(...),
-    background_tasks: BackgroundTasks = BackgroundTasks()
+    session: SessionCreate = Body(...)
 ):
     if current_user["role"] != "teacher":
         raise HTTPException(status_code=400, detail="Only teachers can create sessions")
 
+    starts_at, ends_at = parse_session_slot(session.date, session.time, session.duration)
+    teacher_id = str(current_user["_id"])
+    conflicts = await find_session_conflicts(teacher_id, starts_at, ends_at)
+    if conflicts:
+        raise session_conflict(conflicts)
+
+    # Resolve the course once, so sessions always carry a canonical course_id
+    course = None
+    if session.course:
+        course = await resolve_session_course(session.course, str(current_user["_id"]))
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
+
     session_dict = session.dict()
+    session_dict["course_id"] = str(course["_id"]) if course else None
+    session_dict["starts_at"] = starts_at
+    session_dict["ends_at"] = ends_at
     session_dict["teacher_id"] = str(current_user["_id"])
     session_dict["attendees"] = []
     session_dict["meeting_link"] = f"https://meet.jit.si/learnlive-session-{ObjectId()}"
 
     result = await db.sessions.insert_one(session_dict)
+    # A concurrent request may have inserted an overlapping session since the
+    # check above. Re-check now that ours is visible and back out on any
+    # overlap: at least one of two racing requests sees the other, so they
+    # can never both succeed
+    conflicts = await find_session_conflicts(teacher_id, starts_at, ends_at, exclude_id=result.inserted_id)
+    if conflicts:
+        await db.sessions.delete_one({"_id": result.inserted_id})
+        raise session_conflict(conflicts)
     session_id = str(result.inserted_id)
     session_dict["id"] = session_id
+    reminder_scheduler.schedule(session_id, starts_at)
+
+    student_ids = await get_course_student_ids(session_dict["course_id"]) if course else []
+    await invalidate_calendar_feeds([session_dict["teacher_id"], *student_ids])
 
     # Create notification for the teacher
     teacher_notification = {
@@ -1035,32 +4146,53 @@ async def create_session(
         "action_type": "session",
         "action_id": session_id,
     }
-    background_tasks.add_task(create_notification, teacher_notification)
-
-    # Find the course and notify enrolled students
-    if session.course:
-        course = None
-        # Try to find by ID first
-        if ObjectId.is_valid(session.course):
-            course = await db.courses.find_one({"_id": ObjectId(session.course)})
+    await create_notification(teacher_notification)
 
-        # If not found, try to find by title
-        if not course:
-            course = await db.courses.find_one({"title": session.course})
-
-        if course:
-            for student_id in course.get("students", []):
-                student_notification = {
-                    "user_id": student_id,
-                    "title": "New Live Session Scheduled",
-                    "message": f"A new session '{session.title}' has been scheduled for {session.date} at {session.time}.",
-                    "action_type": "session",
-                    "action_id": session_id,
-                }
-                background_tasks.add_task(create_notification, student_notification)
+    # Notify enrolled students
+    if course:
+        await enqueue_fan_out(student_ids, {
+            "title": "New Live Session Scheduled",
+            "message": f"A new session '{session.title}' has been scheduled for {session.date} at {session.time}.",
+            "action_type": "session",
+            "action_id": session_id,
+        }, topic=course_topic(session_dict["course_id"]))
 
     return session_dict
 
+@app.post("/sessions/conflicts")
+async def check_session_conflicts(
+    current_user: dict = Depends(get_current_user),
+    check: ScheduleCheck = Body(...)
+):
+    """Check proposed slots against the teacher's sessions and each other."""
+    if current_user["role"] != "teacher":
+        raise HTTPException(status_code=400, detail="Only teachers can check session conflicts")
+    if len(check.slots) > SCHEDULE_CHECK_MAX_SLOTS:
+        raise HTTPException(status_code=400, detail=f"At most {SCHEDULE_CHECK_MAX_SLOTS} slots per check")
+
+    slots = [parse_session_slot(slot.date, slot.time, slot.duration) for slot in check.slots]
+    conflicts = await find_schedule_conflicts(str(current_user["_id"]), slots)
+
+    # Overlaps among the proposed slots themselves
+    proposed = TeacherSchedule()
+    for index, (starts_at, ends_at) in enumerate(slots):
+        proposed.add(str(index), None, starts_at, ends_at)
+
+    results = []
+    for index, (starts_at, ends_at) in enumerate(slots):
+        overlapping_slots = sorted(
+            int(session[2]) for session in proposed.overlapping(starts_at, ends_at) if session[2] != str(index)
+        )
+        results.append({
+            "index": index,
+            "starts_at": starts_at,
+            "ends_at": ends_at,
+            "conflicts": conflicts[index],
+            "overlapping_slots": overlapping_slots,
+            "available": not conflicts[index] and not overlapping_slots,
+        })
+    return {"results": results}
+
 @app.get("/sessions/{session_id}", response_model=Session)
 async def get_session(
     session_id: str,
@@ -1074,12 +4206,8 @@ async def get_session(
     session["id"] = str(session["_id"])
 
     if current_user["role"] == "student":
-        enrolled_courses = []
-        async for course in db.courses.find({"students": str(current_user["_id"])}):
-            enrolled_courses.append(str(course["_id"]))
-            enrolled_courses.append(course["title"])
-
-        if session.get("course_id") not in enrolled_courses and session.get("course") not in enrolled_courses:
+        course_id = session.get("course_id")
+        if not course_id or not await is_enrolled(str(current_user["_id"]), course_id):
             raise HTTPException(
                 status_code=403,
                 detail="You must be enrolled in the course to access this session"
@@ -1089,16 +4217,96 @@ async def get_session(
 
 # Notification Endpoints
 @app.get("/notifications", response_model=List[Notification])
-async def get_notifications(current_user: dict = Depends(get_current_user)):
+async def get_notifications(
+    current_user: dict = Depends(get_current_user),
+    limit: int = Query(NOTIFICATION_PAGE_SIZE, ge=1, le=NOTIFICATION_PAGE_SIZE_MAX),
+    before: Optional[str] = None,
+    unread_only: bool = False
+):
+    """Newest-first notifications. Pass the last ID of a page as `before` for the next."""
     user_id = str(current_user["_id"])
 
-    notifications = []
-    async for notification in db.notifications.find({"user_id": user_id}).sort("created_at", -1):
+    query = {}
+    if unread_only:
+        query["is_read"] = False
+    if before:
+        if not ObjectId.is_valid(before):
+            raise HTTPException(status_code=400, detail="Invalid notification ID format")
+        anchor = await db.notifications.find_one(
+            {"_id": ObjectId(before), "user_id": user_id},
+            {"created_at": 1}
+        ) or await find_archived_notification(user_id, ObjectId(before))
+        if not anchor:
+            raise HTTPException(status_code=404, detail="Notification not found")
+        # Keyset on (created_at, _id): fan-outs share one created_at
+        query["$or"] = [
+            {"created_at": {"$lt": anchor["created_at"]}},
+            {"created_at": anchor["created_at"], "_id": {"$lt": anchor["_id"]}},
+        ]
+
+    notifications = await db.notifications.find({"user_id": user_id, **query}).sort(
+        [("created_at", DESCENDING), ("_id", DESCENDING)]
+    ).limit(limit).to_list(None)
+
+    # Everything archived is older than the archive cutoff, so a full page
+    # that ends after the cutoff can't be interleaved with archived items
+    archive_cutoff = datetime.utcnow() - timedelta(days=NOTIFICATION_ARCHIVE_AFTER_DAYS)
+    if len(notifications) < limit or notifications[-1]["created_at"] < archive_cutoff:
+        notifications += await find_archived_notifications(user_id, query, limit)
+        notifications.sort(key=lambda notification: (notification["created_at"], notification["_id"]), reverse=True)
+        notifications = notifications[:limit]
+
+    for notification in notifications:
         notification["id"] = str(notification["_id"])
-        notifications.append(notification)
 
     return notifications
 
+@app.get("/notifications/unread-count")
+async def read_unread_notification_count(current_user: dict = Depends(get_current_user)):
+    return {"unread": await get_unread_count(str(current_user["_id"]))}
+
+@app.get("/notifications/stream")
+async def stream_notifications(request: Request, current_user: dict = Depends(get_current_user)):
+    """Server-Sent Events stream of the current user's new notifications."""
+    user_id = str(current_user["_id"])
+    queue = notification_broker.subscribe(user_id)
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=NOTIFICATION_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Comment line keeps proxies and mobile networks from idling us out
+                    yield ": keep-alive\n\n"
+                    continue
+                message = f"event: {event['event']}\n"
+                if "id" in event:
+                    message += f"id: {event['id']}\n"
+                message += f"data: {json.dumps(event.get('data', {}))}\n\n"
+                yield message
+        finally:
+            notification_broker.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/ops/notification-stream-stats", dependencies=[Depends(require_ops_token)])
+async def get_notification_stream_stats():
+    return {
+        **notification_broker.stats,
+        "connections": notification_broker.connection_count(),
+        "users": len(notification_broker.subscribers),
+        "queue_size": notification_broker.queue_size,
+        "source": NOTIFICATION_STREAM_SOURCE,
+    }
+
 @app.put("/notifications/{notification_id}/read")
 async def mark_notification_as_read(
     notification_id: str,
@@ -1111,18 +4319,26 @@ async def mark_notification_as_read(
 
     notification = await db.notifications.find_one({"_id": ObjectId(notification_id)})
     if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
+        result = await db.notification_archive.update_one(
+            {"user_id": user_id, "items": {"$elemMatch": {"_id": ObjectId(notification_id), "is_read": False}}},
+            {"$set": {"items.$.is_read": True, "items.$.read_at": datetime.utcnow()}}
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=404, detail="Notification not found")
+        await adjust_unread_count(user_id, -1)
+        return {"message": "Notification marked as read"}
 
     if notification.get("user_id") != user_id:
         raise HTTPException(status_code=403, detail="You can only mark your own notifications as read")
 
     result = await db.notifications.update_one(
-        {"_id": ObjectId(notification_id)},
-        {"$set": {"is_read": True}}
+        {"_id": ObjectId(notification_id), "is_read": False},
+        {"$set": {"is_read": True, "read_at": datetime.utcnow()}}
     )
 
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Notification not found or already marked as read")
+    await adjust_unread_count(user_id, -1)
 
     return {"message": "Notification marked as read"}
 
@@ -1130,12 +4346,28 @@ async def mark_notification_as_read(
 async def mark_all_notifications_as_read(current_user: dict = Depends(get_current_user)):
     user_id = str(current_user["_id"])
 
+    read_at = datetime.utcnow()
     result = await db.notifications.update_many(
         {"user_id": user_id, "is_read": False},
-        {"$set": {"is_read": True}}
+        {"$set": {"is_read": True, "read_at": read_at}}
     )
+    marked = result.modified_count
+
+    async for row in db.notification_archive.aggregate([
+        {"$match": {"user_id": user_id, "items.is_read": False}},
+        {"$unwind": "$items"},
+        {"$match": {"items.is_read": False}},
+        {"$count": "unread"},
+    ]):
+        marked += row["unread"]
+        await db.notification_archive.update_many(
+            {"user_id": user_id, "items.is_read": False},
+            {"$set": {"items.$[item].is_read": True, "items.$[item].read_at": read_at}},
+            array_filters=[{"item.is_read": False}]
+        )
+    await adjust_unread_count(user_id, -marked)
 
-    return {"message": f"Marked {result.modified_count} notifications as read"}
+    return {"message": f"Marked {marked} notifications as read"}
 
 @app.delete("/notifications/{notification_id}")
 async def delete_notification(
@@ -1149,15 +4381,26 @@ async def delete_notification(
 
     notification = await db.notifications.find_one({"_id": ObjectId(notification_id)})
     if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
+        bucket = await db.notification_archive.find_one_and_update(
+            {"user_id": user_id, "items._id": ObjectId(notification_id)},
+            {"$pull": {"items": {"_id": ObjectId(notification_id)}}},
+            projection={"items": {"$elemMatch": {"_id": ObjectId(notification_id)}}}
+        )
+        if not bucket:
+            raise HTTPException(status_code=404, detail="Notification not found")
+        if not bucket["items"][0].get("is_read"):
+            await adjust_unread_count(user_id, -1)
+        return {"message": "Notification deleted successfully"}
 
     if notification.get("user_id") != user_id:
         raise HTTPException(status_code=403, detail="You can only delete your own notifications")
 
-    result = await db.notifications.delete_one({"_id": ObjectId(notification_id)})
+    deleted = await db.notifications.find_one_and_delete({"_id": ObjectId(notification_id)})
 
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Notification not found")
+    if not deleted.get("is_read"):
+        await adjust_unread_count(user_id, -1)
 
     return {"message": "Notification deleted successfully"}
 
@@ -1180,16 +4423,376 @@ async def register_device_token(
         }},
         upsert=True
     )
+    await enqueue_topic_subscriptions([user_id], await get_user_topics(user_id))
 
     return {"message": "Device token registered successfully"}
 
+@app.on_event("startup")
+async def start_inline_outbox_worker():
+    if OUTBOX_INLINE_WORKER:
+        asyncio.create_task(run_outbox_worker())
+        asyncio.create_task(run_background_migrations())
+
+@app.on_event("startup")
+async def start_notification_stream_bridge():
+    if NOTIFICATION_STREAM_SOURCE == "change_stream":
+        asyncio.create_task(watch_notification_inserts())
+    elif not OUTBOX_INLINE_WORKER:
+        logger.warning(
+            "NOTIFICATION_STREAM_SOURCE=local without OUTBOX_INLINE_WORKER=1: notifications "
+            "delivered by worker.py won't reach this process's notification streams"
+        )
+
+@app.on_event("startup")
+async def start_upload_session_cleanup():
+    asyncio.create_task(run_periodically(UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS, cleanup_stale_upload_sessions))
+
+@app.on_event("startup")
+async def start_upload_sweeper():
+    if SWEEPER_INTERVAL_SECONDS > 0:
+        asyncio.create_task(run_periodically(SWEEPER_INTERVAL_SECONDS, sweep_orphaned_uploads_job))
+
+@app.on_event("startup")
+async def start_session_reminders():
+    if SESSION_REMINDERS:
+        asyncio.create_task(reminder_scheduler.run())
+
+@app.on_event("startup")
+async def start_notification_archiver():
+    if NOTIFICATION_ARCHIVE_INTERVAL_SECONDS > 0:
+        asyncio.create_task(run_periodically(NOTIFICATION_ARCHIVE_INTERVAL_SECONDS, archive_old_notifications))
+
+@app.on_event("shutdown")
+async def shutdown_executors():
+    password_executor.shutdown(wait=False)
+    fcm_executor.shutdown(wait=False)
+    if derivative_executor is not None:
+        derivative_executor.shutdown(wait=False)
+
+@app.get("/ops/storage-stats", dependencies=[Depends(require_ops_token)])
+async def read_storage_stats():
+    return await get_storage_stats()
+
 # Root endpoint
 @app.get("/")
 async def root():
     return {"message": "Welcome to LearnLive API"}
 
-# Static files serving
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Media serving
+class MediaFileResponse(Response):
+    """Send a byte range of a file.
+
+    Uses the ASGI zero-copy send extension (sendfile) when the server offers
+    it, otherwise streams the range in chunks read off the event loop.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.send_body = send_body
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        length = self.end - self.start + 1
+        if not self.send_body or length <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.start,
+                    "count": length,
+                })
+            return
+
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.start)
+            remaining = length
+            while remaining > 0:
+                chunk = await f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[tuple]:
+    """Parse a single-range "bytes=" header into (start, end).
+
+    Returns None when the header should be ignored (not bytes, multiple
+    ranges or malformed) and raises 416 when the range is unsatisfiable.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    start_text, _, end_text = ranges.strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
+        else:
+            suffix_length = int(end_text)
+            if suffix_length <= 0:
+                raise HTTPException(
+                    status_code=416,
+                    detail="Requested range not satisfiable",
+                    headers={"Content-Range": f"bytes */{file_size}"}
+                )
+            start = max(file_size - suffix_length, 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    if start > end:
+        return None
+    return start, min(end, file_size - 1)
+
+def is_not_modified(request: Request, etag: str, modified_timestamp: float) -> bool:
+    # Conditional requests: If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(modified_timestamp) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return False
+
+@app.api_route("/uploads/{file_name}", methods=["GET", "HEAD"])
+async def serve_upload(file_name: str, request: Request):
+    # Dotfiles are in-progress uploads and never served
+    if file_name.startswith("."):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = os.path.join(UPLOAD_DIR, file_name)
+    try:
+        stat_result = os.stat(file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    file_size = stat_result.st_size
+    stem = Path(file_name).stem
+    if CONTENT_ADDRESSED_NAME.match(stem):
+        etag = f'"{stem}"'
+    else:
+        etag = f'"{file_size:x}-{int(stat_result.st_mtime):x}"'
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": MEDIA_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Type"] = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    send_body = request.method == "GET"
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+        byte_range = parse_byte_range(range_header, file_size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(file_size)
+        return MediaFileResponse(file_path, 0, file_size - 1, 200, headers, send_body)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return MediaFileResponse(file_path, start, end, 206, headers, send_body)
+
+# Calendar feeds
+# Rendered feeds are cached per worker, stamped with the user's
+# calendar_version. A token is looked up in users at most once per
+# CALENDAR_TOKEN_RECHECK_SECONDS per worker (calendar_tokens); each lookup
+# catches a reset token or a version bump made on any worker. Changes made on
+# this worker drop its cached feed, so they show up at once.
+calendar_cache = TTLCache(maxsize=CALENDAR_CACHE_MAX_SIZE, ttl=CALENDAR_CACHE_TTL_SECONDS)
+calendar_tokens = TTLCache(maxsize=CALENDAR_CACHE_MAX_SIZE, ttl=CALENDAR_TOKEN_RECHECK_SECONDS)
+
+async def invalidate_calendar_feeds(user_ids: List[str]):
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return
+    await db.users.update_many(
+        {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]}},
+        {"$inc": {"calendar_version": 1}, "$set": {"calendar_changed_at": datetime.utcnow().replace(microsecond=0)}}
+    )
+    for user_id in user_ids:
+        calendar_cache.pop(user_id, None)
+
+def ical_escape(text: str) -> str:
+    return (
+        str(text or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+def ical_fold(line: str) -> str:
+    # Content lines are limited to 75 octets; continuations start with a space
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(encoded))
+        # Never split a multi-byte UTF-8 character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    return "\r\n ".join(parts)
+
+def ical_datetime(value: datetime) -> str:
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+def session_stamp(session: dict) -> datetime:
+    # When the session was created; sessions aren't edited in place
+    return session["_id"].generation_time.replace(tzinfo=None)
+
+def render_calendar(sessions: List[dict]) -> str:
+    # DTSTAMP comes from the session, not the render time, so the same
+    # sessions always render to the same bytes (and ETag)
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//LearnLive//Sessions//EN",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        "X-WR-CALNAME:LearnLive sessions",
+    ]
+    for session in sessions:
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{session['_id']}@learnlive",
+            f"DTSTAMP:{ical_datetime(session_stamp(session))}",
+            f"DTSTART:{ical_datetime(session['starts_at'])}",
+            f"DTEND:{ical_datetime(session['ends_at'])}",
+            f"SUMMARY:{ical_escape(session.get('title'))}",
+            f"DESCRIPTION:{ical_escape(session.get('description'))}",
+        ]
+        if session.get("meeting_link"):
+            lines += [
+                f"URL:{session['meeting_link']}",
+                f"LOCATION:{ical_escape(session['meeting_link'])}",
+            ]
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(ical_fold(line) for line in lines) + "\r\n"
+
+async def build_calendar_feed(user: dict) -> dict:
+    user_id = str(user["_id"])
+    # Last-Modified is the newest change the feed reflects: a session, an
+    # enrollment, or anything that invalidated it (e.g. a deleted course)
+    changes = [user["_id"].generation_time.replace(tzinfo=None)]
+    if user.get("calendar_changed_at"):
+        changes.append(user["calendar_changed_at"])
+
+    query = {"starts_at": {"$gte": datetime.utcnow() - timedelta(days=CALENDAR_PAST_DAYS)}}
+    if user["role"] == "student":
+        enrollments = await db.enrollments.find({"user_id": user_id}, {"course_id": 1, "enrolled_at": 1}).to_list(None)
+        query["course_id"] = {"$in": [enrollment["course_id"] for enrollment in enrollments]}
+        changes += [enrollment["enrolled_at"] for enrollment in enrollments if enrollment.get("enrolled_at")]
+    else:
+        query["teacher_id"] = user_id
+
+    sessions = await db.sessions.find(
+        query,
+        {"title": 1, "description": 1, "starts_at": 1, "ends_at": 1, "meeting_link": 1}
+    ).sort([("starts_at", ASCENDING), ("_id", ASCENDING)]).limit(CALENDAR_MAX_EVENTS).to_list(None)
+    changes += [session_stamp(session) for session in sessions]
+
+    body = render_calendar(sessions).encode("utf-8")
+    return {
+        "token": user["calendar_token"],
+        "version": user.get("calendar_version", 0),
+        "body": body,
+        "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        "last_modified": max(changes).replace(microsecond=0, tzinfo=timezone.utc).timestamp(),
+    }
+
+def calendar_feed_url(request: Request, token: str) -> str:
+    return str(request.url_for("get_calendar_feed", token=token))
+
+@app.get("/users/me/calendar-feed")
+async def get_calendar_feed_url(request: Request, current_user: dict = Depends(get_current_user)):
+    token = current_user.get("calendar_token")
+    if not token:
+        token = secrets.token_urlsafe(24)
+        # Only set it if no concurrent request did first
+        await db.users.update_one(
+            {"_id": ObjectId(current_user["_id"]), "calendar_token": {"$exists": False}},
+            {"$set": {"calendar_token": token}}
+        )
+        user = await db.users.find_one({"_id": ObjectId(current_user["_id"])}, {"calendar_token": 1})
+        token = user["calendar_token"]
+        invalidate_cached_user(current_user["email"])
+    return {"url": calendar_feed_url(request, token)}
+
+@app.post("/users/me/calendar-feed/reset")
+async def reset_calendar_feed_url(request: Request, current_user: dict = Depends(get_current_user)):
+    # Rotating the token revokes every subscribed copy of the old URL
+    token = secrets.token_urlsafe(24)
+    await db.users.update_one(
+        {"_id": ObjectId(current_user["_id"])},
+        {"$set": {"calendar_token": token}}
+    )
+    invalidate_cached_user(current_user["email"])
+    await invalidate_calendar_feeds([str(current_user["_id"])])
+    return {"url": calendar_feed_url(request, token)}
+
+@app.get("/calendar/{token}.ics")
+async def get_calendar_feed(token: str, request: Request):
+    """Unauthenticated iCalendar feed of a user's sessions; the token is the credential."""
+    user_id = calendar_tokens.get(token)
+    feed = calendar_cache.get(user_id) if user_id else None
+    if feed is None or feed["token"] != token:
+        user = await db.users.find_one(
+            {"calendar_token": token},
+            {"role": 1, "calendar_token": 1, "calendar_version": 1, "calendar_changed_at": 1}
+        )
+        if not user:
+            calendar_tokens.pop(token, None)
+            raise HTTPException(status_code=404, detail="Calendar not found")
+        user_id = str(user["_id"])
+
+        feed = calendar_cache.get(user_id)
+        if feed is None or feed["token"] != token or feed["version"] != user.get("calendar_version", 0):
+            feed = await build_calendar_feed(user)
+            calendar_cache[user_id] = feed
+        calendar_tokens[token] = user_id
+
+    headers = {
+        "ETag": feed["etag"],
+        "Last-Modified": formatdate(feed["last_modified"], usegmt=True),
+        "Cache-Control": "private, max-age=300",
+    }
+    if is_not_modified(request, feed["etag"], feed["last_modified"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=feed["body"], media_type="text/calendar; charset=utf-8", headers=headers)
 
 # Port finding and server startup
 def find_available_port(start_port: int, max_port: int = 65535) -> Optional[int]:
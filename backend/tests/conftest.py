@@ -0,0 +1,137 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+import mongomock.collection
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+# main creates its uploads/ directories relative to the working directory
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="learnlive-tests-"))
+try:
+    import main
+finally:
+    os.chdir(_cwd)
+
+# Newer pymongo passes sort= to bulk updates, which mongomock doesn't accept
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+mongomock.collection.BulkOperationBuilder.add_update = (
+    lambda self, *args, sort=None, **kwargs: _add_update(self, *args, **kwargs)
+)
+
+
+class FakeMulticastResponse:
+    def __init__(self, size):
+        self.success_count = size
+        self.failure_count = 0
+        self.responses = []
+
+
+class FakeMessaging:
+    """Records FCM sends instead of making them.
+
+    Sends fail with fail_with when set, take delay seconds, and while hang is
+    set they block until it is cleared, then fail like a dropped connection.
+    """
+
+    def __init__(self):
+        self.topic_sends = []
+        self.multicasts = []
+        self.fail_with = None
+        self.delay = 0
+        self.hang = threading.Event()
+        self.unhung = threading.Event()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def call(self, sent, message):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.hang.is_set():
+                self.unhung.wait(5)
+                raise ConnectionError("connection reset by FCM")
+            time.sleep(self.delay)
+            if self.fail_with:
+                raise self.fail_with
+            sent.append(message)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def release(self):
+        # Let hung sends finish, and wait until they have
+        self.hang.clear()
+        self.unhung.set()
+        while self.in_flight:
+            time.sleep(0.01)
+        self.unhung.clear()
+
+    def send(self, message):
+        self.call(self.topic_sends, message)
+
+    def send_multicast(self, message):
+        self.call(self.multicasts, message)
+        return FakeMulticastResponse(len(message["tokens"]))
+
+    def pushes_per_user(self, tokens_by_user, topic_members):
+        pushes = {user_id: 0 for user_id in tokens_by_user}
+        for message in self.multicasts:
+            for user_id, token in tokens_by_user.items():
+                pushes[user_id] += message["tokens"].count(token)
+        for message in self.topic_sends:
+            for user_id in topic_members.get(message["topic"], []):
+                pushes[user_id] += 1
+        return pushes
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = mongomock_motor.AsyncMongoMockClient()["learnlive_test"]
+    monkeypatch.setattr(main, "db", database)
+    asyncio.run(main.ensure_indexes())
+    return database
+
+
+@pytest.fixture
+def fcm(monkeypatch):
+    messaging = FakeMessaging()
+    # A fresh semaphore per test, since each test runs its own event loop
+    monkeypatch.setattr(main, "fcm_semaphore", asyncio.Semaphore(main.FCM_MAX_CONCURRENCY))
+    # firebase_admin may not be installed, in which case main has no messaging
+    monkeypatch.setattr(main, "messaging", messaging, raising=False)
+    monkeypatch.setattr(main, "firebase_enabled", True)
+    monkeypatch.setattr(
+        main, "build_multicast_message",
+        lambda tokens, title, body, data: {"tokens": list(tokens), "title": title}
+    )
+    monkeypatch.setattr(
+        main, "build_topic_message",
+        lambda topic, title, body, data: {"topic": topic, "title": title}
+    )
+    yield messaging
+    messaging.release()
+
+
+@pytest.fixture
+def drain_outbox(db):
+    async def drain(worker_id="test-worker"):
+        # Run queued outbox jobs until none is due
+        while True:
+            job = await main.claim_outbox_job(worker_id)
+            if job is None:
+                return
+            await main.process_outbox_job(job)
+    return drain
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from cachetools import TTLCache
+from starlette.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Drives the token recheck interval
+    now = [0.0]
+    monkeypatch.setattr(main, "calendar_tokens", TTLCache(
+        maxsize=100, ttl=main.CALENDAR_TOKEN_RECHECK_SECONDS, timer=lambda: now[0]
+    ))
+
+    def advance(seconds):
+        now[0] += seconds
+    return advance
+
+
+@pytest.fixture
+def calendar(db, clock):
+    teacher_id, student_id, course_id = ObjectId(), ObjectId(), "course-1"
+
+    async def insert():
+        await db.users.insert_many([
+            {"_id": teacher_id, "email": "teacher@example.com", "role": "teacher", "calendar_token": "teacher-token"},
+            {"_id": student_id, "email": "student@example.com", "role": "student", "calendar_token": "student-token"},
+        ])
+        await db.sessions.insert_one({
+            "title": "Algebra",
+            "teacher_id": str(teacher_id),
+            "course_id": course_id,
+            "starts_at": datetime.utcnow() + timedelta(days=1),
+            "ends_at": datetime.utcnow() + timedelta(days=1, hours=1),
+        })
+    asyncio.run(insert())
+    main.calendar_cache.clear()
+    yield {"teacher_id": str(teacher_id), "student_id": str(student_id), "course_id": course_id}
+    main.calendar_cache.clear()
+
+
+def test_reset_token_is_revoked_on_every_worker(db, calendar, clock):
+    client = TestClient(main.app)
+    assert client.get("/calendar/teacher-token.ics").status_code == 200
+
+    # Reset handled by another worker: this one's cache still holds the feed
+    asyncio.run(db.users.update_one({"calendar_token": "teacher-token"}, {"$set": {"calendar_token": "new-token"}}))
+
+    clock(main.CALENDAR_TOKEN_RECHECK_SECONDS + 1)
+    assert client.get("/calendar/teacher-token.ics").status_code == 404
+    assert client.get("/calendar/new-token.ics").status_code == 200
+
+
+def test_etag_and_last_modified_only_change_with_the_data(db, calendar):
+    client = TestClient(main.app)
+    first = client.get("/calendar/teacher-token.ics")
+    main.calendar_cache.clear()
+    second = client.get("/calendar/teacher-token.ics")
+
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert first.headers["Last-Modified"] == second.headers["Last-Modified"]
+    assert client.get(
+        "/calendar/teacher-token.ics", headers={"If-None-Match": first.headers["ETag"]}
+    ).status_code == 304
+
+
+def test_enrollment_on_another_worker_shows_up_in_the_feed(db, calendar, clock):
+    client = TestClient(main.app)
+    # This worker has cached the student's (empty) feed
+    assert b"Algebra" not in client.get("/calendar/student-token.ics").content
+
+    async def enroll_elsewhere():
+        await db.enrollments.insert_one({
+            "course_id": calendar["course_id"],
+            "user_id": calendar["student_id"],
+            "enrolled_at": datetime.utcnow(),
+        })
+        await db.users.update_one(
+            {"_id": ObjectId(calendar["student_id"])},
+            {"$inc": {"calendar_version": 1}, "$set": {"calendar_changed_at": datetime.utcnow()}}
+        )
+    asyncio.run(enroll_elsewhere())
+
+    clock(main.CALENDAR_TOKEN_RECHECK_SECONDS + 1)
+    assert b"Algebra" in client.get("/calendar/student-token.ics").content
+
+
+def test_revalidation_within_the_recheck_interval_skips_mongo(db, calendar, clock):
+    client = TestClient(main.app)
+    etag = client.get("/calendar/teacher-token.ics").headers["ETag"]
+
+    # With users unreachable, the worker still answers from memory
+    asyncio.run(db.users.delete_many({}))
+    clock(main.CALENDAR_TOKEN_RECHECK_SECONDS - 1)
+    assert client.get("/calendar/teacher-token.ics", headers={"If-None-Match": etag}).status_code == 304
+
+    clock(2)
+    assert client.get("/calendar/teacher-token.ics", headers={"If-None-Match": etag}).status_code == 404
+
+
+def test_reset_on_this_worker_revokes_at_once(db, calendar):
+    client = TestClient(main.app)
+    assert client.get("/calendar/teacher-token.ics").status_code == 200
+
+    teacher = {"_id": calendar["teacher_id"], "email": "teacher@example.com"}
+    main.app.dependency_overrides[main.get_current_user] = lambda: teacher
+    try:
+        assert client.post("/users/me/calendar-feed/reset").status_code == 200
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
+
+    assert client.get("/calendar/teacher-token.ics").status_code == 404
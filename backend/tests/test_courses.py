@@ -0,0 +1,86 @@
+import asyncio
+
+from starlette.testclient import TestClient
+
+import main
+
+
+def test_courses_filter_by_teacher_across_pages(db):
+    async def insert():
+        await db.courses.insert_many([
+            {
+                "title": f"Course {index}",
+                "description": "",
+                "price": 0,
+                "grade": "6",
+                "teacher_id": "teacher-1" if index % 3 == 0 else "teacher-2",
+                "teacher_name": "Teacher",
+                "created_at": main.datetime.utcnow(),
+            }
+            for index in range(30)
+        ])
+    asyncio.run(insert())
+    main.app.dependency_overrides[main.get_current_user] = lambda: {"_id": "teacher-1"}
+    client = TestClient(main.app)
+
+    try:
+        titles, cursor = [], None
+        while True:
+            params = {"teacher_id": "teacher-1", "limit": 4, **({"cursor": cursor} if cursor else {})}
+            page = client.get("/courses", params=params).json()
+            titles += [course["title"] for course in page["items"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
+
+    assert sorted(titles) == sorted(f"Course {index}" for index in range(0, 30, 3))
+
+
+def test_enrollment_on_another_worker_is_listed_at_once(db):
+    student = {"_id": "student-1", "role": "student"}
+
+    async def insert_course():
+        course = await db.courses.insert_one({
+            "title": "Algebra",
+            "description": "",
+            "price": 0,
+            "grade": "6",
+            "teacher_id": "teacher-1",
+            "teacher_name": "Teacher",
+            "created_at": main.datetime.utcnow(),
+        })
+        course_id = str(course.inserted_id)
+        await db.sessions.insert_one({
+            "title": "Algebra live",
+            "description": "",
+            "date": "2099-01-01",
+            "time": "10:00",
+            "duration": 60,
+            "teacher": "Teacher",
+            "teacher_id": "teacher-1",
+            "course_id": course_id,
+            "starts_at": main.datetime(2099, 1, 1, 10),
+            "ends_at": main.datetime(2099, 1, 1, 11),
+        })
+        return course_id
+    course_id = asyncio.run(insert_course())
+
+    main.app.dependency_overrides[main.get_current_user] = lambda: student
+    client = TestClient(main.app)
+    try:
+        assert client.get("/course/enrolled").json() == []
+        assert client.get("/sessions/upcoming").json() == []
+
+        # Enrolled by another worker, or by a migration
+        asyncio.run(db.enrollments.insert_one({
+            "course_id": course_id,
+            "user_id": "student-1",
+            "enrolled_at": main.datetime.utcnow(),
+        }))
+
+        assert [course["title"] for course in client.get("/course/enrolled").json()] == ["Algebra"]
+        assert [session["title"] for session in client.get("/sessions/upcoming").json()] == ["Algebra live"]
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
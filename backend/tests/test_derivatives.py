@@ -0,0 +1,83 @@
+import asyncio
+
+from bson import ObjectId
+
+import main
+
+SOURCE = "a" * 64
+THUMBNAIL = "b" * 64
+PREVIEW = "c" * 64
+
+
+def store(db, *sha256s):
+    async def insert():
+        await db.stored_files.insert_many([
+            {"_id": sha256, "file_url": f"/uploads/{sha256}.png", "ref_count": 1, "size": 10}
+            for sha256 in sha256s
+        ])
+    asyncio.run(insert())
+
+
+def test_releasing_the_last_reference_releases_derivatives(db):
+    store(db, SOURCE, THUMBNAIL, PREVIEW)
+
+    async def scenario():
+        await db.derivatives.insert_one({
+            "_id": SOURCE,
+            "thumbnail_url": f"/uploads/{THUMBNAIL}.png",
+            "preview_url": f"/uploads/{PREVIEW}.png",
+        })
+        await main.release_file(f"/uploads/{SOURCE}.pdf")
+        return await db.derivatives.count_documents({}), await db.stored_files.count_documents({})
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_shared_source_keeps_its_derivatives(db):
+    store(db, SOURCE, THUMBNAIL)
+
+    async def scenario():
+        await db.stored_files.update_one({"_id": SOURCE}, {"$set": {"ref_count": 2}})
+        await db.derivatives.insert_one({"_id": SOURCE, "thumbnail_url": f"/uploads/{THUMBNAIL}.png"})
+        await main.release_file(f"/uploads/{SOURCE}.pdf")
+        return await db.derivatives.count_documents({}), await db.stored_files.count_documents({})
+
+    assert asyncio.run(scenario()) == (1, 2)
+
+
+def test_render_finishing_after_the_source_was_deleted_is_released(db, monkeypatch):
+    store(db, THUMBNAIL)
+    material_id = ObjectId()
+
+    async def build_derivatives(cache_id, file_url, kind):
+        return {"_id": cache_id, "thumbnail_url": f"/uploads/{THUMBNAIL}.png"}
+
+    monkeypatch.setattr(main, "build_derivatives", build_derivatives)
+
+    async def scenario():
+        await main.generate_derivatives({
+            "collection": "course_materials",
+            "document_id": str(material_id),
+            "file_url": f"/uploads/{SOURCE}.pdf",
+            "kind": "document",
+        })
+        return await db.derivatives.count_documents({}), await db.stored_files.count_documents({})
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_migration_releases_orphaned_derivatives(db):
+    store(db, SOURCE, THUMBNAIL, PREVIEW)
+
+    async def scenario():
+        await db.derivatives.insert_many([
+            {"_id": SOURCE, "thumbnail_url": f"/uploads/{THUMBNAIL}.png"},
+            {"_id": "d" * 64, "thumbnail_url": f"/uploads/{PREVIEW}.png"},
+        ])
+        await main.release_orphaned_derivatives()
+        return await db.derivatives.distinct("_id"), await db.stored_files.distinct("_id")
+
+    derivative_ids, stored_ids = asyncio.run(scenario())
+
+    assert derivative_ids == [SOURCE]
+    assert sorted(stored_ids) == [SOURCE, THUMBNAIL]
@@ -0,0 +1,127 @@
+import asyncio
+
+import main
+
+
+def add_students(db, count):
+    tokens = {f"student-{index}": f"token-{index}" for index in range(count)}
+
+    async def insert():
+        await db.device_tokens.insert_many([
+            {"user_id": user_id, "device_token": token} for user_id, token in tokens.items()
+        ])
+    asyncio.run(insert())
+    return tokens
+
+
+def test_topic_fan_out_pushes_each_user_once(db, fcm, drain_outbox, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_FAN_OUT_CHUNK_SIZE", 2)
+    tokens = add_students(db, 5)
+    topic = main.course_topic("course-1")
+
+    async def scenario():
+        await main.enqueue_fan_out(list(tokens), {"title": "New material", "message": "Notes"}, topic=topic)
+        await drain_outbox()
+
+    asyncio.run(scenario())
+
+    assert fcm.pushes_per_user(tokens, {topic: list(tokens)}) == {user_id: 1 for user_id in tokens}
+    assert len(fcm.topic_sends) == 1
+    assert fcm.multicasts == []
+    assert asyncio.run(db.notifications.count_documents({})) == 5
+
+
+def test_fan_out_without_topic_multicasts_each_user_once(db, fcm, drain_outbox, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_FAN_OUT_CHUNK_SIZE", 2)
+    tokens = add_students(db, 5)
+
+    async def scenario():
+        await main.enqueue_fan_out(list(tokens), {"title": "Reminder", "message": "Soon"})
+        await drain_outbox()
+
+    asyncio.run(scenario())
+
+    assert fcm.pushes_per_user(tokens, {}) == {user_id: 1 for user_id in tokens}
+    assert fcm.topic_sends == []
+
+
+def test_coalesced_topic_fan_outs_push_once(db, fcm, drain_outbox):
+    tokens = add_students(db, 3)
+    topic = main.course_topic("course-1")
+    notification = {
+        "title": "New material",
+        "message": "Notes",
+        "action_type": "material",
+        "coalesce_id": "course-1",
+    }
+
+    async def scenario():
+        for _ in range(3):
+            await main.enqueue_fan_out(list(tokens), notification, topic=topic)
+        await drain_outbox()
+
+    asyncio.run(scenario())
+
+    assert fcm.pushes_per_user(tokens, {topic: list(tokens)}) == {user_id: 1 for user_id in tokens}
+    counts = asyncio.run(db.notifications.distinct("count"))
+    assert counts == [3]
+
+
+def test_retried_fan_out_job_does_not_duplicate(db, fcm):
+    tokens = add_students(db, 3)
+
+    async def scenario():
+        for _ in range(2):
+            await main.fan_out_notifications(list(tokens), {"title": "Hi", "message": "There"}, job_id="job-1")
+
+    asyncio.run(scenario())
+
+    assert asyncio.run(db.notifications.count_documents({})) == 3
+    assert fcm.pushes_per_user(tokens, {}) == {user_id: 1 for user_id in tokens}
+    counters = asyncio.run(db.notification_counters.find().to_list(None))
+    assert {counter["_id"]: counter["unread"] for counter in counters} == {user_id: 1 for user_id in tokens}
+
+
+def test_retried_topic_push_job_does_not_resend(db, fcm):
+    async def scenario():
+        for _ in range(2):
+            await main.send_topic_push("course-1", {"title": "Hi", "message": "There"}, job_id="job-1")
+
+    asyncio.run(scenario())
+
+    assert len(fcm.topic_sends) == 1
+
+
+def test_failed_topic_push_releases_its_claim(db, fcm):
+    notification = {"title": "Hi", "message": "There", "action_type": "material", "action_id": "m1"}
+
+    async def scenario():
+        fcm.fail_with = RuntimeError("FCM unavailable")
+        try:
+            await main.send_topic_push("course-1", notification, job_id="job-1")
+        except RuntimeError:
+            pass
+        fcm.fail_with = None
+        await main.send_topic_push("course-1", notification, job_id="job-1")
+
+    asyncio.run(scenario())
+
+    assert len(fcm.topic_sends) == 1
+
+
+def test_different_events_on_one_course_are_not_coalesced(db):
+    events = [
+        {"title": "Course Updated", "message": "Algebra was updated", "action_type": "course", "action_id": "course-1"},
+        {"title": "New Student Enrolled", "message": "Ann enrolled", "action_type": "course", "action_id": "course-1"},
+        {"title": "New Student Enrolled", "message": "Bob enrolled", "action_type": "course", "action_id": "course-1"},
+    ]
+
+    async def scenario():
+        for event in events:
+            await main.write_notifications(["teacher-1"], event, main.datetime.utcnow())
+        return await db.notifications.find({}, {"title": 1, "message": 1, "count": 1, "_id": 0}).sort("title").to_list(None)
+
+    assert asyncio.run(scenario()) == [
+        {"title": "Course Updated", "message": "Algebra was updated", "count": 1},
+        {"title": "New Student Enrolled", "message": "Bob enrolled", "count": 2},
+    ]
@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime
+
+import main
+
+
+def add_students(db, count):
+    tokens = {f"student-{index}": f"token-{index}" for index in range(count)}
+
+    async def insert():
+        await db.device_tokens.insert_many([
+            {"user_id": user_id, "device_token": token} for user_id, token in tokens.items()
+        ])
+    asyncio.run(insert())
+    return tokens
+
+
+def retry_now(db):
+    # Skip the backoff of failed jobs
+    asyncio.run(db.notification_outbox.update_many({"status": "pending"}, {"$set": {"available_at": datetime.utcnow()}}))
+
+
+def outbox_jobs(db):
+    return asyncio.run(db.notification_outbox.find({}, {"status": 1, "attempts": 1, "last_error": 1}).to_list(None))
+
+
+def test_hanging_fcm_times_out_releases_the_semaphore_and_retries(db, fcm, drain_outbox, monkeypatch):
+    monkeypatch.setattr(main, "FCM_SEND_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(main, "FCM_MULTICAST_BATCH_SIZE", 2)
+    monkeypatch.setattr(main, "fcm_semaphore", asyncio.Semaphore(2))
+    tokens = add_students(db, 5)
+    fcm.hang.set()
+
+    async def fan_out():
+        await main.enqueue_fan_out(list(tokens), {"title": "Reminder", "message": "Soon"})
+        await drain_outbox()
+
+    asyncio.run(fan_out())
+
+    [job] = outbox_jobs(db)
+    assert (job["status"], job["attempts"]) == ("pending", 1)
+    assert "Push failed for 5 of 5 recipients" in job["last_error"]
+    assert main.fcm_semaphore._value == 2
+    assert fcm.multicasts == []
+
+    fcm.release()
+    retry_now(db)
+    # The next run is a new event loop, as after a worker restart
+    monkeypatch.setattr(main, "fcm_semaphore", asyncio.Semaphore(2))
+    asyncio.run(drain_outbox())
+
+    assert [job["status"] for job in outbox_jobs(db)] == ["done"]
+    assert fcm.pushes_per_user(tokens, {}) == {user_id: 1 for user_id in tokens}
+    assert asyncio.run(db.notifications.count_documents({})) == 5
+
+
+def test_erroring_fcm_retries_only_the_failed_recipients(db, fcm, drain_outbox, monkeypatch):
+    monkeypatch.setattr(main, "FCM_MULTICAST_BATCH_SIZE", 2)
+    tokens = add_students(db, 4)
+    calls = []
+    send_multicast = fcm.send_multicast
+
+    def flaky_send_multicast(message):
+        calls.append(message)
+        if len(calls) == 1:
+            raise RuntimeError("UNAVAILABLE")
+        return send_multicast(message)
+    fcm.send_multicast = flaky_send_multicast
+
+    async def fan_out():
+        await main.enqueue_fan_out(list(tokens), {"title": "Reminder", "message": "Soon"})
+        await drain_outbox()
+
+    asyncio.run(fan_out())
+    assert outbox_jobs(db)[0]["status"] == "pending"
+
+    retry_now(db)
+    asyncio.run(drain_outbox())
+
+    assert [job["status"] for job in outbox_jobs(db)] == ["done"]
+    # The first batch failed and was resent; the second was sent once
+    assert fcm.pushes_per_user(tokens, {}) == {user_id: 1 for user_id in tokens}
+    assert len(calls) == 3
+
+
+def test_erroring_fcm_retries_a_single_notification_push(db, fcm, drain_outbox):
+    tokens = add_students(db, 1)
+    fcm.fail_with = RuntimeError("UNAVAILABLE")
+
+    async def notify():
+        await main.create_notification({"user_id": "student-0", "title": "Hi", "message": "There"})
+        await drain_outbox()
+
+    asyncio.run(notify())
+    [job] = outbox_jobs(db)
+    assert (job["status"], job["last_error"]) == ("pending", "UNAVAILABLE")
+    assert fcm.multicasts == []
+
+    fcm.fail_with = None
+    retry_now(db)
+    asyncio.run(drain_outbox())
+
+    assert [job["status"] for job in outbox_jobs(db)] == ["done"]
+    assert fcm.pushes_per_user(tokens, {}) == {"student-0": 1}
+    assert asyncio.run(db.notifications.count_documents({})) == 1
+
+
+def test_slow_fcm_calls_are_bounded_by_the_semaphore(db, fcm, drain_outbox, monkeypatch):
+    monkeypatch.setattr(main, "FCM_MULTICAST_BATCH_SIZE", 1)
+    monkeypatch.setattr(main, "fcm_semaphore", asyncio.Semaphore(2))
+    tokens = add_students(db, 6)
+    fcm.delay = 0.05
+
+    async def fan_out():
+        await main.enqueue_fan_out(list(tokens), {"title": "Reminder", "message": "Soon"})
+        await drain_outbox()
+
+    asyncio.run(fan_out())
+
+    assert [job["status"] for job in outbox_jobs(db)] == ["done"]
+    assert fcm.max_in_flight == 2
+    assert fcm.pushes_per_user(tokens, {}) == {user_id: 1 for user_id in tokens}
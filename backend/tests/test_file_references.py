@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+import main
+
+SHARED = "e" * 64
+SHARED_URL = f"/uploads/{SHARED}.pdf"
+TEACHER = {"_id": "teacher-1", "role": "teacher"}
+
+
+@pytest.fixture
+def deleted_keys(monkeypatch):
+    keys = []
+
+    async def delete(key):
+        keys.append(key)
+    monkeypatch.setattr(main.storage, "delete", delete)
+
+    # Yield inside release_file, so concurrent requests interleave there
+    release_file = main.release_file
+
+    async def yielding_release_file(file_url):
+        await asyncio.sleep(0)
+        await release_file(file_url)
+    monkeypatch.setattr(main, "release_file", yielding_release_file)
+    return keys
+
+
+def shared_materials(db, count):
+    async def insert():
+        await db.stored_files.insert_one({"_id": SHARED, "file_url": SHARED_URL, "ref_count": count, "size": 10})
+        materials = []
+        for _ in range(count):
+            course = await db.courses.insert_one({"teacher_id": TEACHER["_id"], "title": "Course"})
+            material = await db.course_materials.insert_one({"course_id": str(course.inserted_id), "file_url": SHARED_URL})
+            materials.append((str(course.inserted_id), str(material.inserted_id)))
+        return materials
+    return asyncio.run(insert())
+
+
+async def delete_material(course_id, material_id):
+    try:
+        await main.delete_course_material(course_id, material_id, current_user=TEACHER)
+        return 200
+    except HTTPException as e:
+        return e.status_code
+
+
+def ref_count(db):
+    async def find():
+        stored = await db.stored_files.find_one({"_id": SHARED})
+        return stored and stored["ref_count"]
+    return asyncio.run(find())
+
+
+def test_deleting_a_shared_material_keeps_the_file_for_other_courses(db, deleted_keys):
+    (first, second) = shared_materials(db, 2)
+
+    asyncio.run(delete_material(*first))
+    assert ref_count(db) == 1
+    assert deleted_keys == []
+
+    asyncio.run(delete_material(*second))
+    assert ref_count(db) is None
+    assert deleted_keys == [f"{SHARED}.pdf"]
+
+
+def test_concurrent_deletes_of_one_material_release_it_once(db, deleted_keys):
+    (first, _) = shared_materials(db, 2)
+
+    async def race():
+        return await asyncio.gather(delete_material(*first), delete_material(*first))
+
+    assert sorted(asyncio.run(race())) == [200, 404]
+    assert ref_count(db) == 1
+    assert deleted_keys == []
+
+
+def test_concurrent_video_replacements_release_the_old_video_once(db, deleted_keys):
+    new_videos = ["1" * 64, "2" * 64]
+
+    async def scenario():
+        await db.stored_files.insert_many(
+            [{"_id": SHARED, "file_url": SHARED_URL, "ref_count": 2, "size": 10}]
+            + [{"_id": sha256, "file_url": f"/uploads/{sha256}.mp4", "ref_count": 1, "size": 10} for sha256 in new_videos]
+        )
+        await db.courses.insert_one({"_id": ObjectId(), "teacher_id": TEACHER["_id"], "video_url": SHARED_URL})
+        course = await db.courses.find_one({})
+
+        async def replace(sha256):
+            try:
+                await main.replace_course_video(course, f"/uploads/{sha256}.mp4", {})
+                return 200
+            except HTTPException as e:
+                return e.status_code
+        return await asyncio.gather(*(replace(sha256) for sha256 in new_videos))
+
+    assert sorted(asyncio.run(scenario())) == [200, 409]
+    # The old video lost exactly one reference; the losing upload was released
+    assert ref_count(db) == 1
+    assert len(deleted_keys) == 1 and deleted_keys[0].endswith(".mp4")
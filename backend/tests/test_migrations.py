@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def migration_runs(monkeypatch):
+    runs = []
+
+    async def migration():
+        runs.append("0100_test")
+
+    monkeypatch.setattr(main, "MIGRATIONS", [("0100_test", migration)])
+    monkeypatch.setattr(main, "MIGRATION_POLL_SECONDS", 0.01)
+    return runs
+
+
+def marker(db, name="0100_test"):
+    return asyncio.run(db.migrations.find_one({"_id": name}))
+
+
+def test_migration_is_applied_once(db, migration_runs):
+    asyncio.run(main.run_migrations())
+    asyncio.run(main.run_migrations())
+
+    assert migration_runs == ["0100_test"]
+    assert marker(db)["status"] == "applied"
+
+
+def test_migration_left_running_by_a_dead_process_is_rerun(db, migration_runs):
+    asyncio.run(db.migrations.insert_one({
+        "_id": "0100_test",
+        "status": "running",
+        "owner": "dead-worker",
+        "lease_until": datetime.utcnow() - timedelta(seconds=1),
+    }))
+
+    asyncio.run(main.run_migrations())
+
+    assert migration_runs == ["0100_test"]
+    assert marker(db)["status"] == "applied"
+
+
+def test_running_marker_without_a_lease_is_rerun(db, migration_runs):
+    # Written before markers had leases
+    asyncio.run(db.migrations.insert_one({"_id": "0100_test", "status": "running", "started_at": datetime.utcnow()}))
+
+    asyncio.run(main.run_migrations())
+
+    assert migration_runs == ["0100_test"]
+
+
+def test_startup_waits_for_a_migration_another_process_is_applying(db, migration_runs):
+    asyncio.run(db.migrations.insert_one({
+        "_id": "0100_test",
+        "status": "running",
+        "owner": "other-worker",
+        "lease_until": datetime.utcnow() + timedelta(minutes=5),
+    }))
+
+    async def start():
+        startup = asyncio.create_task(main.run_migrations())
+        await asyncio.sleep(0.05)
+        assert not startup.done()
+        await db.migrations.update_one({"_id": "0100_test"}, {"$set": {"status": "applied"}})
+        await asyncio.wait_for(startup, 1)
+
+    asyncio.run(start())
+
+    # The other process applied it; this one only waited
+    assert migration_runs == []
+
+
+def test_failed_migration_stops_startup_and_is_retried(db, monkeypatch):
+    attempts = []
+
+    async def migration():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "MIGRATIONS", [("0100_test", migration)])
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.run_migrations())
+    assert marker(db) is None
+
+    asyncio.run(main.run_migrations())
+    assert len(attempts) == 2
+    assert marker(db)["status"] == "applied"
+
+
+def test_lease_is_renewed_while_a_migration_runs(db, monkeypatch):
+    monkeypatch.setattr(main, "MIGRATION_LEASE_SECONDS", 0.3)
+    leases = []
+
+    async def migration():
+        leases.append((await db.migrations.find_one({"_id": "0100_test"}))["lease_until"])
+        await asyncio.sleep(0.25)
+        leases.append((await db.migrations.find_one({"_id": "0100_test"}))["lease_until"])
+
+    monkeypatch.setattr(main, "MIGRATIONS", [("0100_test", migration)])
+
+    asyncio.run(main.run_migrations())
+
+    assert leases[1] > leases[0]
+    assert "lease_until" not in marker(db)
+
+
+def test_upload_rehash_runs_in_the_worker_not_at_startup():
+    startup = [name for name, _ in main.MIGRATIONS]
+    background = [name for name, _ in main.BACKGROUND_MIGRATIONS]
+
+    assert "0002_uploads_to_content_addressed_storage" not in startup
+    assert "0002_uploads_to_content_addressed_storage" in background
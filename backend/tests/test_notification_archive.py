@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+STUDENT = {"_id": "student-1"}
+
+
+@pytest.fixture
+def notifications(db):
+    def add(days_old, user_id="student-1", is_read=False, title="Reminder"):
+        created_at = datetime.utcnow() - timedelta(days=days_old)
+        document = {"user_id": user_id, "title": title, "message": "Soon", "created_at": created_at, "is_read": is_read}
+        if is_read:
+            document["read_at"] = created_at
+        asyncio.run(db.notifications.insert_one(document))
+        if not is_read:
+            asyncio.run(main.adjust_unread_count(user_id, 1))
+        return document
+    return add
+
+
+def buckets(db):
+    return {bucket["_id"]: bucket for bucket in asyncio.run(db.notification_archive.find().to_list(None))}
+
+
+def listed_titles():
+    return [notification["title"] for notification in asyncio.run(main.get_notifications(current_user=STUDENT, limit=20))]
+
+
+def test_old_unread_notifications_are_bucketed_per_user_and_month(db, notifications):
+    archive_age = main.NOTIFICATION_ARCHIVE_AFTER_DAYS
+    first = notifications(archive_age + 40)
+    second = notifications(archive_age + 40, user_id="student-2")
+    notifications(archive_age + 1)
+    notifications(1)
+
+    report = asyncio.run(main.archive_old_notifications())
+
+    assert report["archived"] == 3
+    month = first["created_at"].strftime("%Y-%m")
+    archived = buckets(db)
+    assert f"student-1:{month}" in archived
+    assert archived[f"student-2:{month}"]["items"][0]["_id"] == second["_id"]
+    assert sum(len(bucket["items"]) for bucket in archived.values()) == 3
+    # Only the recent notification stays in the live store
+    assert asyncio.run(db.notifications.count_documents({})) == 1
+
+
+def test_archiving_keeps_listing_and_counters(db, notifications):
+    notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10, title="Old")
+    notifications(1, title="New")
+
+    asyncio.run(main.archive_old_notifications())
+
+    assert listed_titles() == ["New", "Old"]
+    assert asyncio.run(main.get_unread_count("student-1")) == 2
+
+
+def test_archiving_twice_does_not_duplicate_items(db, notifications):
+    notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10)
+
+    asyncio.run(main.archive_old_notifications())
+    report = asyncio.run(main.archive_old_notifications())
+
+    assert report["archived"] == 0
+    [bucket] = buckets(db).values()
+    assert len(bucket["items"]) == 1
+
+
+def test_archived_notifications_can_be_read_and_deleted(db, notifications):
+    read = notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10)
+    deleted = notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10)
+    asyncio.run(main.archive_old_notifications())
+
+    asyncio.run(main.mark_notification_as_read(str(read["_id"]), current_user=STUDENT))
+    assert asyncio.run(main.get_unread_count("student-1")) == 1
+    asyncio.run(main.delete_notification(str(deleted["_id"]), current_user=STUDENT))
+    assert asyncio.run(main.get_unread_count("student-1")) == 0
+
+    [bucket] = buckets(db).values()
+    assert [item["_id"] for item in bucket["items"]] == [read["_id"]]
+    assert bucket["items"][0]["is_read"]
+
+
+def test_archived_items_read_past_retention_expire_with_their_bucket(db, notifications):
+    notification = notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10)
+    asyncio.run(main.archive_old_notifications())
+    read_at = datetime.utcnow() - timedelta(days=main.NOTIFICATION_READ_RETENTION_DAYS + 1)
+    asyncio.run(db.notification_archive.update_one(
+        {"items._id": notification["_id"]},
+        {"$set": {"items.$.is_read": True, "items.$.read_at": read_at}}
+    ))
+
+    report = asyncio.run(main.archive_old_notifications())
+
+    assert report["expired_buckets"] == 1
+    assert buckets(db) == {}
+
+
+def test_read_notifications_expire_through_a_ttl_index(db):
+    indexes = asyncio.run(db.notifications.index_information())
+
+    [ttl] = [index for index in indexes.values() if index["key"] == [("read_at", 1)]]
+    assert ttl["expireAfterSeconds"] == main.NOTIFICATION_READ_RETENTION_DAYS * 24 * 60 * 60
+
+
+def test_read_notifications_are_not_archived(db, notifications):
+    notifications(main.NOTIFICATION_ARCHIVE_AFTER_DAYS + 10, is_read=True)
+
+    report = asyncio.run(main.archive_old_notifications())
+
+    assert report["archived"] == 0
+    assert buckets(db) == {}
@@ -0,0 +1,165 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+
+
+class SSEClient:
+    """Drives GET /notifications/stream through the ASGI app in-process."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.body = b""
+        self.received = asyncio.Event()
+        self.disconnect = asyncio.Event()
+        self.started = False
+
+    async def receive(self):
+        if not self.started:
+            self.started = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await self.disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        if message["type"] == "http.response.body":
+            self.body += message.get("body", b"")
+            if b"event: notification" in self.body:
+                self.received.set()
+
+    async def run(self):
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/notifications/stream",
+            "raw_path": b"/notifications/stream",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"x-test-user", self.user_id.encode())],
+            "client": ("127.0.0.1", 1),
+            "server": ("testserver", 80),
+        }
+        await main.app(scope, self.receive, self.send)
+
+
+@pytest.fixture
+def stream_db(monkeypatch):
+    # No indexes: mongomock checks them per insert, which makes writing a
+    # thousand records slow without adding anything to these tests
+    database = AsyncMongoMockClient()["learnlive_stream_test"]
+    monkeypatch.setattr(main, "db", database)
+    return database
+
+
+@pytest.fixture
+def stream_users(monkeypatch):
+    async def current_user(request: main.Request):
+        return {"_id": request.headers["x-test-user"]}
+
+    main.app.dependency_overrides[main.get_current_user] = current_user
+    yield
+    main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+async def connect(user_ids):
+    clients = [SSEClient(user_id) for user_id in user_ids]
+    tasks = [asyncio.create_task(client.run()) for client in clients]
+    while main.notification_broker.connection_count() < len(clients):
+        await asyncio.sleep(0.01)
+    return clients, tasks
+
+
+async def close(clients, tasks):
+    for client in clients:
+        client.disconnect.set()
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=10)
+
+
+def test_local_stream_delivers_fan_out_to_every_connection(stream_db, stream_users, monkeypatch):
+    monkeypatch.setattr(main, "NOTIFICATION_STREAM_SOURCE", "local")
+    user_ids = [f"student-{index}" for index in range(1000)]
+
+    async def scenario():
+        clients, tasks = await connect(user_ids)
+        await main.fan_out_notifications(user_ids, {"title": "Class moved", "message": "Now at 10"}, push=False)
+        await asyncio.wait_for(asyncio.gather(*[client.received.wait() for client in clients]), timeout=10)
+        await close(clients, tasks)
+        return clients
+
+    clients = asyncio.run(scenario())
+
+    assert all(client.body.count(b"event: notification") == 1 for client in clients)
+    assert main.notification_broker.connection_count() == 0
+
+
+class FakeChangeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.changes:
+            # An idle change stream waits for the next write
+            await asyncio.Event().wait()
+        change = self.changes.pop(0)
+        self.resume_token = {"_data": str(change["fullDocument"]["_id"])}
+        return change
+
+
+class FakeNotifications:
+    def __init__(self):
+        self.changes = []
+
+    def watch(self, pipeline, **kwargs):
+        return FakeChangeStream(self.changes)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.notifications = FakeNotifications()
+
+
+def test_change_stream_delivers_notifications_written_by_the_worker(stream_db, stream_users, monkeypatch):
+    # The outbox worker runs in worker.py: its inserts reach this process's
+    # streams only through the change stream
+    monkeypatch.setattr(main, "NOTIFICATION_STREAM_SOURCE", "change_stream")
+    user_ids = ["student-1", "student-2"]
+
+    async def scenario():
+        clients, tasks = await connect(user_ids)
+        documents, _ = await main.write_notifications(
+            user_ids, {"title": "Class moved", "message": "Now at 10"}, main.datetime.utcnow()
+        )
+        for document in documents:
+            # Writers don't publish themselves in change_stream mode
+            main.publish_notification(document)
+        assert not any(client.received.is_set() for client in clients)
+
+        fake_db = FakeDatabase()
+        fake_db.notifications.changes = [
+            {"operationType": "insert", "fullDocument": document} for document in documents
+        ]
+        monkeypatch.setattr(main, "db", fake_db)
+        bridge = asyncio.create_task(main.watch_notification_inserts())
+        await asyncio.wait_for(asyncio.gather(*[client.received.wait() for client in clients]), timeout=5)
+        bridge.cancel()
+        await close(clients, tasks)
+        return clients
+
+    clients = asyncio.run(scenario())
+
+    assert all(client.body.count(b"event: notification") == 1 for client in clients)
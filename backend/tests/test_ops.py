@@ -0,0 +1,53 @@
+import asyncio
+
+from starlette.testclient import TestClient
+
+import main
+
+
+def test_ops_endpoints_are_hidden_without_ops_token(monkeypatch):
+    monkeypatch.setattr(main, "OPS_TOKEN", None)
+    client = TestClient(main.app)
+
+    assert client.get("/ops/user-cache-stats", headers={"X-Ops-Token": "anything"}).status_code == 404
+
+
+def test_ops_endpoints_require_the_ops_token(monkeypatch):
+    monkeypatch.setattr(main, "OPS_TOKEN", "s3cret")
+    client = TestClient(main.app)
+
+    assert client.get("/ops/user-cache-stats").status_code == 403
+    assert client.get("/ops/user-cache-stats", headers={"X-Ops-Token": "wrong"}).status_code == 403
+    response = client.get("/ops/user-cache-stats", headers={"X-Ops-Token": "s3cret"})
+    assert response.status_code == 200
+    assert "hits" in response.json()
+
+
+def test_user_cache_stats_are_not_exposed_to_app_users():
+    client = TestClient(main.app)
+
+    assert client.get("/users/cache-stats", headers={"Authorization": "Bearer token"}).status_code == 404
+
+
+def test_profile_update_invalidates_the_cached_user(db, monkeypatch):
+    monkeypatch.setattr(main, "user_cache", main.TTLCache(maxsize=10, ttl=60))
+    email = "student@example.com"
+    asyncio.run(db.users.insert_one({
+        "email": email,
+        "name": "Student",
+        "role": "student",
+        "class_level": "6",
+        "created_at": main.datetime.utcnow(),
+    }))
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': email})}"}
+    client = TestClient(main.app)
+
+    assert client.get("/users/me", headers=headers).json()["class_level"] == "6"
+    assert email in main.user_cache
+
+    response = client.put("/users/me/class", headers=headers, json={"class_level": "7"})
+    assert response.status_code == 200
+
+    # Served from the database again, not the entry cached before the update
+    assert client.get("/users/me", headers=headers).json()["class_level"] == "7"
+    assert main.user_cache[email]["class_level"] == "7"
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+import main
+
+
+def client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://testserver")
+
+
+def test_saturated_pool_refuses_logins_with_retry_after(db, monkeypatch):
+    monkeypatch.setattr(main, "PASSWORD_HASH_MAX_PENDING", 2)
+    asyncio.run(db.users.insert_one({"email": "ann@example.com", "password": "unused"}))
+    release = threading.Event()
+
+    async def scenario():
+        # Fill the pool with hash jobs that block until released
+        busy = [asyncio.ensure_future(main.run_password_job(release.wait, 5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        async with client() as http:
+            refused = await http.post("/token", data={"username": "ann@example.com", "password": "secret"})
+        release.set()
+        await asyncio.gather(*busy)
+        return refused
+
+    refused = asyncio.run(scenario())
+
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "1"
+    assert main.password_jobs_pending == 0
+
+
+def test_concurrent_logins_keep_the_event_loop_responsive(db, monkeypatch):
+    # Stand-in for bcrypt: holds a pool thread for 100 ms per login
+    monkeypatch.setattr(main, "verify_password", lambda plain, hashed: time.sleep(0.1) or plain == hashed)
+    asyncio.run(db.users.insert_one({"email": "ann@example.com", "password": "secret"}))
+
+    async def scenario():
+        lags = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lags.append(time.perf_counter() - started)
+
+        ticking = asyncio.ensure_future(ticker())
+        async with client() as http:
+            responses = await asyncio.gather(*(
+                http.post("/token", data={"username": "ann@example.com", "password": "secret"})
+                for _ in range(16)
+            ))
+        done.set()
+        await ticking
+        return responses, max(lags)
+
+    responses, max_lag = asyncio.run(scenario())
+
+    assert [response.status_code for response in responses] == [200] * 16
+    # 16 logins hold the pool for 1.6 s of work; inline, one tick would wait that long
+    assert max_lag < 0.1
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from starlette.testclient import TestClient
+
+import main
+
+KEY = "a" * 64 + ".pdf"
+
+
+@pytest.fixture
+def course_files(db):
+    course_id = ObjectId()
+
+    async def insert():
+        await db.courses.insert_one({
+            "_id": course_id,
+            "title": "Algebra",
+            "teacher_id": "download-teacher",
+            "thumbnail": f"/uploads/{'b' * 64}.jpg",
+        })
+        await db.course_materials.insert_one({"course_id": str(course_id), "file_url": f"/uploads/{KEY}"})
+        await db.enrollments.insert_one({"course_id": str(course_id), "user_id": "download-student"})
+    asyncio.run(insert())
+    yield
+    main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+def download(user_id, file_url):
+    main.app.dependency_overrides[main.get_current_user] = lambda: {"_id": user_id, "role": "student"}
+    return TestClient(main.app).get("/storage/presigned-download", params={"file_url": file_url})
+
+
+@pytest.mark.parametrize("user_id", ["download-teacher", "download-student"])
+def test_course_members_can_download_material_files(course_files, user_id):
+    response = download(user_id, f"/uploads/{KEY}")
+
+    assert response.status_code == 200
+    assert response.json()["url"]
+
+
+def test_other_users_cannot_download_material_files(course_files):
+    assert download("download-stranger", f"/uploads/{KEY}").status_code == 403
+
+
+def test_unreferenced_files_are_not_found(course_files):
+    assert download("download-teacher", f"/uploads/{'c' * 64}.pdf").status_code == 404
+
+
+def test_course_thumbnails_are_downloadable_by_anyone(course_files):
+    assert download("download-stranger", f"/uploads/{'b' * 64}.jpg").status_code == 200
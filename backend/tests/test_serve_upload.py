@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+
+import httpx
+import pytest
+from starlette.testclient import TestClient
+
+import main
+
+CONTENT = bytes(range(256)) * 40  # 10240 bytes
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(main.UPLOAD_DIR)
+    with open(os.path.join(main.UPLOAD_DIR, f"{SHA256}.mp4"), "wb") as f:
+        f.write(CONTENT)
+    with open(os.path.join(main.UPLOAD_DIR, ".upload.part"), "wb") as f:
+        f.write(b"in progress")
+    with open("secret.txt", "wb") as f:
+        f.write(b"not an upload")
+    return TestClient(main.app)
+
+
+def test_full_file_advertises_ranges(client):
+    response = client.get(f"/uploads/{SHA256}.mp4")
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Type"] == "video/mp4"
+    assert response.headers["ETag"] == f'"{SHA256}"'
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=10000-", 10000, 10239),
+    ("bytes=-240", 10000, 10239),
+    ("bytes=10200-99999", 10200, 10239),
+])
+def test_single_range_is_served_partially(client, range_header, start, end):
+    response = client.get(f"/uploads/{SHA256}.mp4", headers={"Range": range_header})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[start:end + 1]
+    assert response.headers["Content-Range"] == f"bytes {start}-{end}/{len(CONTENT)}"
+    assert response.headers["Content-Length"] == str(end - start + 1)
+
+
+@pytest.mark.parametrize("range_header", ["bytes=10240-", "bytes=99999-100000", "bytes=-0"])
+def test_unsatisfiable_range_is_refused(client, range_header):
+    response = client.get(f"/uploads/{SHA256}.mp4", headers={"Range": range_header})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_multiple_or_malformed_ranges_fall_back_to_the_full_file(client):
+    for range_header in ("bytes=0-1,5-6", "items=0-1", "bytes=abc"):
+        response = client.get(f"/uploads/{SHA256}.mp4", headers={"Range": range_header})
+        assert response.status_code == 200
+        assert response.content == CONTENT
+
+
+def test_stale_if_range_gets_the_full_file(client):
+    response = client.get(f"/uploads/{SHA256}.mp4", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_etag_revalidation(client):
+    etag = client.get(f"/uploads/{SHA256}.mp4").headers["ETag"]
+
+    not_modified = client.get(f"/uploads/{SHA256}.mp4", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["ETag"] == etag
+
+    changed = client.get(f"/uploads/{SHA256}.mp4", headers={"If-None-Match": '"something-else"'})
+    assert changed.status_code == 200
+    assert changed.content == CONTENT
+
+
+def test_head_sends_headers_only(client):
+    async def head():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as http:
+            return await http.head(f"/uploads/{SHA256}.mp4")
+    response = asyncio.run(head())
+
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(len(CONTENT))
+    assert response.content == b""
+
+
+@pytest.mark.parametrize("path", [
+    "/uploads/..%2Fsecret.txt",
+    "/uploads/%2E%2E%2Fsecret.txt",
+    "/uploads/%2E%2E",
+    "/uploads/.upload.part",
+    "/uploads/missing.mp4",
+])
+def test_paths_outside_served_uploads_are_not_found(client, path):
+    response = client.get(path)
+
+    assert response.status_code == 404
+    assert b"not an upload" not in response.content
@@ -0,0 +1,105 @@
+import asyncio
+import calendar
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import main
+
+
+def add_session(db, students):
+    session_id = ObjectId()
+    starts_at = (datetime.utcnow() + timedelta(minutes=10)).replace(microsecond=0)
+
+    async def insert():
+        await db.sessions.insert_one({
+            "_id": session_id,
+            "title": "Algebra",
+            "teacher_id": "teacher-1",
+            "course_id": "course-1",
+            "starts_at": starts_at,
+        })
+        await db.enrollments.insert_many([{"course_id": "course-1", "user_id": user_id} for user_id in students])
+        await db.device_tokens.insert_many([
+            {"user_id": user_id, "device_token": f"token-{user_id}"} for user_id in ["teacher-1", *students]
+        ])
+    asyncio.run(insert())
+    return str(session_id), starts_at
+
+
+def test_reminder_pushes_everyone_once(db, fcm, drain_outbox):
+    students = ["student-1", "student-2", "student-3"]
+    session_id, starts_at = add_session(db, students)
+    scheduler = main.SessionReminderScheduler()
+
+    async def scenario():
+        await scheduler.fire(session_id, starts_at)
+        await scheduler.fire(session_id, starts_at)
+        await drain_outbox()
+
+    asyncio.run(scenario())
+
+    tokens = {user_id: f"token-{user_id}" for user_id in ["teacher-1", *students]}
+    pushes = fcm.pushes_per_user(tokens, {main.course_topic("course-1"): students})
+    assert pushes == {user_id: 1 for user_id in tokens}
+    assert scheduler.handled == {session_id: starts_at}
+
+
+def test_failed_reminder_is_retried_without_duplicates(db, fcm, drain_outbox, monkeypatch):
+    students = ["student-1", "student-2"]
+    session_id, starts_at = add_session(db, students)
+    scheduler = main.SessionReminderScheduler()
+    enqueue_fan_out = main.enqueue_fan_out
+    calls = []
+
+    async def flaky_enqueue_fan_out(*args, **kwargs):
+        calls.append(kwargs["key"])
+        if len(calls) == 1:
+            raise RuntimeError("outbox unavailable")
+        await enqueue_fan_out(*args, **kwargs)
+
+    monkeypatch.setattr(main, "enqueue_fan_out", flaky_enqueue_fan_out)
+
+    async def scenario():
+        try:
+            await scheduler.fire(session_id, starts_at)
+        except RuntimeError:
+            pass
+        assert session_id not in scheduler.handled
+        reminder = await db.session_reminders.find_one({"session_id": session_id})
+        assert reminder["status"] == "claimed" and reminder["lease_until"] <= datetime.utcnow()
+
+        await scheduler.fire(session_id, starts_at)
+        await drain_outbox()
+        return await db.session_reminders.find_one({"session_id": session_id})
+
+    reminder = asyncio.run(scenario())
+
+    assert reminder["status"] == "sent"
+    assert scheduler.handled == {session_id: starts_at}
+    tokens = {user_id: f"token-{user_id}" for user_id in ["teacher-1", *students]}
+    pushes = fcm.pushes_per_user(tokens, {main.course_topic("course-1"): students})
+    assert pushes == {user_id: 1 for user_id in tokens}
+
+
+def test_reminder_id_does_not_depend_on_the_local_timezone(db, monkeypatch):
+    starts_at = datetime(2030, 1, 15, 9, 30)
+    expected = f"session-1:{calendar.timegm(starts_at.timetuple())}"
+    scheduler = main.SessionReminderScheduler()
+    claimed = []
+
+    async def claim(reminder_id, session_id):
+        claimed.append(reminder_id)
+        return False
+
+    monkeypatch.setattr(scheduler, "claim", claim)
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        asyncio.run(scheduler.fire("session-1", starts_at))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert claimed == [expected]
@@ -0,0 +1,150 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from starlette.testclient import TestClient
+
+import main
+
+
+def upcoming(user, **params):
+    main.app.dependency_overrides[main.get_current_user] = lambda: user
+    try:
+        return TestClient(main.app).get("/sessions/upcoming", params=params)
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+def test_upcoming_sessions_reject_anchors_outside_the_callers_sessions(db):
+    other_session = ObjectId()
+
+    async def insert():
+        await db.sessions.insert_one({
+            "_id": other_session,
+            "teacher_id": "other-teacher",
+            "starts_at": datetime.utcnow() + timedelta(days=1),
+        })
+    asyncio.run(insert())
+
+    teacher = {"_id": "teacher-1", "role": "teacher"}
+    assert upcoming(teacher, after=str(other_session)).status_code == 404
+
+    owner = {"_id": "other-teacher", "role": "teacher"}
+    response = upcoming(owner, after=str(other_session))
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def post_session(user, path, payload):
+    main.app.dependency_overrides[main.get_current_user] = lambda: user
+    try:
+        return TestClient(main.app).post(path, json=payload)
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+def session_payload(**overrides):
+    payload = {
+        "title": "Algebra",
+        "description": "",
+        "date": "2099-01-01",
+        "time": "10:00",
+        "duration": 60,
+        "teacher": "Teacher",
+    }
+    payload.update(overrides)
+    return payload
+
+
+def test_create_session_sees_sessions_booked_by_another_worker(db):
+    teacher = {"_id": "teacher-1", "role": "teacher"}
+    assert post_session(teacher, "/sessions/conflicts", {"slots": [session_payload()]}).status_code == 200
+
+    async def insert():
+        await db.sessions.insert_one({
+            "teacher_id": "teacher-1",
+            "title": "Booked elsewhere",
+            "starts_at": datetime(2099, 1, 1, 10, 30),
+            "ends_at": datetime(2099, 1, 1, 11, 30),
+        })
+    asyncio.run(insert())
+
+    response = post_session(teacher, "/sessions", session_payload())
+    assert response.status_code == 409
+    assert [conflict["title"] for conflict in response.json()["detail"]["conflicts"]] == ["Booked elsewhere"]
+
+
+def test_create_session_backs_out_when_a_concurrent_insert_overlaps(db, monkeypatch):
+    find_session_conflicts = main.find_session_conflicts
+    checks = []
+
+    async def racing_find_session_conflicts(teacher_id, starts_at, ends_at, exclude_id=None):
+        checks.append(exclude_id)
+        conflicts = await find_session_conflicts(teacher_id, starts_at, ends_at, exclude_id)
+        if len(checks) == 1:
+            # Another request inserts an overlapping session right after our check
+            await db.sessions.insert_one({
+                "teacher_id": teacher_id,
+                "title": "Concurrent",
+                "starts_at": starts_at,
+                "ends_at": ends_at,
+            })
+        return conflicts
+    monkeypatch.setattr(main, "find_session_conflicts", racing_find_session_conflicts)
+
+    teacher = {"_id": "teacher-1", "role": "teacher"}
+    response = post_session(teacher, "/sessions", session_payload())
+    assert response.status_code == 409
+    assert len(checks) == 2
+
+    async def titles():
+        return [session["title"] async for session in db.sessions.find({"teacher_id": "teacher-1"})]
+    assert asyncio.run(titles()) == ["Concurrent"]
+
+
+def test_conflict_check_finds_legacy_sessions_longer_than_a_day(db):
+
+    async def insert():
+        await db.sessions.insert_one({
+            "teacher_id": "teacher-1",
+            "title": "Workshop",
+            "starts_at": datetime(2098, 12, 30, 9, 0),
+            "ends_at": datetime(2099, 1, 2, 9, 0),
+        })
+    asyncio.run(insert())
+
+    teacher = {"_id": "teacher-1", "role": "teacher"}
+    response = post_session(teacher, "/sessions/conflicts", {"slots": [session_payload()]})
+    assert response.status_code == 200
+    assert [conflict["title"] for conflict in response.json()["results"][0]["conflicts"]] == ["Workshop"]
+    assert post_session(teacher, "/sessions", session_payload()).status_code == 409
+
+
+def test_conflict_check_forgets_sessions_of_a_deleted_course(db):
+    teacher = {"_id": "teacher-1", "role": "teacher"}
+
+    async def insert():
+        course = await db.courses.insert_one({"teacher_id": "teacher-1", "title": "Algebra"})
+        await db.sessions.insert_one({
+            "teacher_id": "teacher-1",
+            "course_id": str(course.inserted_id),
+            "title": "Algebra",
+            "starts_at": datetime(2099, 1, 1, 10, 0),
+            "ends_at": datetime(2099, 1, 1, 11, 0),
+        })
+        return str(course.inserted_id)
+    course_id = asyncio.run(insert())
+
+    def conflicts():
+        response = post_session(teacher, "/sessions/conflicts", {"slots": [session_payload()]})
+        return response.json()["results"][0]["conflicts"]
+
+    assert len(conflicts()) == 1
+
+    main.app.dependency_overrides[main.get_current_user] = lambda: teacher
+    try:
+        assert TestClient(main.app).delete(f"/courses/{course_id}").status_code == 200
+    finally:
+        main.app.dependency_overrides.pop(main.get_current_user, None)
+
+    assert conflicts() == []
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+STUDENT = {"_id": "student-1"}
+
+
+def unread(user_id="student-1"):
+    return asyncio.run(main.get_unread_count(user_id))
+
+
+def notify(drain_outbox, user_ids, **fields):
+    async def scenario():
+        await main.enqueue_fan_out(list(user_ids), {"title": "Reminder", "message": "Soon", **fields})
+        await drain_outbox()
+    asyncio.run(scenario())
+
+
+def notification_ids(db, user_id="student-1"):
+    return [str(document["_id"]) for document in asyncio.run(db.notifications.find({"user_id": user_id}).to_list(None))]
+
+
+def test_delivered_notifications_increment_the_counter(db, fcm, drain_outbox):
+    notify(drain_outbox, ["student-1", "student-2"])
+    notify(drain_outbox, ["student-1"])
+
+    assert unread("student-1") == 2
+    assert unread("student-2") == 1
+
+
+def test_coalesced_notifications_count_once(db, fcm, drain_outbox):
+    for _ in range(3):
+        notify(drain_outbox, ["student-1"], action_type="material", coalesce_id="course-1")
+
+    assert len(notification_ids(db)) == 1
+    assert unread() == 1
+
+
+def test_read_and_delete_round_trip(db, fcm, drain_outbox):
+    notify(drain_outbox, ["student-1"])
+    notify(drain_outbox, ["student-1"])
+    first, second = notification_ids(db)
+
+    asyncio.run(main.mark_notification_as_read(first, current_user=STUDENT))
+    assert unread() == 1
+
+    # Reading twice doesn't count twice
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.mark_notification_as_read(first, current_user=STUDENT))
+    assert error.value.status_code == 404
+    assert unread() == 1
+
+    # Deleting a read notification leaves the counter alone, an unread one decrements it
+    asyncio.run(main.delete_notification(first, current_user=STUDENT))
+    assert unread() == 1
+    asyncio.run(main.delete_notification(second, current_user=STUDENT))
+    assert unread() == 0
+    assert asyncio.run(main.read_unread_notification_count(current_user=STUDENT)) == {"unread": 0}
+
+
+def test_repair_corrects_drifted_counters(db, fcm, drain_outbox):
+    notify(drain_outbox, ["student-1", "student-2"])
+    notify(drain_outbox, ["student-1"])
+
+    async def drift():
+        # As if counter writes were lost or applied twice around a crash
+        await db.notification_counters.update_one({"_id": "student-1"}, {"$set": {"unread": 7}})
+        await db.notification_counters.update_one({"_id": "student-2"}, {"$set": {"unread": -2}})
+        await db.notification_counters.insert_one({"_id": "student-3", "unread": 4})
+    asyncio.run(drift())
+
+    report = asyncio.run(main.rebuild_unread_counters())
+
+    assert report == {"users_with_unread": 2, "reset_to_zero": 1}
+    assert (unread("student-1"), unread("student-2"), unread("student-3")) == (2, 1, 0)
+
+
+def test_negative_counter_reads_as_zero(db):
+    asyncio.run(db.notification_counters.insert_one({"_id": "student-1", "unread": -3}))
+
+    assert unread() == 0
@@ -0,0 +1,100 @@
+import asyncio
+import os
+
+import pytest
+from bson import ObjectId
+
+import main
+
+TEACHER = {"_id": "teacher-1", "role": "teacher", "name": "Teacher"}
+BOUNDARY = "boundary"
+
+
+@pytest.fixture
+def course_id(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(main.UPLOAD_DIR)
+    monkeypatch.setitem(main.UPLOAD_SIZE_LIMITS, "document", 1000)
+    main.app.dependency_overrides[main.get_current_user] = lambda: TEACHER
+    course_id = ObjectId()
+    asyncio.run(db.courses.insert_one({"_id": course_id, "teacher_id": TEACHER["_id"], "title": "Algebra"}))
+    yield str(course_id)
+    main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+def form_pieces(file_size, piece_size=100):
+    head = b"".join(
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in (("title", "Notes"), ("description", "Week 1"), ("type", "document"))
+    ) + (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="notes.pdf"\r\n'
+        "Content-Type: application/pdf\r\n\r\n"
+    ).encode()
+    body = head + b"x" * file_size + f"\r\n--{BOUNDARY}--\r\n".encode()
+    return [body[start:start + piece_size] for start in range(0, len(body), piece_size)]
+
+
+async def post_material(course_id, pieces):
+    """POST the pieces through the ASGI app, without a Content-Length."""
+    pieces = list(pieces)
+    response = {"body": b"", "unread": None}
+
+    async def receive():
+        body = pieces.pop(0)
+        return {"type": "http.request", "body": body, "more_body": bool(pieces)}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": f"/courses/{course_id}/materials",
+        "raw_path": f"/courses/{course_id}/materials".encode(),
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+        "http_version": "1.1",
+        "asgi": {"version": "3.0"},
+    }
+    await main.app(scope, receive, send)
+    response["unread"] = len(pieces)
+    return response
+
+
+def test_upload_within_its_kind_limit_is_stored(db, course_id):
+    response = asyncio.run(post_material(course_id, form_pieces(800)))
+
+    assert response["status"] == 200
+    material = asyncio.run(db.course_materials.find_one({}))
+    assert (material["title"], material["file_name"], material["file_size"]) == ("Notes", "notes.pdf", 800)
+    assert [name for name in os.listdir(main.UPLOAD_DIR) if name.startswith(".")] == []
+
+
+def test_upload_over_its_kind_limit_is_refused_while_streaming(db, course_id):
+    pieces = form_pieces(100_000)
+    response = asyncio.run(post_material(course_id, pieces))
+
+    assert response["status"] == 413
+    assert b"document uploads" in response["body"]
+    # Refused right after the limit, with most of the body never read
+    assert response["unread"] > len(pieces) - 20
+    assert os.listdir(main.UPLOAD_DIR) == []
+    assert asyncio.run(db.stored_files.count_documents({})) == 0
+    assert asyncio.run(db.course_materials.count_documents({})) == 0
+
+
+def test_missing_field_drops_the_streamed_file(db, course_id):
+    pieces = form_pieces(800)
+    # Same body without the title part
+    body = b"".join(pieces).split(b"--" + BOUNDARY.encode(), 2)
+    response = asyncio.run(post_material(course_id, [b"--" + BOUNDARY.encode() + body[2]]))
+
+    assert response["status"] == 422
+    assert os.listdir(main.UPLOAD_DIR) == []
@@ -0,0 +1,93 @@
+from fastapi import FastAPI, File, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.testclient import TestClient
+
+import main
+
+
+def make_client(max_bytes=100):
+    app = FastAPI()
+    app.add_middleware(main.UploadSizeLimitMiddleware, max_bytes=max_bytes)
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for index in range(3):
+                yield f"chunk-{index};".encode()
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    return TestClient(app)
+
+
+def multipart(size):
+    boundary = "boundary"
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="notes.txt"\r\n'
+        "Content-Type: text/plain\r\n\r\n"
+    ).encode() + b"x" * size + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def test_small_upload_passes():
+    body, headers = multipart(10)
+    response = make_client(max_bytes=1000).post("/upload", data=body, headers=headers)
+
+    assert response.status_code == 200
+    assert response.json() == {"size": 10}
+
+
+def test_declared_oversized_upload_is_rejected():
+    body, headers = multipart(500)
+    response = make_client().post("/upload", data=body, headers=headers)
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Request body too large"}
+
+
+def test_chunked_oversized_upload_is_rejected():
+    body, headers = multipart(500)
+
+    def chunks():
+        for start in range(0, len(body), 64):
+            yield body[start:start + 64]
+
+    # A generator body is sent chunked, without a Content-Length
+    response = make_client().post("/upload", data=chunks(), headers=headers)
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Request body too large"}
+
+
+def test_streamed_responses_pass_through():
+    response = make_client().get("/stream")
+
+    assert response.text == "chunk-0;chunk-1;chunk-2;"
+
+
+def test_response_extensions_pass_through():
+    sent = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.zerocopysend", "file": 3, "count": 10})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message["type"])
+
+    middleware = main.UploadSizeLimitMiddleware(app, max_bytes=10)
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=x")],
+    }
+    main.asyncio.run(middleware(scope, receive, send))
+
+    assert sent == ["http.response.start", "http.response.zerocopysend"]
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from starlette.testclient import TestClient
+
+import main
+
+USER = {"_id": "teacher-1"}
+
+
+@pytest.fixture
+def upload_session(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(main.UPLOAD_SESSIONS_DIR)
+    main.app.dependency_overrides[main.get_current_user] = lambda: USER
+    session_id = ObjectId()
+
+    async def insert():
+        await db.upload_sessions.insert_one({
+            "_id": session_id,
+            "user_id": USER["_id"],
+            "file_name": "notes.pdf",
+            "file_ext": ".pdf",
+            "kind": "document",
+            "size": 8,
+            "offset": 0,
+            "status": "open",
+            "expires_at": datetime.utcnow() + timedelta(hours=1),
+        })
+    asyncio.run(insert())
+    with open(main.upload_session_path(str(session_id)), "wb") as part_file:
+        part_file.truncate(8)
+    yield str(session_id)
+    main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+async def put_chunk(session_id, offset, chunks, gate=None):
+    """PUT a chunk through the ASGI app; waits on gate before the last piece."""
+    pieces = list(chunks)
+    response = {"body": b""}
+
+    async def receive():
+        if gate is not None and len(pieces) == 1:
+            await gate.wait()
+        body = pieces.pop(0)
+        return {"type": "http.request", "body": body, "more_body": bool(pieces)}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "PUT",
+        "scheme": "http",
+        "path": f"/upload-sessions/{session_id}",
+        "raw_path": f"/upload-sessions/{session_id}".encode(),
+        "query_string": f"offset={offset}".encode(),
+        "root_path": "",
+        "headers": [(b"content-type", b"application/octet-stream")],
+        "client": ("127.0.0.1", 1),
+        "server": ("testserver", 80),
+    }
+    await main.app(scope, receive, send)
+    return response["status"], json.loads(response["body"])
+
+
+def test_concurrent_chunks_at_the_same_offset_write_once(db, upload_session):
+    async def scenario():
+        gate = asyncio.Event()
+        first = asyncio.create_task(put_chunk(upload_session, 0, [b"abcd", b"efgh"], gate))
+        while not (await db.upload_sessions.find_one({"_id": ObjectId(upload_session)})).get("writer"):
+            await asyncio.sleep(0.01)
+        second = await put_chunk(upload_session, 0, [b"XXXXXXXX"])
+        gate.set()
+        return await first, second
+
+    (first_status, first_body), (second_status, second_body) = asyncio.run(scenario())
+
+    assert first_status == 200 and first_body["offset"] == 8
+    assert second_status == 409
+    with open(main.upload_session_path(upload_session), "rb") as part_file:
+        assert part_file.read() == b"abcdefgh"
+    stored = asyncio.run(db.upload_sessions.find_one({"_id": ObjectId(upload_session)}))
+    assert "writer" not in stored
+
+
+def test_failed_completion_reopens_the_session(db, upload_session, monkeypatch):
+    async def prepare():
+        await db.upload_sessions.update_one({"_id": ObjectId(upload_session)}, {"$set": {"offset": 8}})
+        course = await db.courses.insert_one({"title": "Algebra", "teacher_id": USER["_id"]})
+        return str(course.inserted_id)
+    course_id = asyncio.run(prepare())
+
+    async def failing_store_file(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(main, "store_file", failing_store_file)
+    client = TestClient(main.app, raise_server_exceptions=False)
+
+    response = client.post(
+        f"/upload-sessions/{upload_session}/complete",
+        json={"target": "material", "course_id": course_id, "title": "Notes", "description": "Week 1"}
+    )
+
+    assert response.status_code == 500
+    stored = asyncio.run(db.upload_sessions.find_one({"_id": ObjectId(upload_session)}))
+    assert stored["status"] == "open"
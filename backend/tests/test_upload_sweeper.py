@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import main
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def uploads(db, tmp_path, monkeypatch):
+    # The sweeper works on uploads/ and uploads_quarantine/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / main.UPLOAD_DIR).mkdir()
+
+    def add(name, age=2 * DAY, directory=main.UPLOAD_DIR):
+        path = tmp_path / directory / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"data")
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+    return add
+
+
+def sweep(dry_run=False):
+    return asyncio.run(main.sweep_orphaned_uploads(dry_run=dry_run))
+
+
+def insert(db, collection, document):
+    asyncio.run(db[collection].insert_one(document))
+
+
+def test_unreferenced_files_are_quarantined_after_the_grace_period(db, uploads, tmp_path):
+    uploads("old-orphan.pdf", age=2 * DAY)
+    uploads("new-orphan.pdf", age=60)
+    uploads(".in-flight.part", age=60)
+
+    report = sweep()
+
+    assert report["quarantined"] == ["old-orphan.pdf"]
+    assert (tmp_path / main.UPLOAD_QUARANTINE_DIR / "old-orphan.pdf").exists()
+    assert (tmp_path / main.UPLOAD_DIR / "new-orphan.pdf").exists()
+    assert (tmp_path / main.UPLOAD_DIR / ".in-flight.part").exists()
+
+
+def test_dry_run_moves_nothing(db, uploads, tmp_path):
+    uploads("orphan.pdf")
+
+    report = sweep(dry_run=True)
+
+    assert report["quarantined"] == ["orphan.pdf"]
+    assert (tmp_path / main.UPLOAD_DIR / "orphan.pdf").exists()
+
+
+def test_files_referenced_by_documents_are_kept(db, uploads, tmp_path):
+    uploads("video.mp4")
+    uploads("material.pdf")
+    insert(db, "courses", {"video_url": "/uploads/video.mp4"})
+    insert(db, "course_materials", {"file_url": "/uploads/material.pdf"})
+
+    report = sweep()
+
+    assert report["quarantined"] == []
+
+
+def test_files_referenced_only_by_stored_files_or_derivatives_are_kept(db, uploads, tmp_path):
+    stored = "a" * 64 + ".pdf"
+    released = "b" * 64 + ".pdf"
+    uploads(stored)
+    uploads(released)
+    uploads("thumb.jpg")
+    uploads("preview.png")
+    insert(db, "stored_files", {"_id": "a" * 64, "file_url": f"/uploads/{stored}", "ref_count": 1})
+    # Its last reference was released, so the file is garbage
+    insert(db, "stored_files", {"_id": "b" * 64, "file_url": f"/uploads/{released}", "ref_count": 0})
+    insert(db, "derivatives", {"_id": "c" * 64, "thumbnail_url": "/uploads/thumb.jpg", "preview_url": "/uploads/preview.png"})
+
+    report = sweep()
+
+    assert report["quarantined"] == [released]
+
+
+def test_quarantined_file_referenced_again_is_restored(db, uploads, tmp_path):
+    uploads("orphan.pdf")
+    sweep()
+    insert(db, "course_materials", {"file_url": "/uploads/orphan.pdf"})
+
+    report = sweep()
+
+    assert report["restored"] == ["orphan.pdf"]
+    assert (tmp_path / main.UPLOAD_DIR / "orphan.pdf").exists()
+    assert not (tmp_path / main.UPLOAD_QUARANTINE_DIR / "orphan.pdf").exists()
+
+
+def test_quarantine_is_purged_after_the_quarantine_period(db, uploads, tmp_path):
+    quarantine_age = main.SWEEPER_QUARANTINE_DAYS * DAY
+    uploads("expired.pdf", age=quarantine_age + DAY, directory=main.UPLOAD_QUARANTINE_DIR)
+    uploads("recent.pdf", age=quarantine_age - DAY, directory=main.UPLOAD_QUARANTINE_DIR)
+
+    report = sweep()
+
+    assert report["deleted"] == ["expired.pdf"]
+    assert not (tmp_path / main.UPLOAD_QUARANTINE_DIR / "expired.pdf").exists()
+    assert (tmp_path / main.UPLOAD_QUARANTINE_DIR / "recent.pdf").exists()
+
+
+def test_quarantine_period_starts_when_the_file_is_quarantined(db, uploads, tmp_path):
+    # Old enough to purge by upload time, but only just quarantined
+    uploads("orphan.pdf", age=30 * DAY)
+
+    sweep()
+    report = sweep()
+
+    assert report["deleted"] == []
+    assert (tmp_path / main.UPLOAD_QUARANTINE_DIR / "orphan.pdf").exists()
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import json
+
+from main import (
+    OUTBOX_CONCURRENCY,
+    archive_old_notifications,
+    rebuild_unread_counters,
+    reminder_scheduler,
+    run_background_migrations,
+    run_migrations,
+    run_outbox_worker,
+    sweep_orphaned_uploads,
+)
+
+# Standalone entry point for background work, run separately from the API:
+#   python worker.py --concurrency 8       deliver queued notifications and
+#                                          apply background migrations
+#   python worker.py migrate               apply all migrations, then exit
+#   python worker.py sweep-uploads         report orphaned upload files
+#   python worker.py sweep-uploads --apply quarantine and purge them
+#   python worker.py repair-unread-counters recount unread notifications
+#   python worker.py archive-notifications  compact old unread notifications
+#   python worker.py reminders             send session starting-soon reminders
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LearnLive background worker")
+    parser.add_argument("command", nargs="?", default="outbox", choices=["outbox", "migrate", "sweep-uploads", "repair-unread-counters", "archive-notifications", "reminders"])
+    parser.add_argument("--concurrency", type=int, default=OUTBOX_CONCURRENCY)
+    parser.add_argument("--apply", action="store_true", help="make changes instead of a dry run")
+    args = parser.parse_args()
+
+    async def migrate():
+        await run_migrations()
+        await run_background_migrations()
+
+    async def outbox():
+        # Delivery waits for the migrations the API needs, like the API does
+        await run_migrations()
+        await asyncio.gather(run_outbox_worker(args.concurrency), run_background_migrations())
+
+    if args.command == "migrate":
+        asyncio.run(migrate())
+    elif args.command == "sweep-uploads":
+        report = asyncio.run(sweep_orphaned_uploads(dry_run=not args.apply))
+        print(json.dumps(report, indent=2))
+    elif args.command == "repair-unread-counters":
+        report = asyncio.run(rebuild_unread_counters())
+        print(json.dumps(report, indent=2))
+    elif args.command == "archive-notifications":
+        report = asyncio.run(archive_old_notifications())
+        print(json.dumps(report, indent=2))
+    elif args.command == "reminders":
+        asyncio.run(reminder_scheduler.run())
+    else:
+        asyncio.run(outbox())
@@ -7,6 +7,7 @@ class Course {
   final String? teacherId;
   final String? teacherName;
   final List<String>? students;
+  final int studentCount;
   final String? thumbnail;
   final String? videoUrl; // Added for course video
 
@@ -19,11 +20,15 @@ class Course {
     this.teacherId,
     this.teacherName,
     this.students,
+    this.studentCount = 0,
     this.thumbnail,
     this.videoUrl, // Added for course video
   });
 
   factory Course.fromJson(Map<String, dynamic> json) {
+    final students = json['students'] != null
+        ? List<String>.from(json['students'])
+        : null;
     return Course(
       id: json['id'],
       title: json['title'],
@@ -32,9 +37,8 @@ class Course {
       price: json['price'].toDouble(),
       teacherId: json['teacher_id'],
       teacherName: json['teacher_name'],
-      students: json['students'] != null
-          ? List<String>.from(json['students'])
-          : null,
+      students: students,
+      studentCount: json['student_count'] ?? students?.length ?? 0,
       thumbnail: json['thumbnail'],
       videoUrl: json['video_url'], // Added for course video
     );
@@ -8,6 +8,7 @@ class AppNotification {
   final String? actionId; // ID related to the action (courseId, sessionId, etc.)
   final DateTime createdAt;
   final bool isRead;
+  final int count; // How many events of the same kind were merged into this one
 
   AppNotification({
     required this.id,
@@ -19,6 +20,7 @@ class AppNotification {
     this.actionId,
     required this.createdAt,
     this.isRead = false,
+    this.count = 1,
   });
 
   factory AppNotification.fromJson(Map<String, dynamic> json) {
@@ -32,6 +34,7 @@ class AppNotification {
       actionId: json['action_id'],
       createdAt: DateTime.parse(json['created_at']),
       isRead: json['is_read'] ?? false,
+      count: json['count'] ?? 1,
     );
   }
 
@@ -46,6 +49,7 @@ class AppNotification {
       'action_id': actionId,
       'created_at': createdAt.toIso8601String(),
       'is_read': isRead,
+      'count': count,
     };
   }
 
@@ -59,6 +63,7 @@ class AppNotification {
     String? actionId,
     DateTime? createdAt,
     bool? isRead,
+    int? count,
   }) {
     return AppNotification(
       id: id ?? this.id,
@@ -70,6 +75,7 @@ class AppNotification {
       actionId: actionId ?? this.actionId,
       createdAt: createdAt ?? this.createdAt,
       isRead: isRead ?? this.isRead,
+      count: count ?? this.count,
     );
   }
 }
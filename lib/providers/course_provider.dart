@@ -34,43 +34,74 @@ class CourseProvider with ChangeNotifier {
     return _enrolledCourseIds.contains(courseId);
   }
   
-  Future<void> fetchAvailableCourses(String? token, String? grade) async {
+  // The catalog is paged with a cursor. The first page is loaded by
+  // fetchAvailableCourses, further pages by fetchMoreCourses as the list
+  // scrolls, for the same grade and teacher
+  static const int coursesPageSize = 20;
+  String? _coursesGrade;
+  String? _coursesTeacherId;
+  String? _nextCoursesCursor;
+  bool _isLoadingMoreCourses = false;
+
+  bool get hasMoreCourses => _nextCoursesCursor != null;
+  bool get isLoadingMoreCourses => _isLoadingMoreCourses;
+
+  Future<Map<String, dynamic>> _fetchCoursesPage(String token, String? cursor, int limit) async {
+    final apiUrl = dotenv.env['API_URL'];
+    if (apiUrl == null) {
+      throw Exception('API_URL not found in environment variables');
+    }
+
+    final url = Uri.parse('$apiUrl/courses').replace(queryParameters: {
+      'limit': '$limit',
+      if (_coursesGrade != null) 'grade': _coursesGrade!,
+      if (_coursesTeacherId != null) 'teacher_id': _coursesTeacherId!,
+      if (cursor != null) 'cursor': cursor,
+    });
+    print('Fetching available courses from: $url');
+
+    final response = await http.get(
+      url,
+      headers: {
+        'Authorization': 'Bearer $token',
+        'Content-Type': 'application/json',
+      },
+    ).timeout(const Duration(seconds: 10));
+
+    print('Fetch available courses response status: ${response.statusCode}');
+
+    if (response.statusCode != 200) {
+      final responseData = json.decode(response.body);
+      throw Exception(responseData['detail'] ?? 'Failed to fetch courses');
+    }
+    return json.decode(response.body);
+  }
+
+  // Loads the first page of courses. Pass allPages for lists that need every
+  // course at once, such as a teacher's own courses in a picker
+  Future<void> fetchAvailableCourses(String? token, String? grade, {String? teacherId, bool allPages = false}) async {
     if (token == null) return;
     
     _isLoading = true;
+    _coursesGrade = grade;
+    _coursesTeacherId = teacherId;
     notifyListeners();
     
     try {
-      final apiUrl = dotenv.env['API_URL'];
-      if (apiUrl == null) {
-        throw Exception('API_URL not found in environment variables');
-      }
-      
-      final url = Uri.parse('$apiUrl/courses${grade != null ? '?grade=$grade' : ''}');
-      print('Fetching available courses from: $url');
-      
-      final response = await http.get(
-        url,
-        headers: {
-          'Authorization': 'Bearer $token',
-          'Content-Type': 'application/json',
-        },
-      ).timeout(const Duration(seconds: 10));
-      
-      print('Fetch available courses response status: ${response.statusCode}');
-      
-      if (response.statusCode == 200) {
-        final List<dynamic> coursesData = json.decode(response.body);
-        _availableCourses = coursesData.map((data) => Course.fromJson(data)).toList();
-        _error = null;
-        _isLoading = false;
-        notifyListeners();
-      } else {
-        final responseData = json.decode(response.body);
-        _error = responseData['detail'] ?? 'Failed to fetch courses';
-        _isLoading = false;
-        notifyListeners();
-      }
+      final List<Course> courses = [];
+      String? cursor;
+      do {
+        final page = await _fetchCoursesPage(token, cursor, allPages ? 100 : coursesPageSize);
+        final List<dynamic> coursesData = page['items'];
+        courses.addAll(coursesData.map((data) => Course.fromJson(data)));
+        cursor = page['next_cursor'];
+      } while (allPages && cursor != null);
+      
+      _availableCourses = courses;
+      _nextCoursesCursor = cursor;
+      _error = null;
+      _isLoading = false;
+      notifyListeners();
     } catch (e) {
       print('Fetch available courses error: $e');
       _error = 'Connection error: ${e.toString()}';
@@ -78,6 +109,30 @@ class CourseProvider with ChangeNotifier {
       notifyListeners();
     }
   }
+
+  // Appends the next page of courses, if there is one and none is loading
+  Future<void> fetchMoreCourses(String? token) async {
+    if (token == null || _nextCoursesCursor == null || _isLoadingMoreCourses || _isLoading) return;
+
+    _isLoadingMoreCourses = true;
+    notifyListeners();
+
+    final cursor = _nextCoursesCursor;
+    try {
+      final page = await _fetchCoursesPage(token, cursor, coursesPageSize);
+      // Drop the page if the list was reloaded meanwhile
+      if (cursor == _nextCoursesCursor) {
+        final List<dynamic> coursesData = page['items'];
+        _availableCourses.addAll(coursesData.map((data) => Course.fromJson(data)));
+        _nextCoursesCursor = page['next_cursor'];
+      }
+    } catch (e) {
+      print('Fetch more courses error: $e');
+      _error = 'Connection error: ${e.toString()}';
+    }
+    _isLoadingMoreCourses = false;
+    notifyListeners();
+  }
   
   Future<void> fetchEnrolledCourses(String? token) async {
     if (token == null) return;
@@ -718,7 +773,11 @@ class CourseProvider with ChangeNotifier {
         return true;
       } else {
         final responseData = json.decode(response.body);
-        _error = responseData['detail'] ?? 'Failed to create session';
+        final detail = responseData['detail'];
+        // Scheduling conflicts (409) return the message with the overlapping sessions
+        _error = detail is Map
+            ? detail['message']
+            : detail ?? 'Failed to create session';
         _isLoading = false;
         notifyListeners();
         return false;
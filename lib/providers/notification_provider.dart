@@ -41,7 +41,8 @@ class NotificationProvider with ChangeNotifier {
         throw Exception('API_URL not found in environment variables');
       }
 
-      final url = Uri.parse('$apiUrl/notifications');
+      // The API returns the newest page; the unread total comes from its counter
+      final url = Uri.parse('$apiUrl/notifications?limit=100');
       print('Fetching notifications from: $url');
 
       final response = await http.get(
@@ -65,6 +66,7 @@ class NotificationProvider with ChangeNotifier {
         
         // Count unread notifications
         _updateUnreadCount();
+        await _fetchUnreadCount(apiUrl, token);
         
         // Save to shared preferences
         _saveNotificationsToPrefs();
@@ -204,12 +206,30 @@ class NotificationProvider with ChangeNotifier {
     _saveNotificationsToPrefs();
   }
 
+  Future<void> _fetchUnreadCount(String apiUrl, String token) async {
+    try {
+      final response = await http.get(
+        Uri.parse('$apiUrl/notifications/unread-count'),
+        headers: {
+          'Authorization': 'Bearer $token',
+          'Content-Type': 'application/json',
+        },
+      ).timeout(const Duration(seconds: 10));
+
+      if (response.statusCode == 200) {
+        _unreadCount = json.decode(response.body)['unread'];
+      }
+    } catch (e) {
+      print('Fetch unread count error: $e');
+    }
+  }
+
   Future<void> markAsRead(String notificationId) async {
     final index = _notifications.indexWhere((n) => n.id == notificationId);
     if (index == -1) return;
 
+    if (!_notifications[index].isRead && _unreadCount > 0) _unreadCount--;
     _notifications[index] = _notifications[index].copyWith(isRead: true);
-    _updateUnreadCount();
     _saveNotificationsToPrefs();
     notifyListeners();
 
@@ -268,8 +288,8 @@ class NotificationProvider with ChangeNotifier {
     final index = _notifications.indexWhere((n) => n.id == notificationId);
     if (index == -1) return;
 
+    if (!_notifications[index].isRead && _unreadCount > 0) _unreadCount--;
     _notifications.removeAt(index);
-    _updateUnreadCount();
     _saveNotificationsToPrefs();
     notifyListeners();
 
@@ -296,8 +316,14 @@ class NotificationProvider with ChangeNotifier {
   }
 
   void addNotification(AppNotification notification) {
+    // A coalesced notification comes back with the same id and a higher count
+    final index = _notifications.indexWhere((n) => n.id == notification.id);
+    if (index != -1) {
+      if (!_notifications[index].isRead && _unreadCount > 0) _unreadCount--;
+      _notifications.removeAt(index);
+    }
     _notifications.insert(0, notification); // Add to the beginning of the list
-    _updateUnreadCount();
+    if (!notification.isRead) _unreadCount++;
     _saveNotificationsToPrefs();
     notifyListeners();
   }
@@ -52,7 +52,7 @@ class _CreateSessionScreenState extends State<CreateSessionScreen> {
       final authProvider = Provider.of<AuthProvider>(context, listen: false);
       final courseProvider = Provider.of<CourseProvider>(context, listen: false);
 
-      await courseProvider.fetchAvailableCourses(authProvider.token, null);
+      await courseProvider.fetchAvailableCourses(authProvider.token, null, teacherId: authProvider.user?.id, allPages: true);
 
       if (courseProvider.error != null) {
         setState(() {
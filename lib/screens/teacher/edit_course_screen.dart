@@ -96,6 +96,7 @@ class _EditCourseScreenState extends State<EditCourseScreen> {
         teacherId: widget.course.teacherId,
         teacherName: widget.course.teacherName,
         students: widget.course.students,
+        studentCount: widget.course.studentCount,
         thumbnail: widget.course.thumbnail,
         videoUrl: widget.course.videoUrl,
       );
@@ -43,7 +43,7 @@ class _TeacherDashboardState extends State<TeacherDashboard> {
       
       // Fetch data
       await Future.wait([
-        courseProvider.fetchAvailableCourses(authProvider.token, null),
+        courseProvider.fetchAvailableCourses(authProvider.token, null, teacherId: authProvider.user?.id, allPages: true),
         courseProvider.fetchUpcomingSessions(authProvider.token),
         notificationProvider.fetchNotifications(authProvider.token, authProvider.user?.id ?? ''),
       ]);
@@ -190,7 +190,7 @@ class _TeacherDashboardState extends State<TeacherDashboard> {
                                   const Icon(Icons.people),
                                   const SizedBox(height: 8),
                                   Text(
-                                    '${teacherCourses.fold(0, (sum, course) => sum + (course.students?.length ?? 0))}',
+                                    '${teacherCourses.fold(0, (sum, course) => sum + course.studentCount)}',
                                     style: const TextStyle(
                                       fontSize: 24,
                                       fontWeight: FontWeight.bold,
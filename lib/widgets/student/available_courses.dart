@@ -1,5 +1,6 @@
 import 'package:flutter/material.dart';
 import 'package:provider/provider.dart';
+import '../../providers/auth_provider.dart';
 import '../../providers/course_provider.dart';
 import '../../models/course.dart';
 
@@ -9,6 +10,7 @@ class AvailableCourses extends StatelessWidget {
   @override
   Widget build(BuildContext context) {
     final courseProvider = Provider.of<CourseProvider>(context);
+    final authProvider = Provider.of<AuthProvider>(context, listen: false);
     final availableCourses = courseProvider.availableCourses;
 
     if (courseProvider.isLoading) {
@@ -36,8 +38,21 @@ class AvailableCourses extends StatelessWidget {
       height: 320, // Adjust height for the course card
       child: ListView.builder(
         scrollDirection: Axis.horizontal,
-        itemCount: availableCourses.length,
+        // One extra item shows a spinner while the next page loads
+        itemCount: availableCourses.length + (courseProvider.hasMoreCourses ? 1 : 0),
         itemBuilder: (context, index) {
+          // Load the next page once the end of the list comes into view
+          if (courseProvider.hasMoreCourses && index >= availableCourses.length - 3) {
+            WidgetsBinding.instance.addPostFrameCallback((_) {
+              courseProvider.fetchMoreCourses(authProvider.token);
+            });
+          }
+          if (index == availableCourses.length) {
+            return const SizedBox(
+              width: 80,
+              child: Center(child: CircularProgressIndicator()),
+            );
+          }
           return Padding(
             padding: const EdgeInsets.only(right: 16.0),
             child: _buildCourseCard(context, availableCourses[index]),
@@ -130,7 +130,7 @@ class TeacherCourses extends StatelessWidget {
                           const Icon(Icons.people, size: 16, color: Colors.grey),
                           const SizedBox(width: 4),
                           Text(
-                            '${course.students?.length ?? 0} students',
+                            '${course.studentCount} students',
                             style: const TextStyle(fontSize: 12, color: Colors.grey),
                           ),
                         ],
@@ -200,7 +200,7 @@ class TeacherCourses extends StatelessWidget {
                                 
                                 if (result == true && context.mounted) { // Fixed: added context.mounted check
                                   // Refresh courses if update was successful
-                                  await courseProvider.fetchAvailableCourses(authProvider.token, null);
+                                  await courseProvider.fetchAvailableCourses(authProvider.token, null, teacherId: authProvider.user?.id, allPages: true);
                                 }
                               },
                               style: ElevatedButton.styleFrom(